@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 
 import sys
-if sys.version_info <= (3, 2):
-    sys.stderr.write("Sonata requires Python 3.2+\n")
+if sys.version_info < (3, 5):
+    sys.stderr.write("Sonata requires Python 3.5+\n")
     sys.exit(1)
 
 from distutils.dep_util import newer
@@ -1,8 +1,14 @@
+import ast
 import collections
+import hashlib
+import heapq
+import json
 import logging
 import os
 import re
 import shutil
+import sqlite3
+import tempfile
 import threading # artwork_update starts a thread _artwork_update
 
 from gi.repository import Gtk, Gdk, GdkPixbuf, GLib, GObject
@@ -14,14 +20,180 @@ from sonata.pluginsystem import pluginsystem
 
 COVERS_DIR = os.path.expanduser("~/.covers")
 COVERS_TEMP_DIR = os.path.join(COVERS_DIR, 'temp')
+# Scaled copies of the covers, to avoid decoding the full images
+THUMBNAILS_DIR = os.path.expanduser("~/.config/sonata/thumbnails")
+# Sizes of the covers whose scaled copies are kept on disk
+THUMBNAIL_SIZES = frozenset([consts.LIB_COVER_SIZE])
+# Space used by the scaled copies, in bytes: the least recently used ones
+# are removed above
+THUMBNAILS_BYTES = 64 * 1024 * 1024
+# Memory used by the pixbufs kept by ArtworkCache, in bytes
+PIXBUF_CACHE_BYTES = 16 * 1024 * 1024
+# Artwork file of each album
+ART_CACHE_PATH = os.path.expanduser("~/.config/sonata/art_cache.db")
+# Where the artwork files were saved by previous versions
+LEGACY_ART_CACHE_PATH = os.path.expanduser("~/.config/sonata/art_cache")
+# Number of changes of the artwork cache written at once
+ART_CACHE_COMMIT_SIZE = 100
+# Number of directories whose files are kept by DirectoryCache
+DIRECTORY_CACHE_SIZE = 20000
+# Number of threads looking for the covers of the library on the disk, and
+# downloading them
+LOCAL_ARTWORK_THREADS = 4
+REMOTE_ARTWORK_THREADS = 2
+# Number of rows of the library, before and after the visible ones, whose
+# covers are looked for in advance
+ARTWORK_PREFETCH_ROWS = 20
 logger = logging.getLogger(__name__)
 
 
+class DirectoryCache:
+    """Names of the files of directories, read again when they change.
+
+    Looking for artwork checks many possible files in each album directory,
+    which is slow on network file systems: the directory is listed once
+    instead, and then only its modification time is checked. `counters`
+    counts the lookups answered ('lookups'), and the 'stat' and 'scandir'
+    calls made to answer them.
+    """
+
+    def __init__(self, max_size=DIRECTORY_CACHE_SIZE):
+        self.max_size = max_size
+        # directory -> (modification time, names of its files)
+        self._listings = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def listdir(self, directory):
+        """Return the names of the files of `directory`, as a frozenset.
+
+        Returns None if `directory` can't be listed.
+        """
+        self.counters['lookups'] += 1
+        try:
+            self.counters['stat'] += 1
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            with self._lock:
+                self._listings.pop(directory, None)
+            return None
+
+        with self._lock:
+            listing = self._listings.get(directory)
+            if listing is not None and listing[0] == mtime:
+                self._listings.move_to_end(directory)
+                return listing[1]
+
+        try:
+            self.counters['scandir'] += 1
+            with os.scandir(directory) as entries:
+                names = frozenset(entry.name for entry in entries)
+        except OSError:
+            return None
+        with self._lock:
+            self._listings[directory] = (mtime, names)
+            self._listings.move_to_end(directory)
+            while len(self._listings) > self.max_size:
+                self._listings.popitem(last=False)
+        return names
+
+    def clear(self):
+        with self._lock:
+            self._listings.clear()
+
+
+# Shared by all the ArtworkLocators
+directory_cache = DirectoryCache()
+
+
+class ArtworkLoader:
+    """Pool of threads looking for covers, the most urgent ones first.
+
+    `load` is called from the threads with the key of the cover (a
+    SongRecord), the priority of its request and the list of the rows
+    waiting for it. Requests of the same cover are loaded once. The threads
+    are started on first use.
+    """
+
+    def __init__(self, load, num_threads, name):
+        self._load = load
+        self._num_threads = num_threads
+        self._name = name
+        self._threads = []
+        self._cond = threading.Condition()
+        # Heap of (priority, sequence number, key), and key -> [priority,
+        # rows] for the keys waiting. Outdated heap entries are skipped.
+        self._heap = []
+        self._pending = {}
+        self._sequence = 0
+
+    def schedule(self, requests, cancel=True):
+        """Request the covers of (priority, key, row) `requests`.
+
+        Lower priorities are loaded first. If `cancel` is True, the requests
+        waiting which are not in `requests` are cancelled.
+        """
+        with self._cond:
+            if cancel:
+                self._heap = []
+                self._pending = {}
+            for priority, key, row in requests:
+                entry = self._pending.get(key)
+                if entry is None:
+                    entry = self._pending[key] = [priority, []]
+                    self._push(priority, key)
+                elif priority < entry[0]:
+                    entry[0] = priority
+                    self._push(priority, key)
+                entry[1].append(row)
+            self._start()
+            self._cond.notify_all()
+
+    def clear(self):
+        """Cancel the requests waiting."""
+        with self._cond:
+            self._heap = []
+            self._pending = {}
+
+    def _push(self, priority, key):
+        self._sequence += 1
+        heapq.heappush(self._heap, (priority, self._sequence, key))
+
+    def _start(self):
+        while len(self._threads) < self._num_threads:
+            thread = threading.Thread(target=self._run, name=self._name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self):
+        # Wait for the most urgent request
+        with self._cond:
+            while True:
+                while not self._heap:
+                    self._cond.wait()
+                priority, _sequence, key = heapq.heappop(self._heap)
+                entry = self._pending.get(key)
+                if entry is not None and entry[0] == priority:
+                    del self._pending[key]
+                    return key, priority, entry[1]
+
+    def _run(self):
+        while True:
+            key, priority, rows = self._next()
+            try:
+                self._load(key, priority, rows)
+            except Exception:
+                logger.exception("Unable to load the artwork of %r", key)
+
+
 class ArtworkLocator:
     """Find and return artwork paths requested for songs."""
 
-    def __init__(self, config):
+    def __init__(self, config, directories=None):
         self.config = config
+        self.directories = directories if directories is not None \
+                else directory_cache
 
     def _get_locations(self, artist, album, song_dir, default_kind=None):
         """Get the various possible locations for the artwork for one song."""
@@ -75,9 +247,8 @@ class ArtworkLocator:
         image.
         """
 
-        try:
-            files = os.listdir(song_dir)
-        except OSError:
+        files = self.directories.listdir(song_dir)
+        if files is None:
             return None
 
         get_ext = lambda path: os.path.splitext(path)[1][1:]
@@ -129,9 +300,15 @@ class ArtworkLocator:
         locations_map = self._get_locations(artist, album, song_dir,
                                             self.config.art_location)
 
+        # All the locations of a directory are checked with one listing
+        listings = {}
         for kind, locations in locations_map.items():
             for location in locations:
-                if os.path.exists(location):
+                directory, name = os.path.split(location)
+                if directory not in listings:
+                    listings[directory] = self.directories.listdir(directory)
+                if listings[directory] is not None and \
+                   name in listings[directory]:
                     return (kind, location)
 
         return (None, None)
@@ -217,15 +394,18 @@ class Artwork(GObject.GObject):
         self.misc_img_in_dir = None
         self.stop_art_update = False
         self.downloading_image = False
-        self.lib_art_cond = None
 
         # local artwork, cache for library
         self.lib_model = None
-        self.lib_art_rows_local = []
-        self.lib_art_rows_remote = []
+        self.lib_art_local = None
+        self.lib_art_remote = None
         self.lib_art_pb_size = 0
+        # Albums without a cover found, not looked for again. Only used
+        # from the main loop.
+        self.lib_art_missing = set()
 
-        self.cache = ArtworkCache(self.config)
+        self.cache = ArtworkCache(self.config,
+                                  legacy_path=LEGACY_ART_CACHE_PATH)
         self.cache.load()
 
     def update_songinfo(self, songinfo):
@@ -268,59 +448,53 @@ class Artwork(GObject.GObject):
         self.lib_model = model
         self.lib_art_pb_size = pb_size
 
-        self.lib_art_cond = threading.Condition()
-        thread = threading.Thread(target=self._library_artwork_update)
-        thread.name = "ArtworkLibraryUpdate"
-        thread.daemon = True
-        thread.start()
+        # Covers are looked for on the disk, and then downloaded, by
+        # separate pools of threads
+        self.lib_art_local = ArtworkLoader(self._library_artwork_local,
+                                           LOCAL_ARTWORK_THREADS,
+                                           "ArtworkLibraryLocal")
+        self.lib_art_remote = ArtworkLoader(self._library_artwork_remote,
+                                            REMOTE_ARTWORK_THREADS,
+                                            "ArtworkLibraryRemote")
+
+    def library_artwork_reset(self):
+        # The library is displayed again: forget the rows requested before
+        self.lib_art_missing = set()
+        if self.lib_art_local is not None:
+            self.lib_art_local.clear()
+            self.lib_art_remote.clear()
 
     def library_artwork_update(self, model, start_row, end_row, albumpb):
         self.albumpb = albumpb
 
-        # Update self.lib_art_rows_local with new rows followed
-        # by the rest of the rows.
-        self.lib_art_cond.acquire()
-        self.lib_art_rows_local = []
-        self.lib_art_rows_remote = []
+        # Look for the covers of the visible rows first, followed by the
+        # next rows and the previous ones. The rows which have a cover
+        # already, or none to find, are skipped and the rows not requested
+        # anymore are cancelled.
+        requests = []
         start = start_row.get_indices()[0]
         end = end_row.get_indices()[0]
-        test_rows = list(range(start, end + 1)) + list(range(len(model)))
-        for row in test_rows:
+        test_rows = list(range(start, end + 1)) + \
+                list(range(end + 1, min(end + 1 + ARTWORK_PREFETCH_ROWS,
+                                        len(model)))) + \
+                list(range(start - 1, max(start - 1 - ARTWORK_PREFETCH_ROWS,
+                                          -1), -1))
+        for priority, row in enumerate(test_rows):
             i = model.get_iter((row,))
             icon = model.get_value(i, 0)
             if icon == self.albumpb:
                 data = model.get_value(i, 1)
-                self.lib_art_rows_local.append((i, data, icon))
-        self.lib_art_cond.notifyAll()
-        self.lib_art_cond.release()
-
-    def _library_artwork_update(self):
-        while True:
-            # Wait for items..
-            self.lib_art_cond.acquire()
-            while(len(self.lib_art_rows_local) == 0 and \
-                  len(self.lib_art_rows_remote) == 0):
-                self.lib_art_cond.wait()
-            self.lib_art_cond.release()
-
-            # Try first element, giving precedence to local queue:
-            if self.lib_art_rows_local:
-                i, data, icon = self.lib_art_rows_local.pop(0)
-                cb = self._library_artwork_update_local
-            elif self.lib_art_rows_remote:
-                i, data, icon = self.lib_art_rows_remote.pop(0)
-                cb = self._library_artwork_update_remote
-            else:
-                continue
-
-            cache_key = SongRecord(artist=data.artist, album=data.album,
-                                         path=data.path)
-            # Try to replace default icons with cover art:
-            pb = self.cache.get_pixbuf(cache_key, self.lib_art_pb_size)
-            cb(i, data, icon, cache_key, pb)
-
-
-    def _library_artwork_update_local(self, i, data, icon, cache_key, pb):
+                cache_key = SongRecord(artist=data.artist, album=data.album,
+                                       path=data.path)
+                if cache_key not in self.lib_art_missing:
+                    requests.append((priority, cache_key, (i, data)))
+        self.lib_art_remote.clear()
+        self.lib_art_local.schedule(requests)
+
+    def _library_artwork_local(self, cache_key, priority, rows):
+        # Try to replace default icons with cover art:
+        pb = self.cache.get_pixbuf(cache_key, self.lib_art_pb_size,
+                                   check=True)
         filename = None
 
         if pb is not None:
@@ -336,40 +510,44 @@ class Artwork(GObject.GObject):
         # No cached pixbuf, try local/remote search:
         if pb is None:
             pb, filename = self.library_get_album_cover(
-                data.path, data.artist, data.album, self.lib_art_pb_size)
+                cache_key.path, cache_key.artist, cache_key.album,
+                self.lib_art_pb_size)
 
         # Set pixbuf icon in model; add to cache
         if pb is not None and filename is not None:
             self.cache.set(cache_key, filename)
-            GLib.idle_add(self.library_set_cover, i, pb, data)
+            for i, data in rows:
+                GLib.idle_add(self.library_set_cover, i, pb, data)
 
         if pb is None and self.config.covers_pref == consts.ART_LOCAL_REMOTE:
             # No local art found, add to remote queue for later
-            self.lib_art_rows_remote.append((i, data, icon))
-
-
-    def _library_artwork_update_remote(self, i, data, icon, cache_key, pb):
-        filename = None
-
-        # No cached pixbuf, try local/remote search:
-        if pb is None:
-            pb, filename = self.library_get_album_cover(data.path,
-                                                        data.artist,
-                                                        data.album,
-                                                        self.lib_art_pb_size)
-            filename = self.locator.path(data.artist, data.album, data.path)
-            self.artwork_download_img_to_file(data.artist, data.album,
-                                              filename)
+            self.lib_art_remote.schedule([(priority, cache_key, row)
+                                          for row in rows], cancel=False)
+        elif pb is None:
+            GLib.idle_add(self.library_artwork_missing, cache_key)
+
+    def _library_artwork_remote(self, cache_key, priority, rows):
+        artist, album = cache_key.artist, cache_key.album
+        filename = self.locator.path(artist, album, cache_key.path)
+        self.artwork_download_img_to_file(artist, album, filename)
+        pb, filename = self.library_get_album_cover(
+            cache_key.path, artist, album, self.lib_art_pb_size)
 
         # Set pixbuf icon in model; add to cache
         if pb is not None and filename is not None:
             self.cache.set(cache_key, filename)
-            GLib.idle_add(self.library_set_cover, i, pb, data)
+            for i, data in rows:
+                GLib.idle_add(self.library_set_cover, i, pb, data)
 
         if pb is None:
             # No remote art found, store self.albumpb filename in cache
             self.cache.set(cache_key, self.album_filename)
+            GLib.idle_add(self.library_artwork_missing, cache_key)
 
+    def library_artwork_missing(self, cache_key):
+        # Called from the main loop by the loader threads
+        self.lib_art_missing.add(cache_key)
+        return False
 
     def library_set_image_for_current_song(self, cache_key):
         # Search through the rows in the library to see
@@ -392,8 +570,7 @@ class Artwork(GObject.GObject):
         _tmp, coverfile = self.locator.locate(artist, album, song_dir)
         if coverfile:
             try:
-                coverpb = GdkPixbuf.Pixbuf.new_from_file_at_size(coverfile,
-                                                            pb_size, pb_size)
+                coverpb = self.cache.load_scaled(coverfile, pb_size)
             except:
                 # Delete bad image:
                 misc.remove_file(coverfile)
@@ -661,54 +838,302 @@ class CoverDownloader:
 
 
 class ArtworkCache:
-    def __init__(self, config, path=None):
+    """Artwork file of each album, and the pixbufs made from these files.
+
+    The artwork files are stored in an SQLite database at `path`, and looked
+    up when they are requested: nothing is loaded at startup. Changes are
+    written by transactions of ART_CACHE_COMMIT_SIZE changes, and when the
+    cache is saved. The cache written by previous versions, at `legacy_path`,
+    is imported once.
+
+    The styled pixbufs are kept in memory, most recently used last, as long
+    as they fit in `max_bytes`. The covers of the sizes in THUMBNAIL_SIZES are
+    also saved scaled in `thumbnails_dir`, so that they don't have to be
+    decoded again when they are needed after a restart: they are removed
+    with their artwork file, and when they take more than `thumbnails_bytes`
+    once the cache is saved. The pixbufs in
+    memory are returned without checking their file, unless requested (the
+    library does it from its threads); the thumbnails are made again when
+    the modification time of the artwork file changes.
+    """
+
+    def __init__(self, config, path=ART_CACHE_PATH, legacy_path=None,
+                 thumbnails_dir=THUMBNAILS_DIR, max_bytes=PIXBUF_CACHE_BYTES,
+                 thumbnails_bytes=THUMBNAILS_BYTES):
         self.logger = logging.getLogger('sonata.artwork.cache')
-        self._cache = {}
         self.config = config
-        self.path = path if path is not None else \
-                os.path.expanduser("~/.config/sonata/art_cache")
+        self.path = path
+        self.legacy_path = legacy_path
+        # The database is opened on first use; the library looks its
+        # artwork up from a thread.
+        self._db = None
+        self._db_lock = threading.RLock()
+        self._changes = 0
+        self.thumbnails_dir = thumbnails_dir
+        self.thumbnails_bytes = thumbnails_bytes
+        self.max_bytes = max_bytes
+        # (key, size, covers type) -> (path, modification time, pixbuf,
+        # bytes)
+        self._pixbufs = collections.OrderedDict()
+        self._pixbufs_bytes = 0
+        # The library loads its artwork from a thread
+        self._pixbufs_lock = threading.Lock()
+
+    def _connection(self):
+        # Returns the database, opened (and created) if needed. Has to be
+        # called with _db_lock held.
+        if self._db is not None:
+            return self._db
+        misc.create_dir(os.path.dirname(self.path))
+        try:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS artwork ("
+                             "key TEXT PRIMARY KEY, filename TEXT NOT NULL)")
+        except sqlite3.Error as e:
+            self.logger.info("Unable to open %s: %s", self.path, e)
+            self._db = sqlite3.connect(":memory:", check_same_thread=False)
+            self._db.execute("CREATE TABLE artwork ("
+                             "key TEXT PRIMARY KEY, filename TEXT NOT NULL)")
+        return self._db
+
+    def _write(self, query, *args):
+        with self._db_lock:
+            db = self._connection()
+            try:
+                db.execute(query, args)
+            except sqlite3.Error as e:
+                self.logger.info("Unable to update the artwork cache: %s", e)
+                return
+            self._changes += 1
+            if self._changes >= ART_CACHE_COMMIT_SIZE:
+                self._commit()
+
+    def _commit(self):
+        try:
+            self._connection().commit()
+            self._changes = 0
+        except sqlite3.Error as e:
+            self.logger.info("Unable to save: %s", e)
+
+    def _key(self, key):
+        # SongRecords are stored as JSON lists of their fields
+        return json.dumps(list(key))
 
     def set(self, key, value):
         self.logger.debug("Setting %r to %r", key, value)
-        self._cache[key] = value
+        self._forget_pixbufs(key)
+        self._write("INSERT OR REPLACE INTO artwork VALUES (?, ?)",
+                    self._key(key), value)
 
     def get(self, key):
         self.logger.debug("Requesting for %r", key)
-        return self._cache.get(key)
-
-    def get_pixbuf(self, key, size, default=None):
+        with self._db_lock:
+            try:
+                row = self._connection().execute(
+                    "SELECT filename FROM artwork WHERE key = ?",
+                    (self._key(key),)).fetchone()
+            except sqlite3.Error as e:
+                self.logger.info("Unable to read the artwork cache: %s", e)
+                return None
+        return row[0] if row is not None else None
+
+    def remove(self, key):
+        self._forget_pixbufs(key)
+        self._write("DELETE FROM artwork WHERE key = ?", self._key(key))
+
+    def get_pixbuf(self, key, size, default=None, check=False):
+        # The pixbufs in memory are returned as is, without looking the file
+        # up, unless `check` is True.
         self.logger.debug("Requesting pixbuf for %r", key)
-        try:
-            path = self._cache[key]
-        except KeyError:
+        pixbuf_key = (key, size, self.config.covers_type)
+        with self._pixbufs_lock:
+            cached = self._pixbufs.get(pixbuf_key)
+            if cached is not None:
+                self._pixbufs.move_to_end(pixbuf_key)
+                if not check:
+                    return cached[2]
+
+        path = self.get(key)
+        if path is None:
             return default
 
-        if not os.path.exists(path):
-            self._cache.pop(key, None)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self.remove(key)
+            self._remove_thumbnails(path)
             return default
+        if cached is not None and cached[:2] == (path, mtime):
+            return cached[2]
 
         try:
-            p = GdkPixbuf.Pixbuf.new_from_file_at_size(path, size, size)
+            p = self.load_scaled(path, size, mtime)
         except:
             self.logger.exception("Unable to load %r at size (%d, %d)",
                                   path, size, size)
             raise
-        return img.do_style_cover(self.config, p, size, size)
+        p = img.do_style_cover(self.config, p, size, size)
+        self._add_pixbuf(pixbuf_key, path, mtime, p)
+        return p
+
+    def _add_pixbuf(self, pixbuf_key, path, mtime, pixbuf):
+        nbytes = pixbuf.get_rowstride() * pixbuf.get_height()
+        with self._pixbufs_lock:
+            previous = self._pixbufs.pop(pixbuf_key, None)
+            if previous is not None:
+                self._pixbufs_bytes -= previous[3]
+            self._pixbufs[pixbuf_key] = (path, mtime, pixbuf, nbytes)
+            self._pixbufs_bytes += nbytes
+            while self._pixbufs_bytes > self.max_bytes and \
+                  len(self._pixbufs) > 1:
+                _key, (_path, _mtime, _pixbuf, nbytes) = \
+                        self._pixbufs.popitem(last=False)
+                self._pixbufs_bytes -= nbytes
+
+    def _forget_pixbufs(self, key):
+        # Drops the pixbufs of `key`, at all sizes
+        with self._pixbufs_lock:
+            for pixbuf_key in [pixbuf_key for pixbuf_key in self._pixbufs
+                               if pixbuf_key[0] == key]:
+                self._pixbufs_bytes -= self._pixbufs.pop(pixbuf_key)[3]
+
+    def load_scaled(self, path, size, mtime=None):
+        """Return the (unstyled) image of `path`, scaled to fit in `size`.
+
+        The scaled copy saved in the thumbnails directory is used when it is
+        up to date. Raises GLib.GError if the image can't be loaded.
+        """
+        if size not in THUMBNAIL_SIZES:
+            return GdkPixbuf.Pixbuf.new_from_file_at_size(path, size, size)
+
+        if mtime is None:
+            mtime = os.stat(path).st_mtime
+        mtime = str(int(mtime))
+        thumbnail = self._thumbnail_path(path, size)
+        try:
+            p = GdkPixbuf.Pixbuf.new_from_file(thumbnail)
+            if p.get_option("tEXt::Thumb::MTime") == mtime:
+                # Most recently used thumbnails are kept by compact()
+                os.utime(thumbnail)
+                return p
+        except (GLib.GError, OSError):
+            pass
+
+        # An outdated thumbnail is replaced, having the same name
+
+        p = GdkPixbuf.Pixbuf.new_from_file_at_size(path, size, size)
+        misc.create_dir(self.thumbnails_dir)
+        try:
+            fd, temp_path = tempfile.mkstemp(suffix=".png",
+                                             dir=self.thumbnails_dir)
+            os.close(fd)
+        except OSError as e:
+            self.logger.info("Unable to save the thumbnail of %r: %s",
+                             path, e)
+            return p
+        # Written aside and then renamed, so that a thumbnail is always
+        # complete
+        try:
+            p.savev(temp_path, "png", ["tEXt::Thumb::MTime"], [mtime])
+            os.replace(temp_path, thumbnail)
+        except (OSError, GLib.GError) as e:
+            misc.remove_file(temp_path)
+            self.logger.info("Unable to save the thumbnail of %r: %s",
+                             path, e)
+        return p
+
+    def _thumbnail_path(self, path, size):
+        name = hashlib.md5(("%s:%d" % (path, size)).encode('utf8'))
+        return os.path.join(self.thumbnails_dir, name.hexdigest() + ".png")
+
+    def _remove_thumbnails(self, path):
+        for size in THUMBNAIL_SIZES:
+            misc.remove_file(self._thumbnail_path(path, size))
+
+    def _prune_thumbnails(self):
+        # Removes the least recently used thumbnails above thumbnails_bytes
+        try:
+            with os.scandir(self.thumbnails_dir) as entries:
+                thumbnails = [(entry.stat().st_mtime, entry.stat().st_size,
+                               entry.path) for entry in entries
+                              if entry.name.endswith(".png")]
+        except OSError:
+            return
+        total = sum(size for _mtime, size, _path in thumbnails)
+        if total <= self.thumbnails_bytes:
+            return
+        self.logger.debug("Removing thumbnails from %s", self.thumbnails_dir)
+        for _mtime, size, thumbnail in sorted(thumbnails):
+            if total <= self.thumbnails_bytes:
+                break
+            misc.remove_file(thumbnail)
+            total -= size
 
     def save(self):
         self.logger.debug("Saving to %s", self.path)
-        misc.create_dir(os.path.dirname(self.path))
-        try:
-            with open(self.path, 'w', encoding="utf8") as f:
-                f.write(repr(self._cache))
-        except IOError as e:
-            self.logger.info("Unable to save: %s", e)
+        with self._db_lock:
+            self._commit()
+            self.compact()
+
+    def compact(self):
+        """Give back the space left by the removed entries, if worth it, and
+        remove the thumbnails above `thumbnails_bytes`."""
+        self._prune_thumbnails()
+        with self._db_lock:
+            db = self._connection()
+            try:
+                pages = db.execute("PRAGMA page_count").fetchone()[0]
+                free = db.execute("PRAGMA freelist_count").fetchone()[0]
+                if free > 10 and free * 4 > pages:
+                    self.logger.debug("Compacting %s", self.path)
+                    db.commit()
+                    db.execute("VACUUM")
+            except sqlite3.Error as e:
+                self.logger.info("Unable to compact: %s", e)
 
     def load(self):
+        """Open the cache, importing the one of previous versions."""
         self.logger.debug("Loading from %s", self.path)
-        self._cache = {}
+        with self._db_lock:
+            self._connection()
+            if self.legacy_path is not None and \
+               os.path.exists(self.legacy_path):
+                self._import_legacy(self.legacy_path)
+
+    def _import_legacy(self, path):
+        # The old cache is the repr() of a dict of SongRecords: it is parsed
+        # without being evaluated.
+        try:
+            with open(path, 'r', encoding="utf8") as f:
+                entries = list(_parse_legacy_cache(f.read()))
+        except (IOError, SyntaxError, ValueError) as e:
+            self.logger.info("Unable to import %s: %s", path, e)
+            entries = []
         try:
-            with open(self.path, 'r', encoding="utf8") as f:
-                self._cache = eval(f.read())
-        except (IOError, SyntaxError) as e:
-            self.logger.info("Unable to load: %s", e)
+            self._connection().executemany(
+                "INSERT OR REPLACE INTO artwork VALUES (?, ?)",
+                ((self._key(key), value) for key, value in entries))
+        except sqlite3.Error as e:
+            self.logger.info("Unable to import %s: %s", path, e)
+            return
+        self._commit()
+        misc.remove_file(path)
+
+
+def _parse_legacy_cache(text):
+    """Yield the (key, filename) items of the repr() of the old cache.
+
+    >>> list(_parse_legacy_cache("{SongRecord(album='B', artist='A', "
+    ...                          "genre=None, year=None, path='A/B'): 'c'}"))
+    [(SongRecord(album='B', artist='A', genre=None, year=None, path='A/B'), 'c')]
+    """
+    tree = ast.parse(text, mode='eval').body
+    if not isinstance(tree, ast.Dict):
+        raise ValueError("not a dict")
+    for key, value in zip(tree.keys, tree.values):
+        if not isinstance(key, ast.Call) or key.args or \
+           getattr(key.func, 'id', None) != 'SongRecord':
+            raise ValueError("unexpected key")
+        fields = dict((keyword.arg, ast.literal_eval(keyword.value))
+                      for keyword in key.keywords)
+        yield SongRecord(**fields), ast.literal_eval(value)
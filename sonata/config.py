@@ -74,6 +74,8 @@ class Config:
                 'profile_num': ('profile_num', 'int', 0)},
             'currformat': {
                 'currentformat': ('current', '', '%A - %T|%L'),
+                'currentsort': ('current_sort', '',
+                                'albumartist, date, album, disc, track'),
                 'currsongformat1': ('currsong1', '', '%T'),
                 'currsongformat2': ('currsong2', '', currsongformat2),
                 'libraryformat': ('library', '', '%A - %T'),
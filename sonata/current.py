@@ -1,13 +1,23 @@
 """Handle the mpd current playlist and provides a user interface for it."""
 
 import os
-import re
+import threading
 import urllib.parse, urllib.request
 
 from gi.repository import Gtk, Gdk, Pango, GLib
 
-from sonata import ui, misc, formatting
-from sonata.mpdhelper import MPDSong
+from sonata import ui, misc, formatting, playlistsort, sortkeys
+from sonata.playlistmodel import PlaylistModel
+
+
+# Fields sorting the playlist for each sort mode (see sortkeys.parse_spec()),
+# the other modes are the name of a tag
+SORT_SPECS = {
+    'artist': "artist, album, disc, track",
+    'album': "album, disc, track",
+    'file': "filename",
+    'dirfile': "file",
+}
 
 
 class Current:
@@ -37,6 +47,8 @@ class Current:
         self.prev_boldrow = -1
         self.playlist_pos_before_filter = None
         self.sel_rows = None
+        # playlistsort.SortRequest being sent to MPD
+        self.sort_request = None
 
         # Current tab
         builder = ui.builder('current')
@@ -88,7 +100,15 @@ class Current:
         return len(self.store) == 0
 
     def clear(self):
+        if self.sort_request is not None:
+            self.sort_request.cancel()
+            self.sort_request = None
+            ui.change_cursor(None)
+        # The view doesn't follow the rows removed one by one
+        save_model = self.view.get_model()
+        self.view.set_model(None)
         self.store.clear()
+        self.view.set_model(save_model)
 
     def on_song_change(self, status):
         self.unbold_boldrow(self.prev_boldrow)
@@ -129,9 +149,9 @@ class Current:
         # Initialize current playlist data and widget
         self.resizing_columns = False
         self.columnformat = self.config.currentformat.split("|")
-        current_columns = [MPDSong] + [str] * len(self.columnformat) + [int]
-        previous_tracks = (item[0] for item in (self.store or []))
-        self.store = Gtk.ListStore(*(current_columns))
+        # Keep the songs of the previous model, only their format changes
+        self.store = PlaylistModel(self.mpd, self.columnformat,
+                                   self.on_times_changed, self.store)
         cellrenderer = Gtk.CellRendererText()
         cellrenderer.set_property("ellipsize", Pango.EllipsizeMode.END)
         cellrenderer.set_property("weight-set", True)
@@ -148,7 +168,8 @@ class Current:
         self.columns = [Gtk.TreeViewColumn(name, cellrenderer, markup=(i + 1))
                 for i, name in enumerate(colnames)]
         for tree in self.columns:
-            tree.add_attribute(cellrenderer, "weight", len(current_columns) - 1)
+            tree.add_attribute(cellrenderer, "weight",
+                               self.store.get_n_columns() - 1)
 
         for column, width in zip(self.columns, self.config.columnwidths):
             column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
@@ -167,7 +188,6 @@ class Current:
         self.view.set_headers_visible(num_columns > 1 and \
                                          self.config.show_header)
         self.view.set_headers_clickable(not self.filterbox_visible)
-        self.update_format(previous_tracks)
         self.view.set_model(self.store)
 
     def dnd_get_data_for_file_managers(self, _treeview, context, selection,
@@ -192,7 +212,7 @@ class Current:
 
         for path in selected:
             index = path.get_indices()[0]
-            item = self.store[index][0].file
+            item = self.store.get_song(index).file
             if return_abs_paths:
                 filenames.append(
                     os.path.join(self.config.current_musicdir, item))
@@ -200,18 +220,6 @@ class Current:
                 filenames.append(item)
         return filenames
 
-    def update_format(self, tracks):
-        for i, track in enumerate(tracks):
-            items = [formatting.parse(part, track, True)
-                     for part in self.columnformat]
-
-            if self.songinfo().pos == i:
-                weight = [Pango.Weight.BOLD]
-            else:
-                weight = [Pango.Weight.NORMAL]
-
-            self.store.append([track] + items + weight)
-
     @try_keep_position
     def current_update(self, prevstatus_playlist, new_playlist_length):
         if self.connected():
@@ -221,47 +229,20 @@ class Current:
             if not self.update_skip:
                 save_model = self.view.get_model()
                 self.view.set_model(None)
-                if prevstatus_playlist:
-                    changed_songs = self.mpd.plchanges(prevstatus_playlist)
-                else:
-                    changed_songs = self.mpd.plchanges(0)
-
-
-                newlen = int(new_playlist_length)
-                currlen = len(self.store)
-
-                for track in changed_songs:
-                    pos = track.pos
-
-                    items = [formatting.parse(part, track, True)
-                             for part in self.columnformat]
-
-                    if pos < currlen:
-                        # Update attributes for item:
-                        i = self.store.get_iter((pos, ))
-                        if track.id != self.store.get_value(i, 0).id:
-                            self.store.set_value(i, 0, track)
-                        for index in range(len(items)):
-                            if items[index] != self.store.get_value(i, index+1):
-                                self.store.set_value(i, index + 1, items[index])
-                    else:
-                        # Add new item:
-                        self.store.append(
-                            [track] + items + [Pango.Weight.NORMAL])
-
-                if newlen == 0:
-                    self.store.clear()
-                else:
-                    # Remove excess songs:
-                    for i in range(currlen - newlen):
-                        it = self.store.get_iter((currlen - 1 - i,))
-                        self.store.remove(it)
-
+                # Only the positions and ids of the changed songs are
+                # requested, the model gets the songs it displays itself.
+                changes = self.mpd.plchangesposid(prevstatus_playlist or 0)
+                self.store.update(changes or [], int(new_playlist_length))
                 self.view.set_model(save_model)
+                text = self.filterpattern.get_text()
+                if self.filterbox_visible and text and \
+                   self.refilter_handler_id is None:
+                    # The songs matching the filter might have changed
+                    self.searchfilter_apply(text)
             self.update_skip = False
 
-            # Update statusbar time:
-            self.total_time = sum(item[0].time for item in self.store)
+            # Update statusbar time, the rest is updated by on_times_changed:
+            self.total_time = self.store.total_time
 
             if 'pos' in self.songinfo():
                 currsong = self.songinfo().pos
@@ -273,6 +254,10 @@ class Current:
             self.update_statusbar()
             ui.change_cursor(None)
 
+    def on_times_changed(self):
+        self.total_time = self.store.total_time
+        self.update_statusbar()
+
     def header_update_column_indicators(self):
         # If we just sorted a column, display the sorting arrow:
         if self.column_sorted[0]:
@@ -355,16 +340,14 @@ class Current:
     def on_sort_by_dirfile(self, _action):
         self.sort('dirfile')
 
+    def on_sort_by_custom(self, _action):
+        self.sort('custom')
+
     def sort(self, mode, column=None):
         if self.connected():
-            if not self.store:
+            if not self.store or self.sort_request is not None:
                 return
 
-            while Gtk.events_pending():
-                Gtk.main_iteration()
-            songs = []
-            track_num = 0
-
             if mode[0:3] == 'col':
                 col_num = int(mode.replace('col', ''))
                 if column.get_sort_indicator():
@@ -376,98 +359,77 @@ class Current:
                     self.column_sorted = (column, Gtk.SortType.DESCENDING)
                 mode = "col"
 
-            # If the first tag in the format is song length, we will make
-            # sure to compare the same number of items in the song length
-            # string (e.g. always use ##:##:##) and pad the first item to two
-            # (e.g. #:##:## -> ##:##:##)
-            custom_sort = False
             if mode == 'col':
-                custom_sort, custom_pos = self.sort_get_first_format_tag(
-                    self.config.currentformat, col_num, 'L')
-
-            for track in (item[0] for item in self.store):
-                record = {}
-                # Those items that don't have the specified tag will be put at
-                # the end of the list (hence the 'zzzzzzz'):
-                zzz = 'zzzzzzzz'
-                if mode == 'artist':
-                    record["sortby"] = (
-                        misc.lower_no_the(track.artist or zzz),
-                        (track.album or zzz).lower(),
-                        track.disc,
-                        track.track)
-                elif mode == 'album':
-                    record["sortby"] = ((track.album or zzz).lower(),
-                                        track.disc,
-                                        track.track)
-                elif mode == 'file':
-                    record["sortby"] = os.path.basename(track.file or
-                                                        zzz).lower()
-                elif mode == 'dirfile':
-                    record["sortby"] = (track.file or zzz).lower()
-                elif mode == 'col':
-                    # Sort by column:
-                    record["sortby"] = self.store.get_value(
-                        self.store.get_iter((track_num, 0)),
-                        col_num).lower()
-                    if custom_sort:
-                        record["sortby"] = self.sanitize_songlen_for_sorting(
-                            record["sortby"], custom_pos)
-                else:
-                    record["sortby"] = track.get(mode, zzz).lower()
-
-                record["id"] = track.id
-                songs.append(record)
-                track_num = track_num + 1
-
-            songs.sort(key=lambda x: x["sortby"])
-
-            pos = 0
-            self.mpd.command_list_ok_begin()
-            for item in songs:
-                self.mpd.moveid(item["id"], pos)
-                pos += 1
-            self.mpd.command_list_end()
-            self.iterate_now()
-
-            self.header_update_column_indicators()
-
-    def sort_get_first_format_tag(self, format, colnum, tag_letter):
-        # Returns a tuple with whether the first tag of the format
-        # includes tag_letter and the position of the tag in the string:
-        formats = format.split('|')
-        format = formats[colnum-1]
-        prev_letter = None
-        for letter in format:
-            if letter == tag_letter and prev_letter == '%':
-                return (True, pos)
+                fields = sortkeys.column_spec(self.columnformat[col_num - 1])
+            elif mode == 'custom':
+                fields = sortkeys.parse_spec(self.config.currentsort)
             else:
-                break
-            prev_letter = letter
-        return (False, 0)
+                fields = sortkeys.parse_spec(SORT_SPECS.get(mode, mode))
+
+            # Songs are compared on their tags, not on the displayed text
+            key = sortkeys.song_key(fields)
 
-    def sanitize_songlen_for_sorting(self, songlength, pos_of_string):
-        songlength = songlength[pos_of_string:]
-        items = [item.zfill(2) for item in songlength.split(':')]
-        for i in range(3 - len(items)):
-            items.insert(0, "00")
-        return ":".join(item for item in items[:3])
+            def commands(client):
+                status, songs = client.batch([('status',),
+                                              ('playlistinfo',)])
+                return status, playlistsort.sort_commands(songs or [], key)
+            self.sort_start(commands)
 
     def on_sort_reverse(self, _action):
         if self.connected():
-            if not self.store:
+            if not self.store or self.sort_request is not None:
                 return
-            while Gtk.events_pending():
-                Gtk.main_iteration()
-            top = 0
-            bot = len(self.store)-1
-            self.mpd.command_list_ok_begin()
-            while top < bot:
-                self.mpd.swap(top, bot)
-                top = top + 1
-                bot = bot - 1
-            self.mpd.command_list_end()
+
+            def commands(client):
+                status = client.status()
+                length = int((status or {}).get('playlistlength', 0))
+                return status, playlistsort.reverse_commands(length)
+            self.sort_start(commands)
+
+    def sort_start(self, commands):
+        # The playlist is requested, the moves are computed and sent from a
+        # thread using a worker connection: `commands` returns MPD's status
+        # and the moves for the client given. The moves stop if another
+        # client changes the playlist meanwhile. The progress is shown in the
+        # status bar.
+        self.sort_request = request = playlistsort.SortRequest()
+        ui.change_cursor(Gdk.Cursor.new(Gdk.CursorType.WATCH))
+        self.update_statusbar()
+
+        def progress(sent, total):
+            request.sent = sent
+            GLib.idle_add(self.update_statusbar)
+
+        def send():
+            with self.mpd.worker() as client:
+                status, moves = commands(client)
+                request.total = len(moves)
+                if status:
+                    playlistsort.send_commands(
+                        client, moves, progress, lambda: request.cancelled,
+                        version=int(status['playlist']))
+            GLib.idle_add(self.sort_done, request)
+
+        thread = threading.Thread(target=send, name="PlaylistSort")
+        thread.daemon = True
+        thread.start()
+
+    def sort_progress(self):
+        # The number of commands sent by the running sort and their total,
+        # or None
+        request = self.sort_request
+        if request is None:
+            return None
+        return request.sent, request.total
+
+    def sort_done(self, request):
+        if request is self.sort_request:
+            self.sort_request = None
+            ui.change_cursor(None)
             self.iterate_now()
+            self.header_update_column_indicators()
+            self.update_statusbar()
+        return False
 
     def on_dnd_received(self, treeview, drag_context, x, y, selection, _info, timestamp):
         drop_info = treeview.get_dest_row_at_pos(x, y)
@@ -533,17 +495,14 @@ class Current:
         drag_sources = []
         for path in selected:
             index = path[0]
-            treeiter = model.get_iter(path)
-            songid = self.get_songid(treeiter, model)
-            drag_sources.append([index, treeiter, songid])
-
-        # Keep track of the moved iters so we can select them afterwards
-        moved_iters = []
+            songid = model.get_song_id(index)
+            drag_sources.append([index, songid])
 
         # Will manipulate model to prevent the entire playlist from refreshing
         offset = 0
         self.mpd.command_list_ok_begin()
-        for index, treeiter, songid in drag_sources:
+        for source in drag_sources:
+            index, songid = source
             if drop_info:
                 destpath, position = drop_info
                 dest = destpath[0] + offset
@@ -553,35 +512,31 @@ class Current:
                 move_to = dest
                 if position in (Gtk.TreeViewDropPosition.BEFORE,
                                 Gtk.TreeViewDropPosition.INTO_OR_BEFORE):
-                    insert_to = dest
                     if dest < index + 1:
                         pop_from = index + 1
                     else:
                         move_to = dest - 1
                 else:
-                    insert_to = dest + 1
                     if dest < index:
                         pop_from = index + 1
-                        move_to = insert_to
+                        move_to = dest + 1
             else:
                 dest = len(self.store) - 1
-                insert_to = dest + 1
+                move_to = dest
 
             self.mpd.moveid(songid, move_to)
-            moved_iters.append(model.insert(insert_to, tuple(model[index])))
-            model.remove(treeiter)
+            model.move(index, move_to)
 
-            # now fixup
-            for source in drag_sources:
-                if dest < index:
+            # now fixup, the moved rows are kept to select them afterwards
+            for other in drag_sources:
+                if move_to <= other[0] < index:
                     # we moved it back, so all indexes inbetween increased by 1
-                    if dest < source[0] < index:
-                        source[0] += 1
-                else:
+                    other[0] += 1
+                elif index < other[0] <= move_to:
                     # we moved it ahead, so all indexes inbetween
                     # decreased by 1
-                    if index < source[0] < dest:
-                        source[0] -= 1
+                    other[0] -= 1
+            source[0] = move_to
         self.mpd.command_list_end()
 
         # we are manipulating the model manually for speed, so...
@@ -595,11 +550,11 @@ class Current:
 
         selection = treeview.get_selection()
         selection.unselect_all()
-        for i in moved_iters:
-            selection.select_iter(i)
+        for row, _songid in drag_sources:
+            selection.select_path(Gtk.TreePath(row))
 
-        if moved_iters:
-            treeview.scroll_to_cell(model.get_path(moved_iters[0]), None)
+        if drag_sources:
+            treeview.scroll_to_cell(Gtk.TreePath(drag_sources[0][0]), None)
 
     def on_click(self, _treeview, path, _column):
         model = self.view.get_model()
@@ -630,12 +585,8 @@ class Current:
             self.filterpattern.grab_focus()
         self.view.set_headers_clickable(not self.filterbox_visible)
 
-    def model_filter_func(self, model, iter, regex):
-        row = model.get(iter, 1, *range(len(self.columnformat)- 1)[1:])
-        for cell in row:
-            if regex.match(cell.lower()):
-                return True
-        return False
+    def model_filter_func(self, model, iter, song_ids):
+        return model.get_iter_song_id(iter) in song_ids
 
     def searchfilter_on_enter(self, _entry):
         model, selected = self.view.get_selection().get_selected_rows()
@@ -664,20 +615,28 @@ class Current:
             self.view.set_model(self.store)
             return
 
-        regex = misc.escape_html(text)
-        regex = re.escape(regex)
-        regex = '.*' + regex.replace(' ', ' .*').lower()
-        filter_regex = re.compile(regex)
-
-        def set_filtering_function(regex):
-            # Creates a Gtk.TreeModelFilter
-            filter_model = self.store.filter_new()
-            filter_model.set_visible_func(self.model_filter_func, regex)
-            self.view.set_model(filter_model)
-
         # Delay slightly the new search, in case something else is coming.
         self.refilter_handler_id = GLib.timeout_add(
-            250, set_filtering_function, filter_regex)
+            250, self.searchfilter_apply, text)
+
+    def searchfilter_apply(self, text):
+        self.refilter_handler_id = None
+        # The model searches its own index of the formatted columns, the
+        # filter only has to look the songs up in the result. The songs
+        # might have to be requested first: the filter is applied then.
+        self.store.search(text, lambda song_ids:
+                          self.searchfilter_show(text, song_ids))
+        return False
+
+    def searchfilter_show(self, text, song_ids):
+        if not self.filterbox_visible or \
+           self.filterpattern.get_text() != text:
+            # The filter changed while the songs were requested
+            return
+        # Creates a Gtk.TreeModelFilter
+        filter_model = self.store.filter_new()
+        filter_model.set_visible_func(self.model_filter_func, song_ids)
+        self.view.set_model(filter_model)
 
     def filter_key_pressed(self, widget, event, treeview):
         if event.keyval == Gdk.keyval_from_name('Down') or \
@@ -691,19 +650,12 @@ class Current:
 
     def boldrow(self, row):
         if row > -1:
-            try:
-                self.store[row][-1] = Pango.Weight.BOLD
-            except IndexError:
-                # The row might not exist anymore
-                pass
+            # The row might not exist anymore, the model ignores it then
+            self.store.set_bold_row(row)
 
     def unbold_boldrow(self, row):
-        if row > -1:
-            try:
-                self.store[row][-1] = Pango.Weight.NORMAL
-            except IndexError:
-                # The row might not exist anymore
-                pass
+        if row > -1 and self.store.bold_row == row:
+            self.store.set_bold_row(-1)
 
     def on_remove(self):
         model, selected = self.selection.get_selected_rows()
@@ -713,12 +665,17 @@ class Current:
         elif len(selected) > 0:
             # we are manipulating the model manually for speed, so...
             self.update_skip = True
+            iters = [model.get_iter(path) for path in reversed(selected)]
+            if model != self.store:
+                # model is different if there is a filter currently applied.
+                # So we retrieve the iters of the wrapped model...
+                iters = [model.convert_iter_to_child_iter(i) for i in iters]
+            # The ids are known without requesting the songs, which couldn't
+            # be done in the command list
+            song_ids = [self.store.get_iter_song_id(i) for i in iters]
             self.mpd.command_list_ok_begin()
-            for i in (model.get_iter(path) for path in reversed(selected)):
-                self.mpd.deleteid(model.get(i, 0)[0].id)
-                if model != self.store:
-                    # model is different if there is a filter currently applied.
-                    # So we retrieve the iter of the wrapped model...
-                    i = model.convert_iter_to_child_iter(i)
-                self.store.remove(i)
+            for song_id in song_ids:
+                self.mpd.deleteid(song_id)
             self.mpd.command_list_end()
+            for i in iters:
+                self.store.remove(i)
@@ -8,9 +8,15 @@ colnames = formatting.parse_colnames(self.config.currentformat)
 newtitle = formatting.parse(self.config.titleformat, self.songinfo,
                             False, True)
 ...
+libraryformat = formatting.compile_format(self.config.libraryformat)
+names = libraryformat.render_many(songs, True)
+...
+rows = formatting.render_columns(self.columnformat, songs, True)
+...
 formatcodes = formatting.formatcodes
 """
 
+import functools
 import re
 import os
 
@@ -34,7 +40,16 @@ class FormatCode:
 
     def format(self, item, wintitle, songpos):
         """Returns the value used in place of the format code"""
-        return str(item.get(self.key, self.default))
+        values = mpdh.get_values(item, self.key)
+        if not values:
+            return str(self.default)
+        # Tags present several times (eg. several artists) show all their
+        # values
+        return ", ".join(str(value) for value in values)
+
+    def cache_key(self, item):
+        """Returns what the value depends on, to reuse it for other songs"""
+        return mpdh.get_values(item, self.key)
 
 
 class NumFormatCode(FormatCode):
@@ -77,6 +92,9 @@ class TitleFormatCode(FormatCode):
         self.default = misc.escape_html(self.default)
         return FormatCode.format(self, item, wintitle, songpos)
 
+    def cache_key(self, item):
+        return FormatCode.cache_key(self, item), item['file']
+
 
 class LenFormatCode(FormatCode):
     """Implements format code behavior for song length."""
@@ -152,29 +170,110 @@ def parse_colnames(format):
     return cols
 
 
-class EmptyBrackets(Exception):
-    pass
+class CompiledFormat:
+    """A format string, parsed once to be applied to many songs.
 
+    The format is kept as a list of groups, each being a list of literal
+    strings and FormatCodes. The groups between brackets are left empty if
+    one of their format codes has no value.
+    """
 
-def _format_substrings(text, item, wintitle, songpos):
-    has_brackets = text.startswith("{") and text.endswith("}")
-
-    def formatter(m):
-        format_code = replace_map[m.group(0)[1:]]
-        if has_brackets and format_code.key not in item:
-            raise EmptyBrackets
-        return format_code.format(item, wintitle, songpos)
-
-    try:
-        text = re.sub(replace_expr, formatter, text)
-    except EmptyBrackets:
-        return ""
-
-    return text[1:-1] if has_brackets else text
+    def __init__(self, format):
+        self.format = format
+        # (whether the group is between brackets, its parts)
+        self._groups = []
+        for text in _return_substrings(format):
+            has_brackets = text.startswith("{") and text.endswith("}")
+            if has_brackets:
+                text = text[1:-1]
+            parts = []
+            for i, part in enumerate(re.split("(%s)" % replace_expr, text)):
+                if i % 2:
+                    parts.append(replace_map[part[1:]])
+                elif part:
+                    parts.append(part)
+            has_codes = any(isinstance(part, FormatCode) for part in parts)
+            if self._groups and not self._groups[-1][0] and \
+               not (has_brackets and has_codes):
+                # Always displayed: merge with the previous group
+                self._groups[-1][1].extend(parts)
+            else:
+                self._groups.append((has_brackets and has_codes, parts))
+
+    def render(self, item, use_escape_html, wintitle=False, songpos=None):
+        """Return the format applied to `item`, like parse()."""
+        text = []
+        for has_brackets, parts in self._groups:
+            group = []
+            for part in parts:
+                if part.__class__ is str:
+                    group.append(part)
+                elif has_brackets and part.key not in item:
+                    group = []
+                    break
+                else:
+                    group.append(part.format(item, wintitle, songpos))
+            text.extend(group)
+        text = "".join(text)
+        return misc.escape_html(text) if use_escape_html else text
+
+    def render_many(self, items, use_escape_html, wintitle=False,
+                    songpos=None):
+        """Return the list of the format applied to each of `items`."""
+        return self._render_many(items, use_escape_html, wintitle, songpos,
+                                 {})
+
+    def _render_many(self, items, use_escape_html, wintitle, songpos, cache):
+        # The values of the format codes are computed (and escaped) once
+        # for each distinct tag value, and kept in `cache`: format code ->
+        # {cache key: value}. Escaping the parts separately gives the same
+        # result as escaping the whole text.
+        escape = misc.escape_html if use_escape_html else str
+        groups = [(has_brackets,
+                   [escape(part) if part.__class__ is str else
+                    (part, part.key, part.cache_key, cache.setdefault(part, {}))
+                    for part in parts])
+                  for has_brackets, parts in self._groups]
+        results = []
+        for item in items:
+            text = []
+            for has_brackets, parts in groups:
+                start = len(text)
+                for part in parts:
+                    if part.__class__ is str:
+                        text.append(part)
+                        continue
+                    code, key, cache_key, values = part
+                    if has_brackets and key not in item:
+                        del text[start:]
+                        break
+                    value_key = cache_key(item)
+                    value = values.get(value_key)
+                    if value is None:
+                        value = escape(code.format(item, wintitle, songpos))
+                        values[value_key] = value
+                    text.append(value)
+            results.append("".join(text))
+        return results
+
+
+def render_columns(formats, items, use_escape_html):
+    """Apply each of `formats` to each of `items`, and return the list of
+    the values of each item, like [[parse(format, item, use_escape_html)
+    for format in formats] for item in items]."""
+    cache = {}
+    columns = [compile_format(format)._render_many(items, use_escape_html,
+                                                   False, None, cache)
+               for format in formats]
+    return [list(row) for row in zip(*columns)]
+
+
+@functools.lru_cache(maxsize=64)
+def compile_format(format):
+    """Return the CompiledFormat of `format`, reused for the same format."""
+    return CompiledFormat(format)
 
 
 def parse(format, item, use_escape_html, wintitle=False, songpos=None):
-    substrings = _return_substrings(format)
-    text = "".join(_format_substrings(sub, item, wintitle, songpos)
-            for sub in substrings)
-    return misc.escape_html(text) if use_escape_html else text
+    return compile_format(format).render(item, use_escape_html, wintitle,
+                                         songpos)
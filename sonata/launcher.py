@@ -25,8 +25,8 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import sys
-if sys.version_info <= (3, 2):
-    sys.stderr.write("Sonata requires Python 3.2+\n")
+if sys.version_info < (3, 5):
+    sys.stderr.write("Sonata requires Python 3.5+\n")
     sys.exit(1)
 
 import gettext
@@ -151,6 +151,10 @@ def run():
     from socket import setdefaulttimeout as socketsettimeout
     socketsettimeout(5)
 
+    # The locale has been set by GTK
+    from sonata import misc
+    misc.collation_reset()
+
     if not args.skip_gui:
         Gdk.threads_init()
 
@@ -1,18 +1,26 @@
 import os
 import re
 import gettext
-import locale
 import threading # libsearchfilter_toggle starts thread libsearchfilter_loop
 import operator
+import queue
 
 from gi.repository import Gtk, Gdk, GdkPixbuf, GObject, GLib, Pango
 
-from sonata import ui, misc, consts, formatting, breadcrumbs, mpdhelper as mpdh
+from sonata import ui, misc, consts, formatting, breadcrumbs, libraryindex
+from sonata import sortkeys
+from sonata import mpdhelper as mpdh
 from sonata.artwork import get_multicd_album_root_dir
 from sonata.song import SongRecord
 
 
 VARIOUS_ARTISTS = _("Various Artists")
+# Number of search results sent at once to the view
+SEARCH_CHUNK_SIZE = 500
+# Order of the songs of an album (see sortkeys)
+SONG_SORT_FIELDS = ('disc', 'track', 'title')
+# Delay before looking for the covers of the rows shown after a scroll, in ms
+ARTWORK_SCROLL_DELAY = 150
 
 
 def list_mark_various_artists_albums(albums):
@@ -44,6 +52,22 @@ def list_mark_various_artists_albums(albums):
     return albums
 
 
+class LibrarySearch:
+    """A search typed in the library search entry.
+
+    The searches are run by a thread, and cancelled when a new one is typed:
+    their remaining work and results are then dropped.
+    """
+
+    def __init__(self, searchby, text):
+        self.searchby = searchby
+        self.text = text
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
 class Library:
     def __init__(self, config, mpd, artwork, TAB_LIBRARY, settings_save,
                  filter_key_pressed, on_add_item, connected,
@@ -64,9 +88,10 @@ class Library:
         self.search_terms_mpd = ['artist', 'title', 'album', 'genre', 'file',
                                  'any']
 
-        self.libfilterbox_cmd_buf = None
-        self.libfilterbox_cond = None
+        self.libsearch_queue = None
+        self.libsearch = None
         self.libfilterbox_source = None
+        self.lib_art_source = None
 
         self.prevlibtodo_base = None
         self.prevlibtodo_base_results = None
@@ -79,10 +104,14 @@ class Library:
         self.lib_view_artist_cache = None
         self.lib_view_genre_cache = None
         self.lib_view_album_cache = None
-        self.lib_list_genres = None
-        self.lib_list_artists = None
-        self.lib_list_albums = None
-        self.lib_list_years = None
+        self.lib_index = None
+        self.lib_index_key = None
+        self.lib_index_outdated = True
+        self.lib_index_generation = 0
+        self.lib_index_rebuilding = False
+        self.lib_index_patching = False
+        self.lib_index_patch_again = False
+        self.lib_updated_dirs = set()
         self.view_caches_reset()
 
         # Library tab
@@ -151,6 +180,8 @@ class Library:
         self.library.connect('key-press-event', self.on_library_key_press)
         self.library.connect('query-tooltip', self.on_library_query_tooltip)
         expanderwindow2.connect('scroll-event', self.on_library_scrolled)
+        expanderwindow2.get_vadjustment().connect('value-changed',
+                                                  self.on_library_scrolled)
         self.libraryview.connect('clicked', self.library_view_popup)
         self.searchtext.connect('key-press-event',
                                 self.libsearchfilter_key_pressed)
@@ -243,25 +274,187 @@ class Library:
 
     def view_caches_reset(self):
         # We should call this on first load and whenever mpd is
-        # updated.
+        # updated. The index is kept, as it can still be used while a new
+        # one is built.
+        self.view_caches_clear()
+        self.lib_index_outdated = True
+        self.lib_index_generation += 1
+
+    def view_caches_clear(self):
         self.lib_view_filesystem_cache = None
         self.lib_view_artist_cache = None
         self.lib_view_genre_cache = None
         self.lib_view_album_cache = None
-        self.lib_list_genres = None
-        self.lib_list_artists = None
-        self.lib_list_albums = None
-        self.lib_list_years = None
 
-    def on_library_scrolled(self, _widget, _event):
+    def view_caches_updating(self, dirs):
+        # Remembers the directories MPD is updating on our request, so that
+        # only them are read again once the update is done.
+        self.lib_updated_dirs.update(dirs)
+
+    def view_caches_update_done(self):
+        # Called when MPD isn't updating its database anymore: if nothing
+        # changed, no database change follows to read the directories.
+        self.lib_updated_dirs = set()
+
+    def view_caches_update(self):
+        # Called when MPD's database changed. If we know which directories
+        # were updated, only their songs are read again, and only the rows of
+        # the affected genres, artists and albums are rebuilt. Otherwise, the
+        # whole library has to be read again.
+        if self.lib_index_patching:
+            # The directories are read once the current update is done
+            self.lib_index_patch_again = True
+            return
+        dirs = self.lib_updated_dirs
+        self.lib_updated_dirs = set()
+        index = self.lib_index
+        if not dirs or dirs & {'', '/'} or index is None or \
+           self.lib_index_outdated or self.lib_index_rebuilding:
+            self.view_caches_reset()
+            return
+
+        # Subdirectories are already read with their parents
+        dirs = [directory for directory in sorted(dirs)
+                if not any(directory.startswith(parent + '/')
+                           for parent in dirs)]
+        generation = self.lib_index_generation
+
+        def update():
+            # The songs are read with a worker connection, and a copy of the
+            # index is patched: the current one may be searched meanwhile.
+            patched, key, affected = None, None, None
+            try:
+                with self.mpd.worker() as client:
+                    stats = client.stats() or {}
+                    # A directory which doesn't exist anymore has no songs,
+                    # other failures need the whole library to be read
+                    results = client.batch([('listallinfo', directory)
+                                            for directory in dirs],
+                                           missing=[])
+                key = {'host': client.host, 'port': client.port,
+                       'db_update': stats.get('db_update')}
+                if key['db_update'] is not None and None not in results:
+                    patched, affected = self.library_index_patch(
+                        index, dirs, results)
+                    # Songs changed elsewhere (eg. by another client)
+                    if str(len(patched)) != stats.get('songs'):
+                        patched = None
+            finally:
+                GLib.idle_add(self.view_caches_patched, patched, key,
+                              affected, generation)
+
+        self.lib_index_patching = True
+        thread = threading.Thread(target=update, name="LibraryIndexUpdate")
+        thread.daemon = True
+        thread.start()
+
+    def library_index_patch(self, index, dirs, results):
+        # Returns a copy of the index with the songs of `dirs` replaced by
+        # the ones of `results`, and the values of the changed songs
+        index = index.copy()
+        removed = index.select_dirs(dirs)
+        affected = self.library_index_values(index, removed)
+        index.remove_songs(removed)
+        first = len(index)
+        for items in results:
+            index.add_songs(items)
+        added = self.library_index_values(index, range(first, len(index)))
+        for tag in affected:
+            affected[tag].update(added[tag])
+        return index, affected
+
+    def view_caches_patched(self, index, key, affected, generation):
+        self.lib_index_patching = False
+        if generation != self.lib_index_generation:
+            # The whole library is read again anyway
+            pass
+        elif index is None or not self.library_index_same_server(
+                key, {'host': self.mpd.host, 'port': self.mpd.port}):
+            self.view_caches_reset()
+            if self.connected() and not self.search_visible():
+                self.library_browse(root=self.config.wd)
+        else:
+            self.lib_index = index
+            self.lib_index_key = key
+            self.library_index_save(index, key)
+            self.view_caches_patch(index, affected)
+            if self.connected() and not self.search_visible():
+                self.library_browse(root=self.config.wd)
+        if self.lib_index_patch_again:
+            self.lib_index_patch_again = False
+            self.view_caches_update()
+        return False
+
+    def library_index_save(self, index, key):
+        # Saved from a thread: an index isn't changed anymore once used
+        path = libraryindex.cache_path(key['host'], key['port'])
+        thread = threading.Thread(target=index.save, args=(path, key),
+                                  name="LibraryIndexSave")
+        thread.daemon = True
+        thread.start()
+
+    def library_index_values(self, index, ids):
+        # Lowercased genres, artists and albums (all of them, for tags
+        # present several times) of the songs `ids`, missing tags being
+        # reported as NOTAG.
+        ids = list(ids)
+        values = {}
+        for tag in ('genre', 'artist', 'album'):
+            values[tag] = set(value.lower()
+                              for value in index.values(tag, ids))
+            if any(not value for value, in index.rows(tag, ids=ids)):
+                values[tag].add(self.NOTAG.lower())
+        return values
+
+    def view_caches_patch(self, index, affected):
+        # Replaces the rows of the affected items in the toplevel views
+        self.lib_view_filesystem_cache = None
+
+        def spellings(tag):
+            values = tuple(affected[tag])
+            return index.values(tag, index.select(**{tag: values}))
+
+        def patch(bd, tag, rows):
+            bd = [row for row in bd
+                  if getattr(row[1][1], tag).lower() not in affected[tag]]
+            bd += rows
+            bd.sort(key=lambda key: misc.collation_key(key[0]))
+            return bd
+
+        notag = self.NOTAG.lower()
+        if self.lib_view_genre_cache is not None:
+            items = spellings('genre')
+            if notag in affected['genre'] and self.NOTAG not in items:
+                items.append(self.NOTAG)
+            self.lib_view_genre_cache = patch(
+                self.lib_view_genre_cache, 'genre',
+                self.library_populate_tag_rows('genre', items))
+        if self.lib_view_artist_cache is not None:
+            items = spellings('artist')
+            if notag in affected['artist'] and self.NOTAG not in items:
+                items.append(self.NOTAG)
+            self.lib_view_artist_cache = patch(
+                self.lib_view_artist_cache, 'artist',
+                self.library_populate_tag_rows('artist', items))
+        if self.lib_view_album_cache is not None:
+            ids = index.select(album=tuple(spellings('album')))
+            self.lib_view_album_cache = patch(
+                self.lib_view_album_cache, 'album',
+                self.library_populate_album_rows(ids,
+                                                 notag in affected['album']))
+
+    def on_library_scrolled(self, *_args):
+        # Only look for the covers once the scrolling stopped for a while,
+        # when we can get the visible state of the treeview
         try:
-            # Use GLib.idle_add so that we can get the visible
-            # state of the treeview
-            GLib.idle_add(self._on_library_scrolled)
-        except:
+            GLib.source_remove(self.lib_art_source)
+        except TypeError:
             pass
+        self.lib_art_source = GLib.timeout_add(ARTWORK_SCROLL_DELAY,
+                                               self._on_library_scrolled)
 
     def _on_library_scrolled(self):
+        self.lib_art_source = None
         if not self.config.show_covers:
             return
 
@@ -344,6 +537,7 @@ class Library:
         self.library.freeze_child_notify()
         self.library.set_model(None)
         self.librarydata.clear()
+        self.artwork.library_artwork_reset()
 
         # Populate treeview with data:
         bd = []
@@ -398,6 +592,7 @@ class Library:
         # Scroll back to set view for current dir:
         self.library.realize()
         GLib.idle_add(self.library_set_view, not path_updated)
+        self.on_library_scrolled()
         if len(prev_selection) > 0 or prev_selection_root or \
            prev_selection_parent:
             # Retain pre-update selection:
@@ -513,6 +708,8 @@ class Library:
             # Use cache if possible...
             bd = self.lib_view_filesystem_cache
         else:
+            libraryformat = formatting.compile_format(
+                self.config.libraryformat)
             for item in self.mpd.lsinfo(path):
                 if 'directory' in item:
                     name = os.path.basename(item['directory'])
@@ -523,8 +720,7 @@ class Library:
                     data = SongRecord(path=item['file'])
                     bd += [('f' + item['file'].lower(),
                             [self.sonatapb, data,
-                             formatting.parse(self.config.libraryformat, item,
-                                              True)])]
+                             libraryformat.render(item, True)])]
             bd.sort(key=operator.itemgetter(0))
         return bd
 
@@ -556,73 +752,17 @@ class Library:
         if bd is not None:
             # We have our cached data, woot.
             return bd
-        bd = []
         if genreview or artistview:
             # Only for artist/genre views, album view is handled differently
             # since multiple artists can have the same album name
-            if genreview:
-                items = self.library_return_list_items('genre')
-                pb = self.genrepb
-            else:
-                items = self.library_return_list_items('artist')
-                pb = self.artistpb
+            tag = 'genre' if genreview else 'artist'
+            items = self.library_return_list_items(tag)
             if not (self.NOTAG in items):
                 items.append(self.NOTAG)
-            for item in items:
-                if genreview:
-                    playtime, num_songs = self.library_return_count(genre=item)
-                    data = SongRecord(genre=item)
-                else:
-                    playtime, num_songs = self.library_return_count(
-                        artist=item)
-                    data = SongRecord(artist=item)
-                if num_songs > 0:
-                    display = misc.escape_html(item)
-                    display += self.add_display_info(num_songs, playtime)
-                    bd += [(misc.lower_no_the(item), [pb, data, display])]
+            bd = self.library_populate_tag_rows(tag, items)
         elif albumview:
-            albums = []
-            untagged_found = False
-            for item in self.mpd.listallinfo('/'):
-                if 'file' in item and 'album' in item:
-                    album = item['album']
-                    artist = item.get('artist', self.NOTAG)
-                    year = item.get('date', self.NOTAG)
-                    path = get_multicd_album_root_dir(
-                        os.path.dirname(item['file']))
-                    data = SongRecord(album=album, artist=artist,
-                                      year=year, path=path)
-                    albums.append(data)
-                    if album == self.NOTAG:
-                        untagged_found = True
-            if not untagged_found:
-                albums.append(SongRecord(album=self.NOTAG))
-            albums = misc.remove_list_duplicates(albums, case=False)
-            albums = list_mark_various_artists_albums(albums)
-            for item in albums:
-                album, artist, _genre, year, path = item
-                playtime, num_songs = self.library_return_count(artist=artist,
-                                                                album=album,
-                                                                year=year)
-                if num_songs > 0:
-                    data = SongRecord(artist=artist, album=album,
-                                           year=year, path=path)
-                    display = misc.escape_html(album)
-                    if artist and year and len(artist) > 0 and len(year) > 0 \
-                       and artist != self.NOTAG and year != self.NOTAG:
-                        display += " <span weight='light'>(%s, %s)</span>" \
-                                % (misc.escape_html(artist),
-                                   misc.escape_html(year))
-                    elif artist and len(artist) > 0 and artist != self.NOTAG:
-                        display += " <span weight='light'>(%s)</span>" \
-                                % misc.escape_html(artist)
-                    elif year and len(year) > 0 and year != self.NOTAG:
-                        display += " <span weight='light'>(%s)</span>" \
-                                % misc.escape_html(year)
-                    display += self.add_display_info(num_songs, playtime)
-                    bd += [(misc.lower_no_the(album), [self.albumpb, data,
-                                                       display])]
-        bd.sort(key=lambda key: locale.strxfrm(key[0]))
+            bd = self.library_populate_album_rows(None, True)
+        bd.sort(key=lambda key: misc.collation_key(key[0]))
         if genreview:
             self.lib_view_genre_cache = bd
         elif artistview:
@@ -631,6 +771,68 @@ class Library:
             self.lib_view_album_cache = bd
         return bd
 
+    def library_populate_tag_rows(self, tag, items):
+        # Rows of the genre or artist view, for the given items
+        pb = self.genrepb if tag == 'genre' else self.artistpb
+        counts = self.library_return_counts([{tag: item} for item in items])
+        bd = []
+        for item, (playtime, num_songs) in zip(items, counts):
+            if num_songs > 0:
+                data = SongRecord(**{tag: item})
+                display = misc.escape_html(item)
+                display += self.add_display_info(num_songs, playtime)
+                bd += [(misc.lower_no_the(item), [pb, data, display])]
+        return bd
+
+    def library_populate_album_rows(self, ids, untagged):
+        # Rows of the album view, for the albums of the songs `ids` (None
+        # meaning all the songs). If `untagged` is True, a row for the songs
+        # without album is added.
+        albums = []
+        untagged_found = False
+        index = self.library_get_index()
+        for album, artist, year, filename in index.rows('album', 'artist',
+                                                        'date', 'file',
+                                                        ids=ids):
+            if album:
+                artist = artist or self.NOTAG
+                year = year or self.NOTAG
+                path = get_multicd_album_root_dir(os.path.dirname(filename))
+                data = SongRecord(album=album, artist=artist,
+                                  year=year, path=path)
+                albums.append(data)
+                if album == self.NOTAG:
+                    untagged_found = True
+        if untagged and not untagged_found:
+            albums.append(SongRecord(album=self.NOTAG))
+        albums = misc.remove_list_duplicates(albums, case=False)
+        albums = list_mark_various_artists_albums(albums)
+        counts = self.library_return_counts(
+            [{'artist': item.artist, 'album': item.album,
+              'year': item.year} for item in albums])
+        bd = []
+        for item, (playtime, num_songs) in zip(albums, counts):
+            album, artist, _genre, year, path = item
+            if num_songs > 0:
+                data = SongRecord(artist=artist, album=album,
+                                       year=year, path=path)
+                display = misc.escape_html(album)
+                if artist and year and len(artist) > 0 and len(year) > 0 \
+                   and artist != self.NOTAG and year != self.NOTAG:
+                    display += " <span weight='light'>(%s, %s)</span>" \
+                            % (misc.escape_html(artist),
+                               misc.escape_html(year))
+                elif artist and len(artist) > 0 and artist != self.NOTAG:
+                    display += " <span weight='light'>(%s)</span>" \
+                            % misc.escape_html(artist)
+                elif year and len(year) > 0 and year != self.NOTAG:
+                    display += " <span weight='light'>(%s)</span>" \
+                            % misc.escape_html(year)
+                display += self.add_display_info(num_songs, playtime)
+                bd += [(misc.lower_no_the(album), [self.albumpb, data,
+                                                   display])]
+        return bd
+
 
     def library_populate_data(self, genre=None, artist=None, album=None,
                               year=None):
@@ -642,9 +844,9 @@ class Library:
             if len(artists) > 0:
                 if not self.NOTAG in artists:
                     artists.append(self.NOTAG)
-                for artist in artists:
-                    playtime, num_songs = self.library_return_count(
-                        genre=genre, artist=artist)
+                counts = self.library_return_counts(
+                    [{'genre': genre, 'artist': artist} for artist in artists])
+                for artist, (playtime, num_songs) in zip(artists, counts):
                     if num_songs > 0:
                         display = misc.escape_html(artist)
                         display += self.add_display_info(num_songs, playtime)
@@ -659,61 +861,47 @@ class Library:
                                                         artist=artist)
             else:
                 albums = self.library_return_list_items('album', artist=artist)
+            album_years = []
             for album in albums:
-                if genre is not None:
-                    years = self.library_return_list_items('date', genre=genre,
-                                                           artist=artist,
-                                                           album=album)
-                else:
-                    years = self.library_return_list_items('date',
-                                                           artist=artist,
-                                                           album=album)
+                years = self.library_return_list_items('date', genre=genre,
+                                                       artist=artist,
+                                                       album=album)
                 if not self.NOTAG in years:
                     years.append(self.NOTAG)
-                for year in years:
-                    if genre is not None:
-                        playtime, num_songs = self.library_return_count(
-                            genre=genre, artist=artist, album=album, year=year)
-                        if num_songs > 0:
-                            files = self.library_return_list_items(
-                                'file', genre=genre, artist=artist,
-                                album=album, year=year)
-                            path = os.path.dirname(files[0])
-                            data = SongRecord(genre=genre, artist=artist,
-                                              album=album, year=year, path=path)
-                    else:
-                        playtime, num_songs = self.library_return_count(
-                            artist=artist, album=album, year=year)
-                        if num_songs > 0:
-                            files = self.library_return_list_items(
-                                'file', artist=artist, album=album, year=year)
-                            path = os.path.dirname(files[0])
-                        cache_data = SongRecord(artist=artist, album=album,
-                                                path=path)
-                        data = SongRecord(artist=artist, album=album,
-                                          year=year, path=path)
-                    if num_songs > 0:
-                        cache_data = SongRecord(artist=artist, album=album, path=path)
-                        display = misc.escape_html(album)
-                        if year and len(year) > 0 and year != self.NOTAG:
-                            display += " <span weight='light'>(%s)</span>" \
-                                    % misc.escape_html(year)
-                        display += self.add_display_info(num_songs, playtime)
-                        ordered_year = year
-                        if ordered_year == self.NOTAG:
-                            ordered_year = '9999'
-                        pb = self.artwork.cache.get_pixbuf(
-                            cache_data, consts.LIB_COVER_SIZE,
-                            self.albumpb)
-                        bd += [(ordered_year + misc.lower_no_the(album),
-                                [pb, data, display])]
+                album_years.extend((album, year) for year in years)
+            counts = self.library_return_counts(
+                [{'genre': genre, 'artist': artist, 'album': album,
+                  'year': year} for album, year in album_years])
+            for (album, year), (playtime, num_songs) in zip(album_years,
+                                                            counts):
+                if num_songs > 0:
+                    files = self.library_return_list_items(
+                        'file', genre=genre, artist=artist, album=album,
+                        year=year)
+                    path = os.path.dirname(files[0])
+                    data = SongRecord(genre=genre, artist=artist,
+                                      album=album, year=year, path=path)
+                    cache_data = SongRecord(artist=artist, album=album, path=path)
+                    display = misc.escape_html(album)
+                    if year and len(year) > 0 and year != self.NOTAG:
+                        display += " <span weight='light'>(%s)</span>" \
+                                % misc.escape_html(year)
+                    display += self.add_display_info(num_songs, playtime)
+                    ordered_year = year
+                    if ordered_year == self.NOTAG:
+                        ordered_year = '9999'
+                    pb = self.artwork.cache.get_pixbuf(
+                        cache_data, consts.LIB_COVER_SIZE,
+                        self.albumpb)
+                    bd += [(ordered_year + misc.lower_no_the(album),
+                            [pb, data, display])]
             # Now, songs not in albums:
             bd += self.library_populate_data_songs(genre, artist, self.NOTAG,
                                                    None)
         else:
             # Songs within an album, artist, year, and possibly genre
             bd += self.library_populate_data_songs(genre, artist, album, year)
-        bd.sort(key=lambda key: locale.strxfrm(key[0]))
+        bd.sort(key=lambda key: misc.collation_key(key[0]))
         return bd
 
     def library_populate_data_songs(self, genre, artist, album, year):
@@ -725,196 +913,160 @@ class Library:
         else:
             songs, _playtime, _num_songs = self.library_return_search_items(
                 artist=artist, album=album, year=year)
-        for song in songs:
+        # The songs are sorted on their tags, and keep this order among the
+        # other rows
+        songs = sortkeys.sort_songs(songs, SONG_SORT_FIELDS)
+        libraryformat = formatting.compile_format(self.config.libraryformat)
+        for i, (song, name) in enumerate(zip(
+                songs, libraryformat.render_many(songs, True))):
             data = SongRecord(path=song.file)
-            track = str(song.get('track', 99)).zfill(2)
-            disc = str(song.get('disc', 99)).zfill(2)
-            try:
-                bd += [('f' + disc + track + misc.lower_no_the(song.title),
-                        [self.sonatapb, data, formatting.parse(
-                            self.config.libraryformat, song, True)])]
-            except:
-                bd += [('f' + disc + track + song.file.lower(),
-                        [self.sonatapb, data,
-                         formatting.parse(self.config.libraryformat, song,
-                                          True)])]
+            bd += [('f%08d' % i, [self.sonatapb, data, name])]
         return bd
 
+    def library_get_index(self):
+        # The index of the whole database is saved on disk, and loaded back
+        # if MPD's database didn't change since. Otherwise, the previous
+        # index is still used while a new one is built in the background: we
+        # only wait for MPD if we have nothing to show. Views ask for the
+        # index many times, so MPD isn't asked again while it is rebuilt.
+        if self.lib_index is not None and not self.lib_index_outdated:
+            return self.lib_index
+        if self.lib_index is not None and self.lib_index_rebuilding and \
+           self.library_index_same_server(
+               self.lib_index_key,
+               {'host': self.mpd.host, 'port': self.mpd.port}):
+            return self.lib_index
+
+        key = self.library_index_key()
+        path = libraryindex.cache_path(key['host'], key['port'])
+        if not self.library_index_same_server(self.lib_index_key, key):
+            self.lib_index = None
+        if self.lib_index is None:
+            LibraryIndex = libraryindex.LibraryIndex
+            self.lib_index_key, self.lib_index = LibraryIndex.load(path)
+            if not self.library_index_same_server(self.lib_index_key, key):
+                self.lib_index = None
+            elif self.lib_index is not None:
+                self.library_index_collation_keys(self.lib_index)
+
+        if self.lib_index is not None and key['db_update'] is not None and \
+           self.lib_index_key == key:
+            self.lib_index_outdated = False
+        elif self.lib_index is None:
+            index = self.library_index_build(self.mpd, key, path)
+            if index is None:
+                return libraryindex.LibraryIndex()
+            self.lib_index = index
+            self.lib_index_key = key
+            self.lib_index_outdated = False
+        elif not self.lib_index_rebuilding:
+            self.library_index_rebuild(key, path)
+        return self.lib_index
+
+    def library_index_key(self):
+        # Identifies the content of the database: MPD changes 'db_update'
+        # each time the database is updated.
+        stats = self.mpd.stats() or {}
+        return {'host': self.mpd.host, 'port': self.mpd.port,
+                'db_update': stats.get('db_update')}
+
+    def library_index_same_server(self, key1, key2):
+        return key1 is not None and key2 is not None and \
+                key1['host'] == key2['host'] and key1['port'] == key2['port']
+
+    def library_index_build(self, mpd, key, path):
+        # Returns None if the database couldn't be retrieved
+        items = mpd.listallinfo('/')
+        if items is None:
+            return None
+        index = libraryindex.LibraryIndex()
+        index.add_songs(items)
+        if key['db_update'] is not None:
+            index.save(path, key)
+        self.library_index_collation_keys(index)
+        return index
+
+    def library_index_collation_keys(self, index):
+        # Computes the collation keys of the values sorted in the views once,
+        # so that building the views only needs cache lookups
+        ids = range(len(index))
+        for tag in ('genre', 'artist', 'album', 'date'):
+            for value in index.values(tag, ids):
+                misc.collation_key(value)
+                misc.collation_key(misc.lower_no_the(value))
+
+    def library_index_rebuild(self, key, path):
+        # Builds the new index in a thread, using a worker connection so that
+        # the UI can keep on talking to MPD.
+        generation = self.lib_index_generation
+
+        def rebuild():
+            with self.mpd.worker() as client:
+                index = self.library_index_build(client, key, path)
+            GLib.idle_add(self.library_index_rebuilt, index, key, generation)
+
+        self.lib_index_rebuilding = True
+        thread = threading.Thread(target=rebuild, name="LibraryIndex")
+        thread.daemon = True
+        thread.start()
+
+    def library_index_rebuilt(self, index, key, generation):
+        self.lib_index_rebuilding = False
+        if index is None or not self.library_index_same_server(
+                key, {'host': self.mpd.host, 'port': self.mpd.port}):
+            return False
+        self.lib_index = index
+        self.lib_index_key = key
+        # The database may have changed again while we were building
+        self.lib_index_outdated = generation != self.lib_index_generation
+        self.view_caches_clear()
+        if self.connected() and not self.search_visible():
+            self.library_browse(root=self.config.wd)
+        return False
+
+    def library_select(self, genre=None, artist=None, album=None, year=None):
+        # Returns the ids in the library index of the matching songs.
+        # Untagged items can be tagged as such or have no tag at all, and
+        # "Various Artists" means any artist.
+        def search(item):
+            return (item, '') if item == self.NOTAG else item
+
+        if artist == VARIOUS_ARTISTS:
+            artist = None
+        return self.library_get_index().select(genre=search(genre),
+                                               artist=search(artist),
+                                               album=search(album),
+                                               date=search(year))
+
     def library_return_list_items(self, itemtype, genre=None, artist=None,
-                                  album=None, year=None, ignore_case=True):
-        # Returns all items of tag 'itemtype', in alphabetical order,
-        # using mpd's 'list'. If searchtype is passed, use
-        # a case insensitive search, via additional 'list'
-        # queries, since using a single 'list' call will be
-        # case sensitive.
-        results = []
-        searches = self.library_compose_list_count_searchlist(genre, artist,
-                                                              album, year)
-        if len(searches) > 0:
-            for s in searches:
-                # If we have untagged tags (''), use search instead
-                # of list because list will not return anything.
-                if '' in s:
-                    items = []
-                    songs, playtime, num_songs = \
-                            self.library_return_search_items(genre, artist,
-                                                             album, year)
-                    for song in songs:
-                        items.append(song.get(itemtype))
-                else:
-                    items = self.mpd.list(itemtype, *s)
-                for item in items:
-                    if len(item) > 0:
-                        results.append(item)
-        else:
-            if genre is None and artist is None and album is None and year \
-               is None:
-                for item in self.mpd.list(itemtype):
-                    if len(item) > 0:
-                        results.append(item)
-        if ignore_case:
-            results = misc.remove_list_duplicates(results, case=False)
-        results.sort(key=locale.strxfrm)
+                                  album=None, year=None):
+        # Returns all items of tag 'itemtype', in alphabetical order.
+        # Items are compared case insensitively.
+        ids = self.library_select(genre, artist, album, year)
+        results = self.library_get_index().values(itemtype, ids)
+        results.sort(key=misc.collation_key)
         return results
 
     def library_return_count(self, genre=None, artist=None, album=None,
                              year=None):
-        # Because mpd's 'count' is case sensitive, we have to
-        # determine all equivalent items (case insensitive) and
-        # call 'count' for each of them. Using 'list' + 'count'
-        # involves much less data to be transferred back and
-        # forth than to use 'search' and count manually.
-        searches = self.library_compose_list_count_searchlist(genre, artist,
-                                                              album, year)
-        playtime = 0
-        num_songs = 0
-        for s in searches:
-            count = self.mpd.count(*s)
-            playtime += count.playtime
-            num_songs += count.songs
-
-        return (playtime, num_songs)
-
-    def library_compose_list_count_searchlist_single(self, search, typename,
-                                                     cached_list, searchlist):
-        s = []
-        skip_type = (typename == 'artist' and search == VARIOUS_ARTISTS)
-        if search is not None and not skip_type:
-            if search == self.NOTAG:
-                itemlist = [search, '']
-            else:
-                itemlist = []
-                if cached_list is None:
-                    cached_list = self.library_return_list_items(typename,
-                                                             ignore_case=False)
-                    # This allows us to match untagged items
-                    cached_list.append('')
-                for item in cached_list:
-                    if str(item).lower() == str(search).lower():
-                        itemlist.append(item)
-            if len(itemlist) == 0:
-                # There should be no results!
-                return None, cached_list
-            for item in itemlist:
-                if len(searchlist) > 0:
-                    for item2 in searchlist:
-                        s.append(item2 + (typename, item))
-                else:
-                    s.append((typename, item))
-        else:
-            s = searchlist
-        return s, cached_list
-
-    def library_compose_list_count_searchlist(self, genre=None, artist=None,
-                                              album=None, year=None):
-        s = []
-        s, self.lib_list_genres = \
-                self.library_compose_list_count_searchlist_single(
-                    genre, 'genre', self.lib_list_genres, s)
-        if s is None:
-            return []
-        s, self.lib_list_artists = \
-                self.library_compose_list_count_searchlist_single(
-                    artist, 'artist', self.lib_list_artists, s)
-        if s is None:
-            return []
-        s, self.lib_list_albums = \
-                self.library_compose_list_count_searchlist_single(
-                    album, 'album', self.lib_list_albums, s)
-        if s is None:
-            return []
-        s, self.lib_list_years = \
-                self.library_compose_list_count_searchlist_single(
-                    year, 'date', self.lib_list_years, s)
-        if s is None:
-            return []
-        return s
-
-    def library_compose_search_searchlist_single(self, search, typename,
-                                                 searchlist):
-        s = []
-        skip_type = (typename == 'artist' and search == VARIOUS_ARTISTS)
-        if search is not None and not skip_type:
-            if search == self.NOTAG:
-                itemlist = [search, '']
-            else:
-                itemlist = [search]
-            for item in itemlist:
-                if len(searchlist) > 0:
-                    for item2 in searchlist:
-                        s.append(item2 + (typename, item))
-                else:
-                    s.append((typename, item))
-        else:
-            s = searchlist
-        return s
-
-    def library_compose_search_searchlist(self, genre=None, artist=None,
-                                          album=None, year=None):
-        s = []
-        s = self.library_compose_search_searchlist_single(genre, 'genre', s)
-        s = self.library_compose_search_searchlist_single(album, 'album', s)
-        s = self.library_compose_search_searchlist_single(artist, 'artist', s)
-        s = self.library_compose_search_searchlist_single(year, 'date', s)
-        return s
+        ids = self.library_select(genre, artist, album, year)
+        return self.library_get_index().count(ids)
+
+    def library_return_counts(self, queries):
+        # Same as library_return_count, for a list of dicts of genre, artist,
+        # album and year.
+        return [self.library_return_count(**query) for query in queries]
 
     def library_return_search_items(self, genre=None, artist=None, album=None,
                                     year=None):
-        # Returns all mpd items, using mpd's 'search', along with
-        # playtime and num_songs.
-        searches = self.library_compose_search_searchlist(genre, artist, album,
-                                                          year)
-        for s in searches:
-            args_tuple = tuple(map(str, s))
-            playtime = 0
-            num_songs = 0
-            results = []
-            strip_type = None
-
-            if len(args_tuple) == 0:
-                return None, 0, 0
-
-            items = self.mpd.search(*args_tuple)
-            if items is not None:
-                for item in items:
-                    if strip_type is None or (strip_type is not None and not \
-                                              strip_type in item.keys()):
-                        match = True
-                        pos = 0
-                        # Ensure that if, e.g., "foo" is searched,
-                        # "foobar" isn't returned too
-                        for arg in args_tuple[::2]:
-                            if arg in item and \
-                               str(item.get(arg, '')).upper() != \
-                               str(args_tuple[pos + 1]).upper():
-                                match = False
-                                break
-                            pos += 2
-                        if match:
-                            results.append(item)
-                            num_songs += 1
-                            playtime += item.time
-        return (results, int(playtime), num_songs)
+        # Returns all the matching songs, along with playtime and num_songs.
+        if genre is None and artist is None and album is None and \
+           year is None:
+            return [], 0, 0
+        index = self.library_get_index()
+        ids = self.library_select(genre, artist, album, year)
+        playtime, num_songs = index.count(ids)
+        return index.songs(ids), playtime, num_songs
 
     def add_display_info(self, num_songs, playtime):
         seconds = int(playtime)
@@ -1178,11 +1330,12 @@ class Library:
             self.prevlibtodo = 'foo'
             self.prevlibtodo_base = "__"
             self.prevlibtodo_base_results = []
-            # extra thread for background search work,
-            # synchronized with a condition and its internal mutex
-            self.libfilterbox_cond = threading.Condition()
-            self.libfilterbox_cmd_buf = self.searchtext.get_text()
-            qsearch_thread = threading.Thread(target=self.libsearchfilter_loop)
+            # extra thread for background search work, receiving the
+            # searches to run through a queue
+            self.libsearch_queue = queue.Queue()
+            self.libsearchfilter_start_loop(self.searchtext)
+            qsearch_thread = threading.Thread(target=self.libsearchfilter_loop,
+                                              args=(self.libsearch_queue,))
             qsearch_thread.name = "LibraryFilter"
             qsearch_thread.daemon = True
             qsearch_thread.start()
@@ -1211,60 +1364,93 @@ class Library:
             300, self.libsearchfilter_start_loop, editable)
 
     def libsearchfilter_start_loop(self, editable):
-        self.libfilterbox_cond.acquire()
-        self.libfilterbox_cmd_buf = editable.get_text()
-        self.libfilterbox_cond.notifyAll()
-        self.libfilterbox_cond.release()
+        # The previous search is outdated: stop it and drop its results
+        if self.libsearch is not None:
+            self.libsearch.cancel()
+        searchby = self.search_terms_mpd[self.config.last_search_num]
+        self.libsearch = LibrarySearch(searchby, editable.get_text())
+        self.libsearch_queue.put(self.libsearch)
 
     def libsearchfilter_stop_loop(self):
-        self.libfilterbox_cond.acquire()
-        self.libfilterbox_cmd_buf = '$$$QUIT###'
-        self.libfilterbox_cond.notifyAll()
-        self.libfilterbox_cond.release()
+        if self.libsearch is not None:
+            self.libsearch.cancel()
+            self.libsearch = None
+        self.libsearch_queue.put(None)
 
-    def libsearchfilter_loop(self):
+    def libsearchfilter_loop(self, searches):
+        # Runs the searches received from `searches`, until None is received
         while True:
-            # copy the last command or pattern safely
-            self.libfilterbox_cond.acquire()
-            try:
-                while(self.libfilterbox_cmd_buf == '$$$DONE###'):
-                    self.libfilterbox_cond.wait()
-                todo = self.libfilterbox_cmd_buf
-                self.libfilterbox_cond.release()
-            except:
-                todo = self.libfilterbox_cmd_buf
-            searchby = self.search_terms_mpd[self.config.last_search_num]
-            if self.prevlibtodo != todo:
-                if todo == '$$$QUIT###':
-                    GLib.idle_add(ui.reset_entry_marking, self.searchtext)
-                    return
-                elif len(todo) > 1:
-                    GLib.idle_add(self.libsearchfilter_do_search, searchby,
-                                  todo)
-                elif len(todo) == 0:
-                    GLib.idle_add(ui.reset_entry_marking, self.searchtext)
-                    self.libsearchfilter_toggle(False)
-                else:
-                    GLib.idle_add(ui.reset_entry_marking, self.searchtext)
-            self.libfilterbox_cond.acquire()
-            self.libfilterbox_cmd_buf = '$$$DONE###'
-            try:
-                self.libfilterbox_cond.release()
-            except Exception as e:
-                # XXX add logger here in the future!
-                raise e
-            self.prevlibtodo = todo
-
-    def libsearchfilter_do_search(self, searchby, todo):
+            search = searches.get()
+            if search is None:
+                GLib.idle_add(ui.reset_entry_marking, self.searchtext)
+                return
+            todo = search.text
+            if search.cancelled or self.prevlibtodo == todo:
+                continue
+            if len(todo) > 1:
+                self.libsearchfilter_run(search)
+            elif len(todo) == 0:
+                GLib.idle_add(ui.reset_entry_marking, self.searchtext)
+                GLib.idle_add(self.libsearchfilter_toggle, False)
+            else:
+                GLib.idle_add(ui.reset_entry_marking, self.searchtext)
+            if not search.cancelled:
+                self.prevlibtodo = todo
+
+    def libsearchfilter_run(self, search):
+        # Called from the search thread: finds the matching songs, then
+        # formats and sends them to the main thread by chunks, so that the
+        # first ones are shown at once. The rows are sorted once they are
+        # all shown. The search stops as soon as it is cancelled.
+        index = self.lib_index
+        if index is not None:
+            matches = self.libsearchfilter_index_search(
+                index, search.searchby, search.text)
+            subsearch = False
+        else:
+            results, subsearch = self.libsearchfilter_base_search(
+                search.searchby, search.text)
+            matches = self.libsearchfilter_filter(search.searchby,
+                                                  search.text, results)
+        songs = [item for item in matches if 'file' in item]
+
+        libraryformat = formatting.compile_format(self.config.libraryformat)
+        keys = []
+        for start in range(0, max(len(songs), 1), SEARCH_CHUNK_SIZE):
+            if search.cancelled:
+                return
+            chunk = songs[start:start + SEARCH_CHUNK_SIZE]
+            bd = [(self.sonatapb, SongRecord(path=item['file']), name)
+                  for item, name in zip(chunk, libraryformat.render_many(
+                      chunk, True))]
+            GLib.idle_add(self.libsearchfilter_show_chunk, search, start, bd,
+                          len(songs), subsearch)
+            keys += [misc.collation_key(name) for _pb, _data, name in bd]
+
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        if order != list(range(len(keys))) and not search.cancelled:
+            GLib.idle_add(self.libsearchfilter_show_sorted, search, order)
+
+    def libsearchfilter_index_search(self, index, searchby, todo):
+        # Called from the search thread: the songs are searched in the
+        # library index, with the same matching as libsearchfilter_filter
+        # (all the words, in any order). The index isn't changed once
+        # used: database updates replace it with a patched copy.
+        words = todo.split(" ")
+        return index.songs(index.search(searchby, words))
+
+    def libsearchfilter_base_search(self, searchby, todo):
+        # Called from the search thread, so a worker connection is used.
         if not self.prevlibtodo_base in todo:
             # Do library search based on first two letters:
             self.prevlibtodo_base = todo[:2]
-            self.prevlibtodo_base_results = self.mpd.search(searchby,
-                                                             self.prevlibtodo_base)
-            subsearch = False
-        else:
-            subsearch = True
+            with self.mpd.worker() as client:
+                self.prevlibtodo_base_results = client.search(
+                    searchby, self.prevlibtodo_base) or []
+            return self.prevlibtodo_base_results, False
+        return self.prevlibtodo_base_results, True
 
+    def libsearchfilter_filter(self, searchby, todo, results):
         # Now, use filtering similar to playlist filtering:
         # this make take some seconds... and we'll escape the search text
         # because we'll be searching for a match in items that are also escaped
@@ -1281,16 +1467,17 @@ class Library:
             regexps.append(re.compile(todos[i]))
         matches = []
         if searchby != 'any':
-            for row in self.prevlibtodo_base_results:
+            for row in results:
                 is_match = True
+                value = " ".join(mpdh.get_values(row, searchby))
                 for regexp in regexps:
-                    if not regexp.match(row.get(searchby, '').lower()):
+                    if not regexp.match(value.lower()):
                         is_match = False
                         break
                 if is_match:
                     matches.append(row)
         else:
-            for row in self.prevlibtodo_base_results:
+            for row in results:
                 allstr = " ".join(row.values())
                 is_match = True
                 for regexp in regexps:
@@ -1299,17 +1486,29 @@ class Library:
                         break
                 if is_match:
                     matches.append(row)
-        if subsearch and len(matches) == len(self.librarydata):
-            # nothing changed..
-            return
-        self.library.freeze_child_notify()
+        return matches
+
+    def libsearchfilter_show_chunk(self, search, start, bd, total, subsearch):
+        # Shows the rows `bd` of the results of `search`, from the row
+        # `start`, unless the search has been cancelled meanwhile.
+        if search.cancelled:
+            return False
         currlen = len(self.librarydata)
-        bd = [(self.sonatapb,
-               SongRecord(path=item['file']),
-               formatting.parse(self.config.libraryformat, item, True))
-              for item in matches if 'file' in item]
-        bd.sort(key=lambda key: locale.strxfrm(key[2]))
-        for i, item in enumerate(bd):
+        if start == 0:
+            if subsearch and total == currlen:
+                # nothing changed..
+                search.cancel()
+                return False
+            # Remove excess items...
+            if total == 0:
+                self.librarydata.clear()
+            else:
+                for i in range(currlen - total):
+                    j = self.librarydata.get_iter((currlen - 1 - i,))
+                    self.librarydata.remove(j)
+            currlen = min(currlen, total)
+        self.library.freeze_child_notify()
+        for i, item in enumerate(bd, start):
             if i < currlen:
                 j = self.librarydata.get_iter((i, ))
                 for index in range(len(item)):
@@ -1317,21 +1516,22 @@ class Library:
                         self.librarydata.set_value(j, index, item[index])
             else:
                 self.librarydata.append(item)
-        # Remove excess items...
-        newlen = len(bd)
-        if newlen == 0:
-            self.librarydata.clear()
-        else:
-            for i in range(currlen - newlen):
-                j = self.librarydata.get_iter((currlen - 1 - i,))
-                self.librarydata.remove(j)
         self.library.thaw_child_notify()
-        if len(matches) == 0:
-            GLib.idle_add(ui.set_entry_invalid, self.searchtext)
-        else:
-            GLib.idle_add(self.library.set_cursor, Gtk.TreePath.new_first(),
-                          None, False)
-            GLib.idle_add(ui.reset_entry_marking, self.searchtext)
+        if total == 0:
+            ui.set_entry_invalid(self.searchtext)
+        elif start == 0:
+            self.library.set_cursor(Gtk.TreePath.new_first(), None, False)
+            ui.reset_entry_marking(self.searchtext)
+        return False
+
+    def libsearchfilter_show_sorted(self, search, order):
+        # Sorts the rows of the results of `search`, all shown: the row
+        # `order[i]` goes to the position i.
+        if search.cancelled or len(order) != len(self.librarydata):
+            return False
+        self.librarydata.reorder(order)
+        self.library.set_cursor(Gtk.TreePath.new_first(), None, False)
+        return False
 
     def libsearchfilter_key_pressed(self, widget, event):
         self.filter_key_pressed(widget, event, self.library)
@@ -0,0 +1,449 @@
+"""
+This module implements a local, in-memory index of the MPD database.
+
+The whole database is loaded at once with 'listallinfo' and stored in a
+compact, column-oriented form: each distinct tag value is kept only once in a
+string table, and songs refer to their values using integer ids. The genre,
+artist, album and date tags are indexed case insensitively (as MPD's 'search'
+does), so that browsing the library only needs dictionary lookups instead of
+requests to MPD. Songs can also be searched by substrings of their tags.
+
+Example usage:
+from sonata.libraryindex import LibraryIndex
+index = LibraryIndex()
+index.add_songs(self.mpd.listallinfo('/'))
+...
+ids = index.select(genre='Rock', artist=('Untagged', ''))
+ids = index.search('any', ['beat', 'abbey'])
+patched = index.copy()
+patched.remove_songs(patched.select_dirs(['Beatles/Abbey Road']))
+playtime, num_songs = index.count(ids)
+albums = index.values('album', ids)
+...
+index.save(cache_path(host, port), key)
+key, index = LibraryIndex.load(cache_path(host, port))
+"""
+
+from array import array
+import bisect
+import hashlib
+import json
+import logging
+import os
+
+from sonata import misc
+from sonata.mpdhelper import MPDSong
+
+
+# Tags kept for each song: enough to display the songs in the library.
+TAGS = ('file', 'artist', 'album', 'date', 'genre', 'title', 'track',
+        'disc', 'name', 'albumartist', 'composer')
+
+# Tags which can be used to select songs.
+INDEXED_TAGS = ('genre', 'artist', 'album', 'date')
+
+CACHE_DIR = os.path.expanduser("~/.config/sonata/library")
+# First line of the cache files, to be changed if the format changes
+CACHE_MAGIC = b"sonata library index 2\n"
+
+logger = logging.getLogger(__name__)
+
+
+def cache_path(host, port):
+    """Return the path of the index cache file for an MPD server."""
+    name = hashlib.md5(("%s:%s" % (host, port)).encode('utf8')).hexdigest()
+    return os.path.join(CACHE_DIR, name)
+
+
+class LibraryIndex:
+    """Songs of the MPD database, indexed by tags."""
+
+    def __init__(self):
+        # The empty string, id 0, represents missing tags
+        self._strings = ['']
+        self._string_ids = {'': 0}
+        self._columns = dict((tag, array('L')) for tag in TAGS)
+        # The columns keep the first value of each tag, for tags present
+        # several times: song id -> ids of the other values
+        self._extra = dict((tag, {}) for tag in TAGS)
+        self._times = array('L')
+        # For each indexed tag: lowercased value -> ids of the songs
+        self._postings = dict((tag, {}) for tag in INDEXED_TAGS)
+        self._search_reset()
+
+    def _search_reset(self):
+        # Built on first search: all the lowercased strings separated by
+        # newlines, the offset of each of them in this text, and for each
+        # searched tag: string id -> ids of the songs having this value.
+        self._search_text = None
+        self._search_offsets = None
+        self._search_songs = {}
+        # Last searched words -> ids of the strings containing them
+        self._search_words = {}
+
+    def __len__(self):
+        return len(self._times)
+
+    def _intern(self, value):
+        try:
+            return self._string_ids[value]
+        except KeyError:
+            string_id = self._string_ids[value] = len(self._strings)
+            self._strings.append(value)
+            return string_id
+
+    def add_songs(self, items):
+        """Add songs, as returned by 'listallinfo' or 'lsinfo', to the index.
+
+        Directories and playlists are ignored. Songs can be selected using
+        any of the values of tags present several times.
+        """
+        for item in items:
+            if 'file' not in item:
+                continue
+            song_id = len(self)
+            for tag in TAGS:
+                value = item.get(tag, '')
+                if isinstance(value, (list, tuple)):
+                    values = value
+                    self._columns[tag].append(self._intern(values[0]))
+                    self._extra[tag][song_id] = tuple(
+                        self._intern(other) for other in values[1:])
+                else:
+                    values = (value,)
+                    self._columns[tag].append(self._intern(value))
+                if tag in self._postings:
+                    postings = self._postings[tag]
+                    for key in set(other.lower() for other in values):
+                        postings.setdefault(key, array('L')).append(song_id)
+            time = str(item.get('time', '0'))
+            self._times.append(int(time) if time.isdigit() else 0)
+        self._search_reset()
+
+    def select(self, **filters):
+        """Return the ids of the songs matching all the filters, in order.
+
+        Each keyword is an indexed tag, and its value is either None (no
+        filtering on this tag), a string or a tuple of strings, one of them
+        having to match. Matching is case insensitive, and the empty string
+        matches songs without this tag.
+        """
+        result = None
+        for tag, values in filters.items():
+            if values is None:
+                continue
+            if isinstance(values, str):
+                values = (values,)
+            postings = self._postings[tag]
+            ids = set()
+            for value in values:
+                ids.update(postings.get(value.lower(), ()))
+            result = ids if result is None else result & ids
+            if not result:
+                return []
+
+        if result is None:
+            return list(range(len(self)))
+        return sorted(result)
+
+    def count(self, ids):
+        """Return the total playtime and the number of songs of `ids`."""
+        return sum(self._times[i] for i in ids), len(ids)
+
+    def values(self, tag, ids):
+        """Return the distinct values of `tag` for the songs `ids`.
+
+        Values are compared case insensitively, the first spelling found is
+        kept. Empty values are skipped.
+        """
+        column = self._columns[tag]
+        extra = self._extra[tag]
+        string_ids = set()
+        for i in ids:
+            string_ids.add(column[i])
+            if i in extra:
+                string_ids.update(extra[i])
+        seen = set()
+        values = []
+        for string_id in sorted(string_ids):
+            value = self._strings[string_id]
+            key = value.lower()
+            if value and key not in seen:
+                seen.add(key)
+                values.append(value)
+        return values
+
+    def rows(self, *tags, ids=None):
+        """Iterate over the songs `ids` (by default, all the songs), as tuples
+        of the requested tags.
+
+        Only the first value of tags present several times is given.
+        """
+        columns = [self._columns[tag] for tag in tags]
+        strings = self._strings
+        if ids is None:
+            ids = range(len(self))
+        for song_id in ids:
+            yield tuple(strings[column[song_id]] for column in columns)
+
+    def search(self, tag, words):
+        """Return the ids of the songs whose `tag` contains all the `words`,
+        in order.
+
+        `tag` can also be 'any', to search in all the tags. Words are matched
+        case insensitively, anywhere in the values, and in any order: 'foo
+        bar' matches 'Barstool Foo'.
+        """
+        # The search can be done from another thread: the structures are
+        # only replaced, never modified, once built.
+        text, offsets = self._search_text, self._search_offsets
+        search_songs, words_cache = self._search_songs, self._search_words
+        if text is None:
+            lowered = [value.lower() for value in self._strings]
+            offsets = array('L')
+            offset = 0
+            for value in lowered:
+                offsets.append(offset)
+                offset += len(value) + 1
+            text = '\n'.join(lowered)
+            self._search_text, self._search_offsets = text, offsets
+
+        songs = search_songs.get(tag)
+        if songs is None:
+            songs = {}
+            for other_tag in (TAGS if tag == 'any' else (tag,)):
+                for song_id, string_id in enumerate(self._columns[other_tag]):
+                    songs.setdefault(string_id, array('L')).append(song_id)
+                for song_id, others in self._extra[other_tag].items():
+                    for string_id in others:
+                        songs.setdefault(string_id,
+                                         array('L')).append(song_id)
+            # Missing tags never match
+            songs.pop(0, None)
+            search_songs[tag] = songs
+
+        result = None
+        for word in set(word.lower() for word in words if word):
+            ids = set()
+            for string_id in self._search_strings(word, text, offsets,
+                                                 words_cache):
+                ids.update(songs.get(string_id, ()))
+            result = ids if result is None else result & ids
+            if not result:
+                return []
+        if result is None:
+            result = set()
+            for ids in songs.values():
+                result.update(ids)
+        return sorted(result)
+
+    def _search_strings(self, word, text, offsets, words):
+        # Returns the ids of the strings containing `word`
+        try:
+            return words[word]
+        except KeyError:
+            pass
+        string_ids = []
+        start = text.find(word)
+        while start >= 0:
+            string_id = bisect.bisect_right(offsets, start) - 1
+            string_ids.append(string_id)
+            if string_id + 1 == len(offsets):
+                break
+            start = text.find(word, offsets[string_id + 1])
+        if len(words) > 100:
+            words.clear()
+        words[word] = string_ids
+        return string_ids
+
+    def select_dirs(self, dirs):
+        """Return the ids of the songs in the directories `dirs`, or in their
+        subdirectories."""
+        prefixes = tuple(directory.rstrip('/') + '/' for directory in dirs)
+        strings = self._strings
+        return [song_id
+                for song_id, string_id in enumerate(self._columns['file'])
+                if strings[string_id].startswith(prefixes)]
+
+    def remove_songs(self, ids):
+        """Remove the songs `ids` from the index.
+
+        The other songs keep their order, but their ids change.
+        """
+        removed = set(ids)
+        if not removed:
+            return
+        kept = [song_id for song_id in range(len(self))
+                if song_id not in removed]
+        new_ids = dict((old_id, new_id) for new_id, old_id in enumerate(kept))
+
+        for tag, column in self._columns.items():
+            self._columns[tag] = array('L', (column[i] for i in kept))
+        for tag, extra in self._extra.items():
+            self._extra[tag] = dict((new_ids[i], values)
+                                    for i, values in extra.items()
+                                    if i in new_ids)
+        self._times = array('L', (self._times[i] for i in kept))
+        for postings in self._postings.values():
+            for value, song_ids in list(postings.items()):
+                song_ids = array('L', (new_ids[i] for i in song_ids
+                                       if i in new_ids))
+                if song_ids:
+                    postings[value] = song_ids
+                else:
+                    del postings[value]
+        self._search_reset()
+
+    def copy(self):
+        """Return a copy of the index, to be changed while this one is still
+        used (and searched from other threads)."""
+        index = type(self)()
+        index._strings = list(self._strings)
+        index._string_ids = dict(self._string_ids)
+        index._columns = dict((tag, array('L', column))
+                              for tag, column in self._columns.items())
+        index._extra = dict((tag, dict(extra))
+                            for tag, extra in self._extra.items())
+        index._times = array('L', self._times)
+        index._postings = dict(
+            (tag, dict((value, array('L', song_ids))
+                       for value, song_ids in postings.items()))
+            for tag, postings in self._postings.items())
+        return index
+
+    def song(self, song_id):
+        """Return the song `song_id` as an MPDSong."""
+        mapping = {}
+        for tag in TAGS:
+            value = self._strings[self._columns[tag][song_id]]
+            if song_id in self._extra[tag]:
+                mapping[tag] = [value] + [self._strings[i] for i
+                                          in self._extra[tag][song_id]]
+            elif value:
+                mapping[tag] = value
+        mapping['time'] = str(self._times[song_id])
+        return MPDSong(mapping)
+
+    def songs(self, ids):
+        return [self.song(song_id) for song_id in ids]
+
+    def save(self, path, key):
+        """Save the index to `path`, with `key` identifying its content.
+
+        `key` is any JSON-serializable value, returned as is by `load()`. The
+        file only contains strings and arrays of integers, so that it can be
+        loaded back safely and very quickly.
+        """
+        strings = '\0'.join(self._strings)
+        if strings.count('\0') != len(self._strings) - 1:
+            logger.info("Not saving the library index: NUL character found")
+            return False
+
+        chunks = [strings.encode('utf8')]
+        chunks.extend(self._columns[tag].tobytes() for tag in TAGS)
+        for tag in TAGS:
+            song_ids = array('L')
+            ends = array('L')
+            values = array('L')
+            for song_id, others in sorted(self._extra[tag].items()):
+                song_ids.append(song_id)
+                values.extend(others)
+                ends.append(len(values))
+            chunks.extend([song_ids.tobytes(), ends.tobytes(),
+                           values.tobytes()])
+        chunks.append(self._times.tobytes())
+        for tag in INDEXED_TAGS:
+            postings = self._postings[tag]
+            ids = array('L')
+            ends = array('L')
+            for value in postings.values():
+                ids.extend(value)
+                ends.append(len(ids))
+            chunks.append('\0'.join(postings.keys()).encode('utf8'))
+            chunks.append(ends.tobytes())
+            chunks.append(ids.tobytes())
+
+        header = {
+            'key': key,
+            'tags': TAGS,
+            'indexed_tags': INDEXED_TAGS,
+            'itemsize': array('L').itemsize,
+            'sizes': [len(chunk) for chunk in chunks],
+        }
+
+        logger.debug("Saving the library index to %s", path)
+        misc.create_dir(os.path.dirname(path))
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(CACHE_MAGIC)
+                f.write(json.dumps(header).encode('utf8') + b'\n')
+                for chunk in chunks:
+                    f.write(chunk)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            logger.info("Unable to save the library index: %s", e)
+            misc.remove_file(tmp_path)
+            return False
+        return True
+
+    @classmethod
+    def load(cls, path):
+        """Load an index saved by `save()`.
+
+        Returns a tuple (key, index), or (None, None) if there is no valid
+        index in `path`.
+        """
+        logger.debug("Loading the library index from %s", path)
+        try:
+            with open(path, 'rb') as f:
+                if f.readline() != CACHE_MAGIC:
+                    raise ValueError("unknown format")
+                header = json.loads(f.readline().decode('utf8'))
+                data = f.read()
+
+            if header['tags'] != list(TAGS) or \
+               header['indexed_tags'] != list(INDEXED_TAGS) or \
+               header['itemsize'] != array('L').itemsize or \
+               sum(header['sizes']) != len(data):
+                raise ValueError("incompatible index")
+
+            chunks = []
+            start = 0
+            for size in header['sizes']:
+                chunks.append(data[start:start + size])
+                start += size
+            chunks = iter(chunks)
+
+            index = cls()
+            index._strings = next(chunks).decode('utf8').split('\0')
+            index._string_ids = dict(zip(index._strings,
+                                         range(len(index._strings))))
+            for tag in TAGS:
+                index._columns[tag].frombytes(next(chunks))
+            for tag in TAGS:
+                song_ids, ends, values = array('L'), array('L'), array('L')
+                song_ids.frombytes(next(chunks))
+                ends.frombytes(next(chunks))
+                values.frombytes(next(chunks))
+                start = 0
+                for song_id, end in zip(song_ids, ends):
+                    index._extra[tag][song_id] = tuple(values[start:end])
+                    start = end
+            index._times.frombytes(next(chunks))
+            for tag in INDEXED_TAGS:
+                values = next(chunks).decode('utf8').split('\0')
+                ends = array('L')
+                ends.frombytes(next(chunks))
+                ids = array('L')
+                ids.frombytes(next(chunks))
+                postings = index._postings[tag]
+                start = 0
+                for value, end in zip(values if ends else [], ends):
+                    postings[value] = ids[start:end]
+                    start = end
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            logger.info("Unable to load the library index: %s", e)
+            return None, None
+
+        return header['key'], index
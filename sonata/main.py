@@ -32,6 +32,7 @@ import gc
 import shutil
 import tempfile
 import threading
+import time
 
 from gi.repository import Gtk, Gdk, GdkPixbuf, Gio, GLib, Pango
 
@@ -86,6 +87,9 @@ class Base:
         self.lyrics_search_dialog = None
 
         self.mpd = mpdh.MPDClient()
+        # Second connection, waiting for MPD to tell us when something
+        # changes, so we don't have to poll it all the time.
+        self.idle_watcher = mpdh.MPDIdleWatcher(self.on_mpd_idle)
         self.conn = False
         # Anything != than self.conn, to actually refresh the UI at startup.
         self.prevconn = not self.conn
@@ -101,9 +105,17 @@ class Base:
         # to freeze while the socket.connect() calls are repeatedly executed.
         # Therefore, if we were not able to make a connection, slow down the
         # iteration check to once every 15 seconds.
+        # When MPD notifies us of its changes, iterating only updates the
+        # elapsed time locally, without talking to MPD.
         self.iterate_time_when_connected = 500
         # Slow down polling when disconnected stopped
         self.iterate_time_when_disconnected_or_stopped = 1000
+        # MPD doesn't notify us of some changes, like the bitrate: the status
+        # is requested again after these delays (in seconds) anyway. This
+        # also keeps the main connection from being closed by MPD's
+        # connection_timeout.
+        self.status_refresh_time_when_playing = 5
+        self.status_refresh_time = 30
 
 
         self.trying_connection = False
@@ -126,6 +138,10 @@ class Base:
 
         self.prevstatus = None
         self.prevsonginfo = None
+        # Last status really received from MPD, and when we received it
+        self.status_fetched = None
+        self.status_fetched_time = None
+        self.status_outdated = True
 
         self.popuptimes = ['2', '3', '5', '10', '15', '30', _('Entire song')]
 
@@ -153,6 +169,8 @@ class Base:
         self.last_progress_text = None
 
         self.last_status_text = ""
+        # What the status bar text was made of
+        self.last_status_totals = None
 
         self.img_clicked = False
 
@@ -380,6 +398,7 @@ class Base:
                   <menuitem action="sortbyalbum"/>
                   <menuitem action="sortbyfile"/>
                   <menuitem action="sortbydirfile"/>
+                  <menuitem action="sortbycustom"/>
                   <separator name="FM3"/>
                   <menuitem action="sortshuffle"/>
                   <menuitem action="sortreverse"/>
@@ -473,6 +492,8 @@ class Base:
              self.current.on_sort_by_file),
             ('sortbydirfile', None, _('By Dir & File Name'), None, None,
              self.current.on_sort_by_dirfile),
+            ('sortbycustom', None, _('By Custom Order'), None, None,
+             self.current.on_sort_by_custom),
             ('sortreverse', None, _('Reverse List'), None, None,
              self.current.on_sort_reverse),
             ]
@@ -919,6 +940,7 @@ class Base:
             test = self.mpd.status()
             if test:
                 self.conn = True
+                self.idle_watcher.start(host, port, password)
             else:
                 self.conn = False
         else:
@@ -933,6 +955,7 @@ class Base:
         self.trying_connection = False
 
     def mpd_disconnect(self):
+        self.idle_watcher.stop()
         if self.conn:
             self.mpd.close()
             self.mpd.disconnect()
@@ -966,6 +989,9 @@ class Base:
             if self.conn:
                 self.iterate_time = self.iterate_time_when_connected
                 self.status = self.mpd.status()
+                self.status_fetched = self.status
+                self.status_fetched_time = time.time()
+                self.status_outdated = False
                 if self.status:
                     if self.status['state'] == 'stop':
                         self.iterate_time = \
@@ -1007,8 +1033,57 @@ class Base:
         self.songinfo = None
         self.artwork.update_songinfo(self.songinfo)
 
+    def update_status_elapsed(self):
+        # Between two MPD notifications, only the elapsed time of the playing
+        # song changes: compute it locally instead of asking MPD.
+        status = self.status_fetched
+        if not status or status['state'] != 'play' or 'time' not in status:
+            return
+
+        at, length = status['time'].split(':')
+        elapsed = float(status.get('elapsed', at))
+        elapsed += time.time() - self.status_fetched_time
+        if int(length) > 0:
+            # MPD will tell us when the next song starts
+            elapsed = min(elapsed, int(length))
+
+        self.status = dict(status)
+        self.status['time'] = "%d:%s" % (elapsed, length)
+        if 'elapsed' in status:
+            self.status['elapsed'] = "%.3f" % elapsed
+
+    def on_mpd_idle(self, changes):
+        if changes is None:
+            # Idle connection lost, poll MPD until we are connected again
+            self.iterate_now()
+            return
+
+        if 'stored_playlist' in changes:
+            self.playlists.populate()
+        if 'database' in changes:
+            self.mpd_updated_db()
+        if set(changes) & {'player', 'mixer', 'options', 'playlist', 'update'}:
+            self.iterate_now()
+        if 'update' in changes and self.conn and \
+           not mpdh.mpd_is_updating(self.status):
+            self.library.view_caches_update_done()
+
+    def status_refresh_due(self):
+        status = self.status_fetched
+        if not status or self.status_fetched_time is None:
+            return True
+        if status['state'] == 'play':
+            delay = self.status_refresh_time_when_playing
+        else:
+            delay = self.status_refresh_time
+        return time.time() - self.status_fetched_time >= delay
+
     def iterate(self):
-        self.update_status()
+        if self.conn and self.idle_watcher.watching \
+           and not self.status_outdated and not self.status_refresh_due():
+            self.update_status_elapsed()
+        else:
+            self.update_status()
         self.info_update(False)
 
         # XXX: this is subject to race condition, since self.conn can be
@@ -1059,6 +1134,7 @@ class Base:
         # slowed down to 500ms, we'll call self.iterate_now()
         # whenever the user performs an action that requires
         # updating the client
+        self.status_outdated = True
         self.iterate_stop()
         self.iterate()
 
@@ -1131,6 +1207,7 @@ class Base:
 
     def handle_change_conn(self):
         if not self.conn:
+            self.idle_watcher.stop()
             for mediabutton in (self.ppbutton, self.stopbutton,
                                 self.prevbutton, self.nextbutton,
                                 self.volumebutton):
@@ -1149,6 +1226,8 @@ class Base:
                                 self.prevbutton, self.nextbutton,
                                 self.volumebutton):
                 mediabutton.set_property('sensitive', True)
+            # We may be connected to another MPD server now
+            self.library.view_caches_reset()
             if self.sonata_loaded:
                 self.library.library_browse(root=SongRecord(path="/"))
             self.playlists.populate()
@@ -1401,6 +1480,12 @@ class Base:
             if mpdh.mpd_is_updating(self.status):
                 # MPD library is being updated
                 self.update_statusbar(True)
+            elif self.idle_watcher.watching:
+                # MPD notifies us itself when the database has changed, see
+                # on_mpd_idle()
+                if self.prevstatus is not None \
+                   and mpdh.mpd_is_updating(self.prevstatus):
+                    self.update_statusbar(False)
             elif self.prevstatus is None \
                     or mpdh.mpd_is_updating(self.prevstatus) \
                     != mpdh.mpd_is_updating(self.status):
@@ -1434,7 +1519,7 @@ class Base:
                                                     self.prevsonginfo)
 
     def mpd_updated_db(self):
-        self.library.view_caches_reset()
+        self.library.view_caches_update()
         self.update_statusbar(False)
         # We need to make sure that we update the artist in case tags
         # have changed:
@@ -1507,7 +1592,17 @@ class Base:
 
     def update_statusbar(self, updatingdb=False):
         if self.config.show_statusbar:
-            if self.conn and self.status:
+            # The totals are maintained by the playlist model as it changes,
+            # the text only has to be made again when they changed.
+            connected = bool(self.conn and self.status)
+            sort_progress = self.current.sort_progress()
+            totals = (connected, self.current.total_time,
+                      connected and self.status['playlistlength'], updatingdb,
+                      sort_progress)
+            if totals == self.last_status_totals:
+                return
+            self.last_status_totals = totals
+            if connected:
                 days = None
                 # FIXME _ is for localization, temporarily __
                 hours, mins, __ = misc.convert_time_raw(self.current.total_time)
@@ -1539,6 +1634,11 @@ class Base:
                 if updatingdb:
                     update_text = _('(updating mpd)')
                     status_text = "{}: {}".format(status_text, update_text)
+                if sort_progress is not None:
+                    sent, total = sort_progress
+                    sort_text = _('(sorting: {percent}%)').format(
+                        percent=100 * sent // total if total else 0)
+                    status_text = "{}: {}".format(status_text, sort_text)
             else:
                 status_text = ''
             if status_text != self.last_status_text:
@@ -1921,7 +2021,7 @@ class Base:
         if self.conn:
             if self.library.search_visible():
                 self.library.on_search_end(None)
-            self.mpd.update('/') # XXX we should pass a list here!
+            self.mpd.update(['/'])
             self.mpd_update_queued = True
 
     def on_updatedb_shortcut(self, _action):
@@ -1939,7 +2039,7 @@ class Base:
             filenames = self.library.get_path_child_filenames(True,
                                                               selected_only)
             if len(filenames) > 0:
-                self.mpd.update(filenames)
+                self.library.view_caches_updating(self.mpd.update(filenames))
                 self.mpd_update_queued = True
 
     def on_image_activate(self, widget, event):
@@ -3012,7 +3112,7 @@ class Base:
         self.config.tags_use_mpdpath = use_mpdpath
 
     def tags_mpd_update(self, tag_paths):
-        self.mpd.update(list(tag_paths))
+        self.library.view_caches_updating(self.mpd.update(list(tag_paths)))
         self.mpd_update_queued = True
 
     def on_about(self, _action):
@@ -1,4 +1,5 @@
 
+import functools
 import os
 import subprocess
 import re
@@ -11,7 +12,63 @@ from gi.repository import GLib
 
 logger = logging.getLogger(__name__)
 
+# Number of results kept by each memoized function
+MEMOIZE_SIZE = 20000
+# Number of collation keys kept, enough for the tags of big libraries
+COLLATION_CACHE_SIZE = 100000
+_memoized = []
 
+
+def memoize(func=None, *, maxsize=MEMOIZE_SIZE):
+    """Decorator keeping the last `maxsize` results of `func`, which takes
+    one hashable argument and returns a string.
+
+    These functions are called again and again with the same values (artist
+    names, durations...) while populating the views. The results are
+    interned, so that equal strings are shared.
+    """
+    if func is None:
+        return functools.partial(memoize, maxsize=maxsize)
+
+    @functools.lru_cache(maxsize=maxsize)
+    @functools.wraps(func)
+    def memoized(arg):
+        return sys.intern(func(arg))
+    _memoized.append(memoized)
+    return memoized
+
+
+def memoize_stats():
+    """Return the hits, misses, maxsize and current size of the cache of
+    each memoized function, by function name."""
+    return dict((func.__name__, func.cache_info()) for func in _memoized)
+
+
+def memoize_clear():
+    for func in _memoized:
+        func.cache_clear()
+
+
+@memoize(maxsize=COLLATION_CACHE_SIZE)
+def strxfrm(s):
+    return locale.strxfrm(s)
+
+
+def collation_key(s):
+    """Return the key to sort `s` according to the current locale.
+
+    The keys are cached: collation_reset() has to be called when the locale
+    changes.
+    """
+    return strxfrm(s)
+
+
+def collation_reset():
+    """Forget the collation keys computed for the previous locale."""
+    strxfrm.cache_clear()
+
+
+@memoize
 def convert_time(seconds):
     """
     Converts time in seconds to 'hh:mm:ss' format
@@ -29,6 +86,7 @@ def convert_time_raw(seconds):
     seconds -= 60 * minutes
     return hours, minutes, seconds
 
+@memoize
 def escape_html(s):
     if not s: # None or ""
         return ""
@@ -113,6 +171,7 @@ def remove_list_duplicates(inputlist, case=True):
 the_re = re.compile('^the ')
 
 
+@memoize
 def lower_no_the(s):
     s = the_re.sub('', s.lower())
     s = str(s)
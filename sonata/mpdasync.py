@@ -0,0 +1,210 @@
+"""
+This module implements an asynchronous backend to talk to MPD.
+
+Commands are run by python-mpd2's asyncio client, on an asyncio event loop
+living in its own thread, so that slow answers from MPD never block the GTK
+main loop. Several connections are used, so that a long request doesn't delay
+the other ones. Each request can be cancelled, for example when its result is
+already outdated, and fails after a timeout.
+
+From the GLib main loop, the results are received using callbacks:
+from sonata.mpdasync import MPDAsyncClient
+client = MPDAsyncClient()
+client.connect(host, port, password)
+...
+request = client.call('search', 'any', 'foo', callback=self.on_results)
+...
+request.cancel() # self.on_results won't be called
+
+Coroutines run on the backend loop can also await the commands directly:
+async def count_albums(client):
+    albums = await client.list('album')
+    return len(albums)
+client.run(count_albums(client), callback=self.on_count)
+"""
+
+import asyncio
+import logging
+import socket
+import threading
+
+from gi.repository import GLib
+import mpd
+
+try:
+    from mpd.asyncio import MPDClient as AsyncioMPDClient
+except ImportError:
+    # python-mpd2 < 1.0
+    AsyncioMPDClient = None
+
+
+# Number of connections opened by the backend
+CONNECTIONS = 2
+# Default timeout of the requests, in seconds
+TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def available():
+    """Whether the installed python-mpd2 provides an asyncio client."""
+    return AsyncioMPDClient is not None
+
+
+class MPDRequest:
+    """A request sent by MPDAsyncClient, which can be cancelled."""
+
+    def __init__(self, future=None):
+        self._future = future
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancel the request: its callback won't be called."""
+        self.cancelled = True
+        if self._future is not None:
+            self._future.cancel()
+
+    @property
+    def done(self):
+        return self._future is None or self._future.done()
+
+
+class MPDAsyncClient:
+    """Run MPD commands on several connections, without blocking.
+
+    `convert` and `failed` are called with the command name and respectively
+    the raw result of the command or the exception it raised, and return the
+    value given to the callbacks (see MPDClient._convert() and
+    MPDClient._failed()).
+    """
+
+    def __init__(self, convert=None, failed=None, connections=CONNECTIONS):
+        self._convert = convert or (lambda cmd_name, retval: retval)
+        self._failed = failed or (lambda cmd_name, error: None)
+        self._num_connections = connections
+        self.host = None
+        self.port = None
+        self._password = None
+        self.timeout = TIMEOUT
+        self._loop = None
+        # Only used from the backend loop: connection -> number of requests
+        self._clients = {}
+        self._connect_lock = None
+
+    def connect(self, host, port, password=None):
+        """Use the MPD server `host`:`port` for the next requests.
+
+        The connections are opened on first use.
+        """
+        self.close()
+        self.host = host
+        self.port = port
+        self._password = password
+
+    def close(self):
+        """Disconnect from MPD. Running requests fail."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._disconnect)
+
+    def _disconnect(self):
+        for client in self._clients:
+            client.disconnect()
+        self._clients = {}
+
+    def _start(self):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=self._loop.run_forever,
+                                      name="MPDAsync")
+            thread.daemon = True
+            thread.start()
+
+    async def _client(self):
+        # The connection with the least requests waiting, connected if needed
+        if not self._clients:
+            self._clients = dict((AsyncioMPDClient(), 0)
+                                 for i in range(self._num_connections))
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        client = min(self._clients, key=self._clients.get)
+        async with self._connect_lock:
+            if not client.connected:
+                await client.connect(self.host, self.port)
+                if self._password:
+                    await client.password(self._password)
+        return client
+
+    async def command(self, cmd_name, *args, timeout=None):
+        """Run a command on the backend loop, and return its result.
+
+        Errors are not raised: the value returned by `failed` is returned
+        instead, like with MPDClient.
+        """
+        timeout = timeout or self.timeout
+        client = None
+        try:
+            client = await asyncio.wait_for(self._client(), timeout)
+            self._clients[client] += 1
+            retval = await asyncio.wait_for(
+                self._run(client, cmd_name, args), timeout)
+        except asyncio.TimeoutError:
+            return self._failed(cmd_name, "%s: timeout" % cmd_name)
+        except (socket.error, mpd.ConnectionError) as e:
+            if client is not None:
+                # Connect again on next use
+                client.disconnect()
+            return self._failed(cmd_name, e)
+        except mpd.MPDError as e:
+            return self._failed(cmd_name, e)
+        finally:
+            if client in self._clients:
+                self._clients[client] -= 1
+        return self._convert(cmd_name, retval)
+
+    async def _run(self, client, cmd_name, args):
+        # Some commands return results which can only be awaited (not used as
+        # futures), so they can't be given as is to asyncio.wait_for().
+        return await getattr(client, cmd_name)(*args)
+
+    def __getattr__(self, attr):
+        """Commands, to be awaited from coroutines run on the backend loop."""
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        async def command(*args):
+            return await self.command(attr, *args)
+        return command
+
+    def call(self, cmd_name, *args, callback=None, timeout=None):
+        """Send a command, and return its MPDRequest right away.
+
+        `callback` is called from the GLib main loop with the result of the
+        command, unless the request has been cancelled before.
+        """
+        return self.run(self.command(cmd_name, *args, timeout=timeout),
+                        callback)
+
+    def run(self, coroutine, callback=None):
+        """Run `coroutine` on the backend loop, and return its MPDRequest.
+
+        `callback` is called from the GLib main loop with the value returned
+        by the coroutine, unless the request has been cancelled before.
+        """
+        self._start()
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        request = MPDRequest(future)
+        future.add_done_callback(
+            lambda future: GLib.idle_add(self._done, request, callback))
+        return request
+
+    def _done(self, request, callback):
+        if request.cancelled or request._future.cancelled():
+            return False
+        try:
+            result = request._future.result()
+        except Exception:
+            logger.exception("Unexpected error during an MPD request")
+            return False
+        if callback is not None:
+            callback(result)
+        return False
@@ -1,15 +1,35 @@
 
+import contextlib
 import functools
 import logging
 import os
+import re
 import socket
+import sys
+import threading
 
-from gi.repository import GObject
+from gi.repository import GLib
 import mpd
 
+from sonata import mpdasync
 from sonata.misc import remove_list_duplicates
 
 
+# Maximum number of commands sent in one command list, to stay below MPD's
+# "max_command_list_size" limit.
+BATCH_SIZE = 500
+# Error code of the commands referring to something which doesn't exist
+ACK_ERROR_NO_EXIST = 50
+
+# MPD's default "max_connections" limit. Sonata keeps two connections opened
+# all the time (the main one and the one waiting with 'idle') and the
+# asynchronous backend uses a few more, the others can be used by workers.
+# Fewer workers are used if the server refuses their connections.
+MAX_CONNECTIONS = 10
+RESERVED_CONNECTIONS = 2 + mpdasync.CONNECTIONS
+MAX_WORKERS = 2
+
+
 class MPDClient:
     def __init__(self, client=None):
         if client is None:
@@ -20,6 +40,14 @@ class MPDClient:
             client.use_unicode = True
         self._client = client
         self.logger = logging.getLogger(__name__)
+        self.host = None
+        self.port = None
+        self._password = None
+        # Connect again automatically when the connection has been lost (eg.
+        # closed by MPD's connection_timeout after a while without requests)
+        self.auto_reconnect = True
+        self._workers = None
+        self._async = None
 
     def __getattr__(self, attr):
         """
@@ -35,32 +63,199 @@ class MPDClient:
     def _call(self, cmd, cmd_name, *args):
         try:
             retval = cmd(*args)
+        except (socket.error, mpd.ConnectionError) as e:
+            if not self._reconnect(cmd_name):
+                return self._failed(cmd_name, e)
+            try:
+                retval = cmd(*args)
+            except (socket.error, mpd.MPDError) as e:
+                return self._failed(cmd_name, e)
+        except mpd.MPDError as e:
+            return self._failed(cmd_name, e)
+        return self._convert(cmd_name, retval)
+
+    def _reconnect(self, cmd_name):
+        if not self.auto_reconnect or self.host is None or \
+           cmd_name in ['connect', 'password', 'disconnect', 'close']:
+            return False
+        self.logger.info("Connection to MPD lost, reconnecting")
+        try:
+            self._client.disconnect()
+        except (socket.error, mpd.MPDError):
+            pass
+        try:
+            self._client.connect(self.host, self.port)
+            if self._password:
+                self._client.password(self._password)
         except (socket.error, mpd.MPDError) as e:
-            if cmd_name in ['lsinfo', 'list']:
-                # return sane values, which could be used afterwards
-                return []
-            elif cmd_name == 'status':
-                return {}
-            else:
-                self.logger.error("%s", e)
-                return None
+            self.logger.info("Unable to reconnect to MPD: %s", e)
+            return False
+        return True
+
+    def _failed(self, cmd_name, error):
+        if cmd_name in ['lsinfo', 'list']:
+            # return sane values, which could be used afterwards
+            return []
+        elif cmd_name == 'status':
+            return {}
+        else:
+            self.logger.error("%s", error)
+            return None
 
+    def _convert(self, cmd_name, retval):
         if cmd_name in ['songinfo', 'currentsong']:
             return MPDSong(retval)
-        elif cmd_name in ['plchanges', 'search']:
+        elif cmd_name in ['plchanges', 'playlistinfo', 'playlistid', 'search',
+                          'find']:
             return [MPDSong(s) for s in retval]
         elif cmd_name in ['count']:
             return MPDCount(retval)
         else:
             return retval
 
+    def batch(self, commands, missing=None):
+        """Send many commands at once and return the list of their results.
+
+        `commands` is an iterable of tuples (command name, arguments...), for
+        example: [('count', 'artist', 'Foo'), ('list', 'album')]. The commands
+        are sent using command lists, which saves one round-trip to MPD per
+        command. Results are converted like for single commands, and a failing
+        command only gets its own error value, without preventing the other
+        commands to run. If `missing` isn't None, it is the result of the
+        commands failing because what they refer to doesn't exist.
+        """
+        commands = list(commands)
+        results = []
+        for start in range(0, len(commands), BATCH_SIZE):
+            results.extend(self._batch(commands[start:start + BATCH_SIZE],
+                                       missing=missing))
+        return results
+
+    def _batch(self, commands, retry=True, missing=None):
+        if not commands:
+            return []
+
+        try:
+            self._client.command_list_ok_begin()
+            for cmd_name, *args in commands:
+                getattr(self._client, cmd_name)(*args)
+            retvals = self._client.command_list_end()
+        except mpd.CommandError as e:
+            index = command_error_index(e)
+            if index is None or index >= len(commands):
+                return [self._failed(cmd_name, e) for cmd_name, *_ in commands]
+            # MPD stopped at the failing command: run the other ones again
+            # without it.
+            if missing is not None and \
+               command_error_code(e) == ACK_ERROR_NO_EXIST:
+                failed = missing
+            else:
+                failed = self._failed(commands[index][0], e)
+            return (self._batch(commands[:index], missing=missing) +
+                    [failed] +
+                    self._batch(commands[index + 1:], missing=missing))
+        except (socket.error, mpd.ConnectionError) as e:
+            if retry and self._reconnect('batch'):
+                return self._batch(commands, retry=False, missing=missing)
+            return [self._failed(cmd_name, e) for cmd_name, *_ in commands]
+        except mpd.MPDError as e:
+            return [self._failed(cmd_name, e) for cmd_name, *_ in commands]
+
+        return [self._convert(cmd_name, retval)
+                for (cmd_name, *_), retval in zip(commands, retvals)]
+
+    def connect(self, host, port):
+        if self._workers is not None:
+            self._workers.close()
+        self.host = host
+        self.port = port
+        self._password = None
+        if self._async is not None:
+            self._async.connect(host, port)
+        try:
+            return self._client.connect(host, port)
+        except (socket.error, mpd.MPDError) as e:
+            # Not connected again automatically: the server is unreachable
+            self.host = None
+            self.port = None
+            return self._failed('connect', e)
+
+    def disconnect(self):
+        if self._workers is not None:
+            self._workers.close()
+        if self._async is not None:
+            self._async.close()
+        # Not connected again until connect() is called
+        self.host = None
+        self.port = None
+        return self._call(self._client.disconnect, 'disconnect')
+
+    def password(self, password):
+        self._password = password
+        if self._async is not None:
+            self._async.connect(self.host, self.port, password)
+        return self._call(self._client.password, 'password', password)
+
+    def clone(self):
+        """Return a new client, connected to the same server as this one.
+
+        This is useful to run long requests from another thread, since a
+        client can't be shared between threads.
+        """
+        client = MPDClient()
+        client.connect(self.host, self.port)
+        if self._password:
+            client.password(self._password)
+        return client
+
+    def worker(self):
+        """Return a context manager giving a worker connection.
+
+        Worker connections are connected to the same server as this client,
+        and are meant to run heavy requests (like 'listallinfo' or 'search')
+        from other threads, without delaying the requests of this one. They
+        reconnect automatically, and are shared through a small pool:
+
+        with self.mpd.worker() as client:
+            items = client.listallinfo('/')
+        """
+        if self._workers is None:
+            self._workers = MPDWorkerPool(self)
+        return self._workers.worker()
+
+    def request(self, cmd_name, *args, callback=None, timeout=None):
+        """Send a command without waiting for MPD, see mpdasync.
+
+        Returns an mpdasync.MPDRequest, which can be cancelled. `callback` is
+        called later from the main loop, with the result of the command
+        converted like for the other commands. If python-mpd2 is too old to
+        provide an asyncio client, the command is run right away instead.
+        """
+        if not mpdasync.available():
+            result = getattr(self, cmd_name)(*args)
+            request = mpdasync.MPDRequest()
+
+            def done():
+                if not request.cancelled and callback is not None:
+                    callback(result)
+                return False
+            GLib.idle_add(done)
+            return request
+
+        if self._async is None:
+            self._async = mpdasync.MPDAsyncClient(self._convert, self._failed)
+            self._async.connect(self.host, self.port, self._password)
+        return self._async.call(cmd_name, *args, callback=callback,
+                                timeout=timeout)
+
     @property
     def version(self):
         return tuple(int(part) for part in self._client.mpd_version.split("."))
 
     def update(self, paths):
+        """Update the directories of `paths`, and return them."""
         if mpd_is_updating(self.status()):
-            return
+            return []
 
         # Updating paths seems to be faster than updating files for
         # some reason:
@@ -73,6 +268,152 @@ class MPDClient:
         for directory in dirs:
             self._client.update(directory)
         self._client.command_list_end()
+        return dirs
+
+
+class MPDWorkerPool:
+    """Worker connections cloned from a client, see MPDClient.worker().
+
+    At most `max_connections` minus RESERVED_CONNECTIONS (and never more than
+    MAX_WORKERS) connections are opened; further requests for a worker wait
+    until one is released. If the server refuses a connection (it allows
+    fewer connections), the pool is reduced to the connections already opened.
+    """
+
+    def __init__(self, client, max_connections=MAX_CONNECTIONS):
+        self._client = client
+        self.max_workers = max(1, min(MAX_WORKERS,
+                                      max_connections - RESERVED_CONNECTIONS))
+        self._idle = []
+        self._busy = 0
+        # Incremented when the workers have to be thrown away
+        self._generation = 0
+        self._cond = threading.Condition()
+        self.logger = logging.getLogger(__name__)
+
+    @contextlib.contextmanager
+    def worker(self):
+        client, generation = self._acquire()
+        try:
+            yield client
+        finally:
+            self._release(client, generation)
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._busy >= self.max_workers:
+                self._cond.wait()
+            self._busy += 1
+            client = self._idle.pop() if self._idle else None
+            generation = self._generation
+        if client is None:
+            client = self._client.clone()
+            # The worker connects again when used, if it failed
+            if client.ping() is None:
+                self._refused()
+        return client, generation
+
+    def _refused(self):
+        with self._cond:
+            opened = self._busy - 1 + len(self._idle)
+            self.max_workers = max(1, min(self.max_workers, opened))
+        self.logger.info(
+            "MPD refused a connection, using %d workers", self.max_workers)
+
+    def _release(self, client, generation):
+        with self._cond:
+            self._busy -= 1
+            keep = generation == self._generation and \
+                    self._busy + len(self._idle) < self.max_workers
+            if keep:
+                self._idle.append(client)
+            self._cond.notify()
+        if not keep:
+            client.disconnect()
+
+    def close(self):
+        """Disconnect the workers: the busy ones are disconnected once
+        released."""
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+            self._generation += 1
+        for client in idle:
+            client.disconnect()
+
+
+class MPDIdleWatcher:
+    """Keep a dedicated connection waiting for changes with MPD's 'idle'.
+
+    Each time MPD reports a change, `callback` is called from the main loop
+    with the list of the changed subsystems (eg. ['player', 'mixer']). If the
+    connection is lost, `callback` is called with None and the watcher stops.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.logger = logging.getLogger(__name__)
+        self._client = None
+        self._watch_id = None
+
+    @property
+    def watching(self):
+        return self._watch_id is not None
+
+    def start(self, host, port, password=None):
+        self.stop()
+        client = mpd.MPDClient(use_unicode=True)
+        try:
+            client.connect(host, port)
+            if password:
+                client.password(password)
+            client.send_idle()
+        except (socket.error, mpd.MPDError) as e:
+            self.logger.info("Unable to watch for MPD changes: %s", e)
+            self._disconnect(client)
+            return False
+
+        self._client = client
+        self._watch_id = GLib.io_add_watch(
+            client.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_ERR | GLib.IO_HUP, self._on_changes)
+        return True
+
+    def stop(self):
+        if self._watch_id is not None:
+            GLib.source_remove(self._watch_id)
+            self._watch_id = None
+        if self._client is not None:
+            self._disconnect(self._client)
+            self._client = None
+
+    def _disconnect(self, client):
+        try:
+            client.disconnect()
+        except (socket.error, mpd.MPDError):
+            pass
+
+    def _on_changes(self, _source, condition):
+        changes = None
+        if not condition & (GLib.IO_ERR | GLib.IO_HUP):
+            try:
+                changes = self._client.fetch_idle()
+                # Wait for the next changes right away, so we don't miss any
+                self._client.send_idle()
+            except (socket.error, mpd.MPDError) as e:
+                self.logger.info("Lost the MPD idle connection: %s", e)
+                changes = None
+
+        if changes is None:
+            # Returning False removes the watch by itself
+            self._watch_id = None
+            self.stop()
+            self.callback(None)
+            return False
+
+        self.logger.debug("MPD changes: %s", ", ".join(changes))
+        self.callback(changes)
+        return True
 
 
 class MPDCount:
@@ -85,76 +426,171 @@ class MPDCount:
         self.songs = int(m['songs'])
 
 
-# Inherits from GObject for to be stored in Gtk's ListStore
-class MPDSong(GObject.GObject):
-    """Provide information about a song in a convenient format"""
+# Tags whose values are shared by many songs: their values are interned, so
+# that each one is stored only once.
+INTERNED_TAGS = frozenset(['artist', 'album', 'albumartist', 'genre', 'date',
+                           'composer', 'performer', 'disc', 'last-modified'])
+
+# Tags of the songs -> tag -> position of its value. Songs coming from MPD
+# only use a few different sets of tags, which are shared between songs.
+_song_keys = {}
+
+
+class MPDSong:
+    """Provide information about a song in a convenient format
+
+    Songs are stored in a compact form: the names of the tags are shared
+    between songs, and only a tuple of values is kept per song. Numeric
+    fields are only converted when they are read. Songs can be stored in Gtk
+    models using GObject.TYPE_PYOBJECT columns.
+
+    Some tags may be present several times (eg. several artists): accessing
+    them returns the first value, and get_values() returns all of them.
+    """
+
+    __slots__ = ['_keys', '_values']
 
     def __init__(self, mapping):
-        self._mapping = {}
+        keys = tuple(mapping)
+        try:
+            self._keys = _song_keys[keys]
+        except KeyError:
+            self._keys = _song_keys[keys] = dict(
+                (key, i) for i, key in enumerate(keys))
+        values = []
         for key, value in mapping.items():
             # Some attributes may be present several times, which is translated
-            # into a list of values by python-mpd. We keep only the first one,
-            # since Sonata doesn't really support multi-valued attributes at the
-            # moment.
-            if isinstance(value, list):
-                value = value[0]
-            self._mapping[key] = value
-        super().__init__()
+            # into a list of values by python-mpd. They are kept as a tuple,
+            # single values are kept as is.
+            if isinstance(value, (list, tuple)):
+                if key in INTERNED_TAGS:
+                    value = tuple(sys.intern(v) for v in value)
+                else:
+                    value = tuple(value)
+                if len(value) == 1:
+                    value = value[0]
+            elif key in INTERNED_TAGS:
+                value = sys.intern(value)
+            values.append(value)
+        self._values = tuple(values)
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and \
-                self._mapping == other._mapping
+                dict(self.items()) == dict(other.items())
 
     def __ne__(self, other):
         return not (self == other)
 
+    __hash__ = None
+
     def __contains__(self, key):
-        return key in self._mapping
+        return key in self._keys
 
     def __getitem__(self, key):
         if key not in self:
             raise KeyError(key)
         return self.get(key)
 
+    def _get(self, key, alt=None):
+        i = self._keys.get(key)
+        if i is None:
+            return alt
+        value = self._values[i]
+        return value[0] if isinstance(value, tuple) else value
+
+    def get_values(self, key):
+        """Return all the values of `key`, as a tuple."""
+        i = self._keys.get(key)
+        if i is None:
+            return ()
+        value = self._values[i]
+        return value if isinstance(value, tuple) else (value,)
+
     def get(self, key, alt=None):
-        if key in self._mapping and hasattr(self, key):
+        if key in self._keys and hasattr(self.__class__, key):
             return getattr(self, key)
         else:
-            return self._mapping.get(key, alt)
+            return self._get(key, alt)
 
     def __getattr__(self, attr):
         # Get the attribute's value directly into the internal mapping.
         # This function is not called if the current object has a "real"
         # attribute set.
-        return self._mapping.get(attr)
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return self._get(attr)
+
+    def keys(self):
+        return self._keys.keys()
 
     def values(self):
-        return self._mapping.values()
+        # Multi-valued tags give all their values
+        values = []
+        for value in self._values:
+            if isinstance(value, tuple):
+                values.extend(value)
+            else:
+                values.append(value)
+        return values
+
+    def items(self):
+        return zip(self._keys, self._values)
 
     @property
     def id(self):
-        return int(self._mapping.get('id', 0))
+        return int(self._get('id', 0))
 
     @property
     def track(self):
-        return cleanup_numeric(self._mapping.get('track', '0'))
+        return cleanup_numeric(self._get('track', '0'))
 
     @property
     def pos(self):
-        v = self._mapping.get('pos', '0')
+        v = self._get('pos', '0')
         return int(v) if v.isdigit() else 0
 
     @property
     def time(self):
-        return int(self._mapping.get('time', 0))
+        return int(self._get('time', 0))
 
     @property
     def disc(self):
-        return cleanup_numeric(self._mapping.get('disc', 0))
+        return cleanup_numeric(self._get('disc', 0))
 
     @property
     def file(self):
-        return self._mapping.get('file', '') # XXX should be always here?
+        return self._get('file', '') # XXX should be always here?
+
+def get_values(item, key):
+    """Return all the values of `key` in `item` as a tuple.
+
+    `item` is an MPDSong, or a mapping as returned by python-mpd, where tags
+    present several times are lists.
+    """
+    if isinstance(item, MPDSong):
+        return item.get_values(key)
+    value = item.get(key)
+    if value is None:
+        return ()
+    elif isinstance(value, (list, tuple)):
+        return tuple(value)
+    else:
+        return (value,)
+
+def command_error_index(error):
+    """Return the index of the failing command in a command list error.
+
+    MPD errors look like "[50@3] {find} No such song", where 3 is the index of
+    the command which failed in the command list.
+    """
+    match = re.search(r'\[\d+@(\d+)\]', str(error))
+    return int(match.group(1)) if match else None
+
+def command_error_code(error):
+    """Return the error code of an MPD error, like 50 for "[50@3] {find} No
+    such song"."""
+    match = re.search(r'\[(\d+)@\d+\]', str(error))
+    return int(match.group(1)) if match else None
 
 def cleanup_numeric(value):
     # track and disc can be oddly formatted (eg, '4/10')
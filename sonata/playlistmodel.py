@@ -0,0 +1,472 @@
+"""
+This module implements the model used to display MPD's current playlist.
+
+Only the ids of the songs are kept for the whole playlist: the songs
+themselves are requested to MPD with 'playlistinfo', a range of positions at
+a time, when their rows are displayed, and only the most recently used ones
+are kept. Displayed rows are requested without waiting for MPD: they are
+empty until the songs arrive. The length of all the songs, needed for the
+total playtime, is loaded in the background and then maintained as the
+playlist changes.
+
+To filter the playlist, the formatted columns of all the songs are kept, and
+updated as the playlist changes. They are requested without waiting for MPD
+too, the first time or after changes: the results of the search come then
+later.
+
+Example usage:
+from sonata.playlistmodel import PlaylistModel
+model = PlaylistModel(self.mpd, self.columnformat, self.on_times_changed)
+model.update(self.mpd.plchangesposid(version), length)
+treeview.set_model(model)
+...
+song = model.get_song(row)
+playtime = model.total_time
+model.search("foo bar", show_songs)
+"""
+
+from array import array
+import collections
+import re
+
+from gi.repository import Gtk, GObject, Pango
+
+from sonata import formatting, misc
+from sonata.mpdhelper import MPDSong
+
+
+# Number of rows requested at once to display them
+FETCH_SIZE = 200
+# Number of rows requested at once to get their length, in the background
+TIMES_FETCH_SIZE = 1000
+# Number of songs kept in memory
+CACHE_SIZE = 2000
+# Maximum number of songs requested one by one to search them, the whole
+# playlist is requested above or the first time
+SEARCH_FETCH_SIZE = 100
+
+
+class PlaylistModel(GObject.Object, Gtk.TreeModel):
+    """Lazy Gtk.TreeModel of the current playlist.
+
+    The first column contains the MPDSong of each row, followed by one
+    column per part of `columnformat`, and the font weight of the row.
+    `times_changed` is called when the total playtime changed after the
+    length of some songs has been loaded.
+    """
+
+    def __init__(self, mpd, columnformat, times_changed=None, previous=None):
+        super().__init__()
+        self.mpd = mpd
+        self.columnformat = columnformat
+        self.times_changed = times_changed
+        self._types = [GObject.TYPE_PYOBJECT] + \
+                [GObject.TYPE_STRING] * len(columnformat) + \
+                [GObject.TYPE_INT]
+
+        # Song ids and lengths (-1 if unknown) of all the rows
+        self._ids = array('L')
+        self._times = array('l')
+        self.total_time = 0
+        self._unknown_times = 0
+        # No unknown length before this position
+        self._unknown_start = 0
+        self._times_request = None
+        # song id -> (song, formatted columns), most recent last
+        self._cache = collections.OrderedDict()
+        # First row of the ranges being requested -> their MPDRequest
+        self._fetch_requests = {}
+        self.bold_row = -1
+        # song id -> lowercased formatted columns, for search()
+        self._search_texts = {}
+        # Last search: (text, ids of the matching songs)
+        self._last_search = None
+        # Search waiting for the songs to be loaded: (text, callback)
+        self._search_pending = None
+        self._search_requests = []
+        # Changed each time the playlist changes, while songs are loaded
+        self._generation = 0
+
+        if previous is not None:
+            # Same playlist, displayed with another format
+            self._ids = array('L', previous._ids)
+            self._times = array('l', previous._times)
+            self.total_time = previous.total_time
+            self._unknown_times = previous._unknown_times
+            self._unknown_start = previous._unknown_start
+            self.bold_row = previous.bold_row
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get_song_id(self, row):
+        return self._ids[row]
+
+    def get_song(self, row):
+        """Return the song of the row `row`, requesting it if needed."""
+        return self._get_row(row)[0]
+
+    def get_iter_song_id(self, treeiter):
+        return self._ids[self._row(treeiter)]
+
+    def _get_row(self, row):
+        song_id = self._ids[row]
+        try:
+            self._cache.move_to_end(song_id)
+            return self._cache[song_id]
+        except KeyError:
+            pass
+        self._fetch(row - row % FETCH_SIZE,
+                    min(row - row % FETCH_SIZE + FETCH_SIZE, len(self)))
+        try:
+            return self._cache[song_id]
+        except KeyError:
+            # The playlist changed meanwhile, or we are disconnected
+            return MPDSong({'file': '', 'id': str(song_id)}), None
+
+    def _fetch(self, start, end):
+        self._add_songs(self.mpd.playlistinfo("%d:%d" % (start, end)) or [])
+
+    def _fetch_later(self, row):
+        # Requests the range of `row` without waiting for MPD
+        start = row - row % FETCH_SIZE
+        if start in self._fetch_requests:
+            return
+        end = min(start + FETCH_SIZE, len(self))
+
+        def loaded(songs):
+            if self._fetch_requests.get(start) is request:
+                del self._fetch_requests[start]
+            for pos in self._add_songs(songs or []):
+                self.row_changed(Gtk.TreePath(pos), self._iter(pos))
+
+        request = self.mpd.request('playlistinfo', "%d:%d" % (start, end),
+                                   callback=loaded)
+        self._fetch_requests[start] = request
+
+    def _add_songs(self, songs):
+        # Keeps the songs still in the playlist, returns their positions
+        positions = []
+        rows = formatting.render_columns(self.columnformat, songs, True)
+        for song, items in zip(songs, rows):
+            pos = song.pos
+            if pos < len(self) and self._ids[pos] == song.id:
+                self._cache[song.id] = (song, items)
+                positions.append(pos)
+                if self._times[pos] < 0:
+                    self._set_time(pos, song.time)
+        while len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return positions
+
+    def _format_row(self, row):
+        # Called to display the row: never waits for MPD
+        song_id = self._ids[row]
+        try:
+            self._cache.move_to_end(song_id)
+            return self._cache[song_id][1]
+        except KeyError:
+            self._fetch_later(row)
+            return [''] * len(self.columnformat)
+
+    def _set_time(self, pos, time):
+        old_time = self._times[pos]
+        if old_time < 0:
+            self._unknown_times -= 1
+        else:
+            self.total_time -= old_time
+        self._times[pos] = time
+        if time < 0:
+            self._unknown_times += 1
+            self._unknown_start = min(self._unknown_start, pos)
+        else:
+            self.total_time += time
+
+    def update(self, changes, length):
+        """Apply the changes returned by 'plchangesposid'.
+
+        The playlist contains now `length` songs.
+        """
+        old_length = len(self)
+        changed = dict((int(change['cpos']), int(change['id']))
+                       for change in changes)
+
+        # Songs moving around keep their length
+        old_times = {}
+        for pos in range(length, old_length):
+            old_times[self._ids[pos]] = self._times[pos]
+            self._set_time(pos, 0)
+        for pos in changed:
+            if pos < old_length and pos < length:
+                old_times[self._ids[pos]] = self._times[pos]
+        del self._ids[length:]
+        del self._times[length:]
+        if length > old_length:
+            self._ids.extend([0] * (length - old_length))
+            self._times.extend([0] * (length - old_length))
+
+        for pos, song_id in changed.items():
+            if pos >= length:
+                continue
+            if pos < old_length and self._ids[pos] == song_id:
+                # Same song at the same place: its tags changed
+                self._cache.pop(song_id, None)
+                self._search_texts.pop(song_id, None)
+                time = -1
+            else:
+                time = old_times.get(song_id, -1)
+            self._ids[pos] = song_id
+            self._set_time(pos, time)
+
+        for pos in range(old_length - 1, length - 1, -1):
+            self.row_deleted(Gtk.TreePath(pos))
+        for pos in sorted(changed):
+            if pos < min(old_length, length):
+                self.row_changed(Gtk.TreePath(pos), self._iter(pos))
+        for pos in range(old_length, length):
+            self.row_inserted(Gtk.TreePath(pos), self._iter(pos))
+
+        if self.bold_row >= length:
+            self.bold_row = -1
+        self._last_search = None
+        self._generation += 1
+        self.load_times()
+
+    def clear(self):
+        # The rows are removed one at a time, from the last one, so that the
+        # model has always the rows given by the signals
+        while self._ids:
+            self._ids.pop()
+            self._times.pop()
+            self.row_deleted(Gtk.TreePath(len(self._ids)))
+        # We may be connected to another server now, with other songs
+        for request in self._fetch_requests.values():
+            request.cancel()
+        self._fetch_requests = {}
+        for request in self._search_requests:
+            request.cancel()
+        self._search_requests = []
+        self._search_pending = None
+        self._generation += 1
+        self._cache.clear()
+        self._search_texts = {}
+        self._last_search = None
+        self._ids = array('L')
+        self._times = array('l')
+        self.total_time = 0
+        self._unknown_times = 0
+        self._unknown_start = 0
+        self.bold_row = -1
+
+    def remove(self, treeiter):
+        """Remove a row, to reflect a change sent to MPD."""
+        pos = self._row(treeiter)
+        self._set_time(pos, 0)
+        del self._ids[pos]
+        del self._times[pos]
+        self._unknown_start = min(self._unknown_start, pos)
+        if self.bold_row == pos:
+            self.bold_row = -1
+        elif self.bold_row > pos:
+            self.bold_row -= 1
+        self.row_deleted(Gtk.TreePath(pos))
+
+    def move(self, pos, new_pos):
+        """Move a row, to reflect a change sent to MPD."""
+        song_id = self._ids[pos]
+        time = self._times[pos]
+        del self._ids[pos]
+        del self._times[pos]
+        self._ids.insert(new_pos, song_id)
+        self._times.insert(new_pos, time)
+        self._unknown_start = min(self._unknown_start, pos, new_pos)
+        self.row_deleted(Gtk.TreePath(pos))
+        self.row_inserted(Gtk.TreePath(new_pos), self._iter(new_pos))
+
+    def set_bold_row(self, row):
+        """Show the row `row` in bold, -1 for none."""
+        previous = self.bold_row
+        self.bold_row = row
+        for pos in (previous, row):
+            if 0 <= pos < len(self):
+                self.row_changed(Gtk.TreePath(pos), self._iter(pos))
+
+    def search(self, text, callback):
+        """Find the songs matching `text`, and call `callback` with their ids.
+
+        The words of `text` have to be found in this order, case
+        insensitively, in one of the formatted columns of the songs. If some
+        songs have to be requested first, `callback` is called later from
+        the main loop, unless another search is started meanwhile.
+        """
+        texts = self._search_texts
+        missing = [song_id for song_id in self._ids if song_id not in texts]
+        if not missing:
+            self._search_pending = None
+            callback(self._search(text))
+            return
+        loading = self._search_pending is not None and \
+                any(not request.done for request in self._search_requests)
+        self._search_pending = (text, callback)
+        if not loading:
+            self._search_load(missing)
+
+    def _search(self, text):
+        regex = re.escape(misc.escape_html(text))
+        regex = re.compile(regex.replace(' ', ' .*').lower())
+        if self._last_search is not None and \
+           text.startswith(self._last_search[0]):
+            # The query is narrowed: only the previous results can match
+            song_ids = self._last_search[1]
+        else:
+            song_ids = self._ids
+        texts = self._search_texts
+        result = set(song_id for song_id in song_ids
+                     if regex.search(texts.get(song_id, '')))
+        self._last_search = (text, result)
+        return result
+
+    def _search_load(self, missing):
+        # Requests the songs `missing` without waiting for MPD: the whole
+        # playlist, or the missing songs one by one
+        if not self._search_texts or len(missing) > SEARCH_FETCH_SIZE:
+            commands = [('playlistinfo',)]
+        else:
+            commands = [('playlistid', song_id) for song_id in missing]
+        generation = self._generation
+        songs = []
+        remaining = len(commands)
+
+        def loaded(result):
+            nonlocal remaining
+            songs.extend(result or [])
+            remaining -= 1
+            if remaining == 0:
+                self._on_search_loaded(songs, generation)
+
+        self._search_requests = [self.mpd.request(*command, callback=loaded)
+                                 for command in commands]
+
+    def _on_search_loaded(self, songs, generation):
+        pending = self._search_pending
+        if pending is None:
+            return
+        self._search_pending = None
+        if generation != self._generation:
+            # The playlist changed meanwhile, the songs changed are requested
+            # again
+            self.search(*pending)
+            return
+        texts = self._search_texts
+        rows = formatting.render_columns(self.columnformat, songs, True)
+        for song, items in zip(songs, rows):
+            # The columns are searched separately
+            texts[song.id] = "\n".join(items).lower()
+        if len(texts) > 2 * len(self):
+            # Forget the songs removed from the playlist
+            self._search_texts = dict((song_id, texts[song_id])
+                                      for song_id in self._ids
+                                      if song_id in texts)
+        text, callback = pending
+        callback(self._search(text))
+
+    def load_times(self):
+        """Request the length of the songs we don't know yet."""
+        if self._times_request is not None or self._unknown_times == 0:
+            return
+        # Only the positions after the last known length are searched
+        start = self._times.index(-1, self._unknown_start)
+        self._unknown_start = start
+        end = min(start + TIMES_FETCH_SIZE, len(self))
+        self._times_request = self.mpd.request(
+            'playlistinfo', "%d:%d" % (start, end),
+            callback=self._on_times_loaded)
+
+    def _on_times_loaded(self, songs):
+        self._times_request = None
+        loaded = False
+        for song in songs or []:
+            pos = song.pos
+            if pos < len(self) and self._ids[pos] == song.id and \
+               self._times[pos] < 0:
+                self._set_time(pos, song.time)
+                loaded = True
+        if self.times_changed is not None:
+            self.times_changed()
+        if loaded:
+            self.load_times()
+
+    # Gtk.TreeModel implementation. Iters keep the row number + 1 (so that
+    # the first row isn't NULL).
+
+    def _iter(self, row):
+        treeiter = Gtk.TreeIter()
+        treeiter.user_data = row + 1
+        return treeiter
+
+    def _row(self, treeiter):
+        return treeiter.user_data - 1
+
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY
+
+    def do_get_n_columns(self):
+        return len(self._types)
+
+    def do_get_column_type(self, column):
+        return self._types[column]
+
+    def do_get_iter(self, path):
+        row = path.get_indices()[0]
+        if 0 <= row < len(self):
+            return True, self._iter(row)
+        return False, None
+
+    def do_get_path(self, treeiter):
+        return Gtk.TreePath(self._row(treeiter))
+
+    def do_get_value(self, treeiter, column):
+        row = self._row(treeiter)
+        if not 0 <= row < len(self):
+            return self._types[column] == GObject.TYPE_INT and 0 or None
+        if column == 0:
+            return self.get_song(row)
+        elif column == len(self._types) - 1:
+            weight = Pango.Weight.BOLD if row == self.bold_row \
+                    else Pango.Weight.NORMAL
+            return int(weight)
+        else:
+            return self._format_row(row)[column - 1]
+
+    def do_iter_next(self, treeiter):
+        row = self._row(treeiter) + 1
+        if row < len(self):
+            treeiter.user_data = row + 1
+            return True
+        return False
+
+    def do_iter_previous(self, treeiter):
+        row = self._row(treeiter) - 1
+        if row >= 0:
+            treeiter.user_data = row + 1
+            return True
+        return False
+
+    def do_iter_children(self, parent):
+        if parent is None and len(self) > 0:
+            return True, self._iter(0)
+        return False, None
+
+    def do_iter_has_child(self, treeiter):
+        return False
+
+    def do_iter_n_children(self, treeiter):
+        return len(self) if treeiter is None else 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and 0 <= n < len(self):
+            return True, self._iter(n)
+        return False, None
+
+    def do_iter_parent(self, child):
+        return False, None
@@ -43,6 +43,7 @@ class Playlists:
         self.mergepl_id = None
         self.actionGroupPlaylists = None
         self.playlist_name_dialog = None
+        self.populate_request = None
 
         self.builder = ui.builder('playlists')
 
@@ -191,10 +192,18 @@ class Playlists:
         return plname
 
     def populate(self):
+        if self.connected():
+            # Only the most recent list is interesting
+            if self.populate_request is not None:
+                self.populate_request.cancel()
+            self.populate_request = self.mpd.request(
+                'listplaylists', callback=self.populate_playlists)
+
+    def populate_playlists(self, playlists):
+        self.populate_request = None
         if self.connected():
             self.playlistsdata.clear()
             playlistinfo = []
-            playlists = self.mpd.listplaylists()
             if playlists is None:
                 playlists = self.mpd.lsinfo()
             for item in playlists:
@@ -0,0 +1,223 @@
+"""
+This module reorders MPD's current playlist with as few commands as possible.
+
+Instead of moving each song to its new position, the songs which are already
+in the right order relative to each other (the longest increasing subsequence
+of their new positions) are left in place, and the other ones are moved by
+ranges: songs which follow each other in both orders are moved together with
+one 'move START:END TO' command. Reversing the playlist only needs half as
+many 'swap' commands as songs.
+
+Example usage:
+from sonata import playlistsort
+moves = playlistsort.sort_moves([2, 0, 1, 3])
+...
+status, songs = client.batch([('status',), ('playlistinfo',)])
+commands = playlistsort.sort_commands(songs, key)
+request = playlistsort.SortRequest(len(commands))
+playlistsort.send_commands(client, commands, progress=self.on_progress,
+                           cancelled=lambda: request.cancelled,
+                           version=int(status['playlist']))
+"""
+
+import bisect
+import logging
+
+
+# Number of commands sent at once in a command list: MPD answers them
+# together, so that the client doesn't wait for each of them.
+SEND_SIZE = 500
+
+logger = logging.getLogger(__name__)
+
+
+def increasing_subsequence(values):
+    """Return the positions of a longest increasing subsequence of `values`.
+
+    >>> sorted(increasing_subsequence([3, 0, 4, 1, 2]))
+    [1, 3, 4]
+    """
+    # tails[i]: smallest last value of an increasing subsequence of length
+    # i + 1, found at positions[i]
+    tails = []
+    positions = []
+    previous = [-1] * len(values)
+    for pos, value in enumerate(values):
+        i = bisect.bisect_left(tails, value)
+        if i == len(tails):
+            tails.append(value)
+            positions.append(pos)
+        else:
+            tails[i] = value
+            positions[i] = pos
+        if i > 0:
+            previous[pos] = positions[i - 1]
+
+    result = set()
+    pos = positions[-1] if positions else -1
+    while pos >= 0:
+        result.add(pos)
+        pos = previous[pos]
+    return result
+
+
+class _Counter:
+    # Fenwick tree counting the songs present at each (sorted) key
+
+    def __init__(self, size):
+        self._tree = [0] * (size + 1)
+
+    def add(self, index, value):
+        index += 1
+        while index < len(self._tree):
+            self._tree[index] += value
+            index += index & -index
+
+    def count_before(self, index):
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+
+def sort_moves(new_positions):
+    """Return the moves sorting a playlist, as (start, end, to) tuples.
+
+    `new_positions` gives for each song of the playlist its position once
+    sorted (it is a permutation of range(len(new_positions))). Each move
+    takes the songs from `start` to `end` (excluded) and puts them at the
+    position `to` of the resulting playlist, like MPD's 'move' command. The
+    moves have to be applied in this order.
+
+    >>> sort_moves([1, 2, 0])
+    [(2, 3, 0)]
+    >>> sort_moves([0, 3, 4, 1, 2])
+    [(1, 3, 3)]
+    """
+    length = len(new_positions)
+    kept = increasing_subsequence(new_positions)
+    old_positions = [0] * length
+    for pos, new_pos in enumerate(new_positions):
+        old_positions[new_pos] = pos
+
+    # Songs not kept in place are moved by runs of songs following each
+    # other in both orders, right after the last kept song sorted before
+    # them (the anchor, -1 for the start of the playlist). Runs are moved in
+    # their new order, so the songs sorted between the anchor and a run have
+    # always been moved there already.
+    runs = []
+    anchor = -1
+    new_pos = 0
+    while new_pos < length:
+        pos = old_positions[new_pos]
+        if pos in kept:
+            anchor = pos
+            new_pos += 1
+            continue
+        size = 1
+        while new_pos + size < length and pos + size < length and \
+              new_positions[pos + size] == new_pos + size and \
+              pos + size not in kept:
+            size += 1
+        runs.append((pos, size, anchor, new_pos))
+        new_pos += size
+
+    # The position of a song in the playlist being sorted is the number of
+    # songs before it. Songs are ordered by keys: (old position, 0, 0) before
+    # being moved, and (anchor, 1, new position) after that, packed in ints.
+    def key(pos, moved=0, new_pos=0):
+        return ((pos + 1) * 2 + moved) * (length + 1) + new_pos
+
+    keys = [key(pos) for pos in range(length)]
+    for pos, size, anchor, new_pos in runs:
+        keys.extend(key(anchor, 1, new_pos + i) for i in range(size))
+    keys.sort()
+    index = dict((k, i) for i, k in enumerate(keys))
+    counter = _Counter(len(keys))
+    for pos in range(length):
+        counter.add(index[key(pos)], 1)
+
+    moves = []
+    for pos, size, anchor, new_pos in runs:
+        start = counter.count_before(index[key(pos)])
+        for i in range(size):
+            counter.add(index[key(pos + i)], -1)
+        to = counter.count_before(index[key(anchor, 1, new_pos)])
+        for i in range(size):
+            counter.add(index[key(anchor, 1, new_pos + i)], 1)
+        if start != to:
+            moves.append((start, start + size, to))
+    return moves
+
+
+def _move_commands(moves):
+    return [('move', "%d:%d" % (start, end), to) for start, end, to in moves]
+
+
+def sort_commands(songs, key):
+    """Return the 'move' commands sorting the playlist `songs` on `key`.
+
+    `key` gives the sort key of a song (see sortkeys.song_key()). Equal songs
+    keep their order.
+
+    >>> sort_commands(['b', 'c', 'a'], key=str)
+    [('move', '2:3', 0)]
+    """
+    order = sorted(range(len(songs)), key=lambda pos: key(songs[pos]))
+    new_positions = [0] * len(songs)
+    for new_pos, pos in enumerate(order):
+        new_positions[pos] = new_pos
+    return _move_commands(sort_moves(new_positions))
+
+
+def reverse_commands(length):
+    """Return the 'swap' commands reversing a playlist of `length` songs.
+
+    >>> reverse_commands(5)
+    [('swap', 0, 4), ('swap', 1, 3)]
+    """
+    return [('swap', pos, length - 1 - pos) for pos in range(length // 2)]
+
+
+class SortRequest:
+    """Commands reordering the playlist, being sent from a thread.
+
+    `total` is 0 until the commands are known.
+    """
+
+    def __init__(self, total=0):
+        self.total = total
+        self.sent = 0
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop sending the commands (the ones sent aren't undone)."""
+        self.cancelled = True
+
+
+def send_commands(client, commands, progress=None, cancelled=None,
+                  version=None):
+    """Send `commands` with `client`, SEND_SIZE commands at a time.
+
+    `commands` are tuples like for MPDClient.batch(). `progress` is called
+    with the number of commands sent and the total after each command list.
+    Returns False if `cancelled` returned True before all commands were sent.
+
+    The commands refer to positions in the playlist: if `version`, the
+    version of the playlist they were computed from, is given, they are only
+    sent as long as nobody else changed the playlist (each command changes
+    the version once), and False is returned otherwise.
+    """
+    for start in range(0, len(commands), SEND_SIZE):
+        if cancelled is not None and cancelled():
+            return False
+        if version is not None:
+            status = client.status() or {}
+            if status.get('playlist') != str(version + start):
+                logger.info("The playlist changed, stopping the sort")
+                return False
+        client.batch(commands[start:start + SEND_SIZE])
+        if progress is not None:
+            progress(min(start + SEND_SIZE, len(commands)), len(commands))
+    return True
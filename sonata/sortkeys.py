@@ -0,0 +1,145 @@
+"""
+This module builds the keys used to sort songs on their tags.
+
+A sort is described by a list of fields, like "albumartist, date, disc,
+track": the songs are compared on the first field, then on the next ones
+when they are equal. The keys are computed from the raw values of the tags,
+compared as numbers, durations or (cached) collation keys depending on the
+field, and the songs without a value for a field are put at the end.
+
+Example usage:
+from sonata import sortkeys
+fields = sortkeys.parse_spec("albumartist, date, disc, track")
+songs.sort(key=sortkeys.song_key(fields))
+...
+fields = sortkeys.column_spec(self.columnformat[col_num - 1])
+"""
+
+import os
+
+from sonata import misc
+from sonata import mpdhelper as mpdh
+
+
+# Tags compared as numbers (eg. '4/10' for a track is 4)
+NUMERIC_FIELDS = frozenset(['track', 'disc', 'pos', 'id', 'prio'])
+# Tags compared as numbers of seconds
+DURATION_FIELDS = frozenset(['time', 'duration'])
+# Tags compared without their leading "The"
+NAME_FIELDS = frozenset(['artist', 'albumartist', 'composer', 'performer'])
+# Tags compared as is
+RAW_FIELDS = frozenset(['date', 'originaldate'])
+# Tag used when a song has no value for another one
+FALLBACK_FIELDS = {'albumartist': 'artist', 'title': 'filename'}
+# Other names of the fields
+ALIASES = {'year': 'date', 'length': 'time', 'tracknumber': 'track',
+           'discnumber': 'disc', 'dirfile': 'file', 'path': 'dirname'}
+
+# Fields used to sort the format codes of a column (see formatting)
+FORMAT_CODE_FIELDS = {'A': 'artist', 'B': 'album', 'T': 'title', 'N': 'track',
+                      'D': 'disc', 'Y': 'date', 'G': 'genre', 'P': 'dirname',
+                      'F': 'filename', 'S': 'name', 'L': 'time'}
+
+# Key of the songs without a value, after all the other ones
+_MISSING = (1,)
+
+
+def parse_spec(spec):
+    """Return the fields of `spec`, like "album-artist, date, disc, track".
+
+    >>> parse_spec("Album-Artist, year,disc, track ")
+    ('albumartist', 'date', 'disc', 'track')
+    """
+    fields = []
+    for field in spec.split(','):
+        field = field.strip().lower().replace('-', '').replace('_', '')
+        if field:
+            fields.append(ALIASES.get(field, field))
+    return tuple(fields)
+
+
+def column_spec(format):
+    """Return the fields sorting the column displaying `format`.
+
+    >>> column_spec("%N. %T {(%L)}")
+    ('track', 'title', 'time')
+    """
+    fields = []
+    for i, code in enumerate(format.split('%')):
+        field = FORMAT_CODE_FIELDS.get(code[:1]) if i > 0 else None
+        if field is not None and field not in fields:
+            fields.append(field)
+    return tuple(fields)
+
+
+def _getter(field):
+    # Function returning the first value of `field` in a song, including the
+    # fields computed from the file name
+    if field in ('filename', 'dirname'):
+        path_func = os.path.basename if field == 'filename' \
+                else os.path.dirname
+
+        def get(item):
+            values = mpdh.get_values(item, 'file')
+            return path_func(values[0]) if values else None
+    else:
+        def get(item):
+            values = mpdh.get_values(item, field)
+            return values[0] if values else None
+    return get
+
+
+def _field_key(field):
+    # Function returning the key of a song for `field`
+    get = _getter(field)
+    fallback = FALLBACK_FIELDS.get(field)
+    get_fallback = _getter(fallback) if fallback is not None else None
+    if field in NUMERIC_FIELDS:
+        convert = mpdh.cleanup_numeric
+    elif field in DURATION_FIELDS:
+        def convert(value):
+            try:
+                return float(value)
+            except ValueError:
+                return 0
+    elif field in NAME_FIELDS:
+        def convert(value):
+            return misc.collation_key(misc.lower_no_the(value))
+    elif field in RAW_FIELDS:
+        convert = str
+    else:
+        def convert(value):
+            return misc.collation_key(value.lower())
+
+    def key(item):
+        value = get(item)
+        if value is None and get_fallback is not None:
+            value = get_fallback(item)
+        if value is None or value == '':
+            return _MISSING
+        return (0, convert(value))
+    return key
+
+
+def song_key(fields):
+    """Return a function giving the sort key of a song for `fields`.
+
+    Songs are MPDSongs or mappings as returned by python-mpd.
+
+    >>> songs = [{'track': '10'}, {'track': '9/12'}, {}]
+    >>> [song.get('track') for song in sorted(songs,
+    ...                                       key=song_key(('track',)))]
+    ['9/12', '10', None]
+    """
+    keys = [_field_key(field) for field in fields]
+    if len(keys) == 1:
+        return keys[0]
+
+    def key(item):
+        return tuple([field_key(item) for field_key in keys])
+    return key
+
+
+def sort_songs(songs, fields):
+    """Return `songs` sorted on `fields`, keeping the order of equal songs."""
+    return sorted(songs, key=song_key(fields))
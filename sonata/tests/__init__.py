@@ -1,12 +1,22 @@
 #!/usr/bin/python
 
+import asyncio
 import doctest
 import unittest
 import gettext
+import locale
 import os
+import socket
 import sys
 import operator
 
+try:
+    from unittest.mock import Mock, call, ANY
+except ImportError: # pragma: nocover
+    from mock import Mock, call, ANY
+
+import mpd
+
 # This currently needed, because gettext is used in some module, i want to test
 try:
     gettext.install('sonata', os.path.join(sonata.__file__.split('/lib')[0], 'share', 'locale'))
@@ -14,8 +24,9 @@ except:
     gettext.install('sonata', '/usr/share/locale')
     gettext.textdomain('sonata')
 
-from sonata import misc, song, library
-from sonata.mpdhelper import MPDSong
+from sonata import misc, song, library, mpdasync, formatting
+from sonata.playlistmodel import PlaylistModel
+from sonata.mpdhelper import MPDClient, MPDCount, MPDSong, MPDWorkerPool
 
 DOCTEST_FLAGS = (
     doctest.ELLIPSIS |
@@ -27,6 +38,26 @@ class TestSonata(unittest.TestCase):
     def test_convert_time(self):
         self.assertEqual(misc.convert_time(60*4+4), "04:04")
         self.assertEqual(misc.convert_time(3600*3+60*2), "03:02:00")
+    def test_memoize_stats(self):
+        misc.memoize_clear()
+        self.assertEqual(misc.escape_html("a & b"), "a &amp; b")
+        self.assertEqual(misc.escape_html("a & b"), "a &amp; b")
+        self.assertEqual(misc.lower_no_the("The Band"), "band")
+        stats = misc.memoize_stats()
+        self.assertEqual((1, 1), (stats['escape_html'].hits,
+                                  stats['escape_html'].misses))
+        self.assertEqual((0, 1), (stats['lower_no_the'].hits,
+                                  stats['lower_no_the'].misses))
+    def test_collation_key(self):
+        self.assertEqual(misc.collation_key("b"), locale.strxfrm("b"))
+        self.assertEqual(['a', 'B', 'c'],
+                         sorted(['c', 'B', 'a'],
+                                key=lambda s: misc.collation_key(s.lower())))
+        self.assertGreater(misc.memoize_stats()['strxfrm'].currsize, 0)
+        # The keys are computed again when the locale changes
+        misc.collation_reset()
+        misc.collation_key("b")
+        self.assertEqual(1, misc.memoize_stats()['strxfrm'].currsize)
     def test_song_record(self):
         record_first = song.SongRecord("a", "a", "a", "a", "a")
         record_equal = song.SongRecord(artist="a", path="b")
@@ -114,9 +145,383 @@ class TestMPDSong(unittest.TestCase):
         self.assertEqual('a', song.genre)
         self.assertEqual('c', song.foo)
 
+    def test_multi_valued_attribute(self):
+        song = MPDSong({'artist': ['a', 'b'], 'album': 'c'})
+        self.assertEqual(('a', 'b'), song.get_values('artist'))
+        self.assertEqual(('c',), song.get_values('album'))
+        self.assertEqual((), song.get_values('genre'))
+        self.assertEqual(['a', 'b', 'c'], song.values())
+        self.assertEqual('c', song._values[1])
+
+    def test_format_multi_valued_attribute(self):
+        song = MPDSong({'artist': ['a', 'b'], 'file': 'f.ogg'})
+        self.assertEqual("a, b - f.ogg",
+                         formatting.parse("%A - %T", song, False))
+        self.assertEqual("a, b", formatting.parse("%A", {'artist': ['a', 'b']},
+                                                  False))
+
+    def test_songs_share_their_keys(self):
+        song1 = MPDSong({'file': 'a', 'artist': 'foo'})
+        song2 = MPDSong({'file': 'b', 'artist': 'foo'})
+        self.assertIs(song1._keys, song2._keys)
+        self.assertFalse(hasattr(song1, '__dict__'))
+        self.assertEqual([('file', 'b'), ('artist', 'foo')], list(song2.items()))
+
+    def test_equality(self):
+        self.assertEqual(MPDSong({'file': 'a', 'id': '1'}),
+                         MPDSong({'id': '1', 'file': 'a'}))
+        self.assertNotEqual(MPDSong({'file': 'a'}), MPDSong({'file': 'b'}))
+
+
+class TestFormatting(unittest.TestCase):
+    def test_brackets(self):
+        song = {'artist': 'a', 'file': 'dir/f.ogg', 'time': '70'}
+        self.assertEqual("a - f.ogg (01:10)", formatting.parse(
+            "%A - %T{ [%B]} {(%L)}", song, False))
+        self.assertEqual("{a}", formatting.parse("{{%A}}", song, False))
+        self.assertEqual("x &amp; a{", formatting.parse("{x} & %A{", song,
+                                                        True))
+
+    def test_compiled_format(self):
+        songs = [{'artist': 'a', 'file': 'f.ogg'}, {'file': 'b.ogg'}]
+        compiled = formatting.compile_format("%A: {%B }%T")
+        self.assertIs(compiled, formatting.compile_format("%A: {%B }%T"))
+        self.assertEqual(["a: f.ogg", "Unknown: b.ogg"],
+                         compiled.render_many(songs, True))
+        self.assertEqual([formatting.parse("%A: {%B }%T", song, True)
+                          for song in songs],
+                         compiled.render_many(songs, True))
+
+    def test_render_columns(self):
+        songs = [{'artist': 'a&b', 'file': 'f.ogg', 'time': '70'},
+                 {'artist': 'a&b', 'file': 'g.ogg'}]
+        self.assertEqual([["a&amp;b", "f.ogg (01:10)"],
+                          ["a&amp;b", "g.ogg"]],
+                         formatting.render_columns(["%A", "%T{ (%L)}"],
+                                                   songs, True))
+
+
+class TestMPDClientBatch(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.mpd = MPDClient(self.client)
+
+    def test_batch_results_are_converted(self):
+        self.client.command_list_end.return_value = [
+            {'songs': '2', 'playtime': '10'},
+            ['a', 'b'],
+        ]
+
+        res = self.mpd.batch([('count', 'artist', 'a'), ('list', 'album')])
+
+        self.assertIsInstance(res[0], MPDCount)
+        self.assertEqual(2, res[0].songs)
+        self.assertEqual(['a', 'b'], res[1])
+        self.client.count.assert_called_once_with('artist', 'a')
+        self.client.list.assert_called_once_with('album')
+
+    def test_batch_error_is_isolated(self):
+        # MPD stops at the second command, the others are sent again
+        self.client.command_list_end.side_effect = [
+            mpd.CommandError("[50@1] {list} unknown tag"),
+            [{'songs': '1', 'playtime': '1'}],
+            [{'songs': '3', 'playtime': '3'}],
+        ]
+
+        res = self.mpd.batch([('count', 'artist', 'a'), ('list', 'foo'),
+                              ('count', 'artist', 'b')])
+
+        self.assertEqual(3, len(res))
+        self.assertEqual(1, res[0].songs)
+        self.assertEqual([], res[1])
+        self.assertEqual(3, res[2].songs)
+
+    def test_batch_missing(self):
+        self.client.command_list_end.side_effect = [
+            mpd.CommandError("[50@0] {listallinfo} No such directory"),
+            mpd.CommandError("[5@0] {listallinfo} unknown command"),
+        ]
+        res = self.mpd.batch([('listallinfo', 'a'), ('listallinfo', 'b')],
+                             missing=[])
+        self.assertEqual([[], None], res)
+
+    def test_empty_batch(self):
+        self.assertEqual([], self.mpd.batch([]))
+        self.assertFalse(self.client.command_list_ok_begin.called)
+
+
+class TestMPDClientReconnect(unittest.TestCase):
+    def setUp(self):
+        self.client = Mock()
+        self.mpd = MPDClient(self.client)
+        self.mpd.connect('localhost', 6600)
+        self.client.status.side_effect = [mpd.ConnectionError("Not connected"),
+                                          {'state': 'play'}]
+
+    def test_auto_reconnect(self):
+        self.assertEqual({'state': 'play'}, self.mpd.status())
+        self.assertEqual(2, self.client.connect.call_count)
+
+    def test_no_reconnection(self):
+        self.mpd.auto_reconnect = False
+        self.assertEqual({}, self.mpd.status())
+        self.assertEqual(1, self.client.connect.call_count)
+
+    def test_no_reconnection_after_disconnect(self):
+        self.mpd.disconnect()
+        self.assertEqual({}, self.mpd.status())
+        self.assertEqual(1, self.client.connect.call_count)
+
+    def test_no_reconnection_after_failed_connect(self):
+        self.client.connect.side_effect = socket.error("refused")
+        self.assertIsNone(self.mpd.connect('localhost', 6600))
+        self.assertEqual({}, self.mpd.status())
+        self.assertEqual(2, self.client.connect.call_count)
+
+
+class TestMPDWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.mpd = Mock()
+        self.mpd.clone.side_effect = lambda: Mock()
+        self.pool = MPDWorkerPool(self.mpd, max_connections=3)
+
+    def test_workers_are_reused(self):
+        with self.pool.worker() as client1:
+            pass
+        with self.pool.worker() as client2:
+            pass
+        self.assertIs(client1, client2)
+        self.assertEqual(1, self.pool.max_workers)
+
+    def test_refused_connections(self):
+        self.pool.max_workers = 3
+        with self.pool.worker() as client1:
+            with self.pool.worker() as client2:
+                client3 = Mock()
+                client3.ping.return_value = None
+                self.mpd.clone.side_effect = [client3]
+                with self.pool.worker() as worker:
+                    self.assertIs(client3, worker)
+                self.assertEqual(2, self.pool.max_workers)
+        client3.disconnect.assert_called_once_with()
+        client1.disconnect.assert_not_called()
+        client2.disconnect.assert_not_called()
+
+    def test_close(self):
+        with self.pool.worker() as client1:
+            self.pool.close()
+        client1.disconnect.assert_called_once_with()
+        with self.pool.worker() as client2:
+            pass
+        self.assertIsNot(client1, client2)
+
+
+class FakeAsyncioClient:
+    connected = True
+
+    async def status(self):
+        return {'state': 'play'}
+
+    async def count(self, *args):
+        return {'songs': '2', 'playtime': '10'}
+
+    async def listallinfo(self, *args):
+        await asyncio.sleep(1)
+
+
+class TestMPDAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.orig_client = mpdasync.AsyncioMPDClient
+        mpdasync.AsyncioMPDClient = FakeAsyncioClient
+        mpd = MPDClient(Mock())
+        self.client = mpdasync.MPDAsyncClient(mpd._convert, mpd._failed)
+
+    def tearDown(self):
+        mpdasync.AsyncioMPDClient = self.orig_client
+
+    def run_command(self, *args, **kwargs):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                self.client.command(*args, **kwargs))
+        finally:
+            loop.close()
+
+    def test_results_are_converted(self):
+        self.assertEqual({'state': 'play'}, self.run_command('status'))
+        res = self.run_command('count', 'artist', 'foo')
+        self.assertIsInstance(res, MPDCount)
+        self.assertEqual(2, res.songs)
+
+    def test_timeout(self):
+        self.assertIsNone(self.run_command('listallinfo', timeout=0.01))
+
+
+class TestPlaylistModel(unittest.TestCase):
+    def setUp(self):
+        self.songs = [self.song(i, pos) for pos, i in enumerate([5, 6, 7])]
+        self.mpd = Mock()
+        self.mpd.playlistinfo.side_effect = self.playlistinfo
+        # The requests are answered by the tests
+        self.mpd.request.return_value.done = False
+        self.model = PlaylistModel(self.mpd, ['%T'])
+        self.model.update(self.changes(), 3)
+
+    def song(self, song_id, pos):
+        return MPDSong({'id': str(song_id), 'pos': str(pos),
+                        'file': 'f.ogg', 'title': 'Song %d' % song_id,
+                        'time': str(song_id * 10)})
+
+    def changes(self, start=0):
+        return [{'cpos': str(s.pos), 'id': str(s.id)}
+                for s in self.songs[start:]]
+
+    def playlistinfo(self, songrange=None):
+        if songrange is None:
+            return self.songs
+        start, end = (int(i) for i in songrange.split(':'))
+        return self.songs[start:end]
+
+    def playlistid(self, song_id):
+        return [song for song in self.songs if song.id == song_id]
+
+    def load_times(self):
+        args, kwargs = self.mpd.request.call_args
+        kwargs['callback'](self.playlistinfo(args[1]))
+
+    def search(self, text):
+        # Answers the requests of the search, if any
+        results = []
+        self.mpd.request.reset_mock()
+        self.model.search(text, results.append)
+        for args, kwargs in self.mpd.request.call_args_list:
+            self.assertEqual([], results)
+            kwargs['callback'](getattr(self, args[0])(*args[1:]))
+        self.assertEqual(1, len(results))
+        return results[0]
+
+    def test_songs_are_requested_by_range(self):
+        self.assertEqual(3, len(self.model))
+        self.assertEqual(6, self.model.get_song(1).id)
+        self.assertEqual(7, self.model.get_song(2).id)
+        self.assertEqual(['Song 7'], self.model._format_row(2))
+        self.mpd.playlistinfo.assert_called_once_with('0:3')
+
+    def test_displayed_rows_are_requested_later(self):
+        # The lengths are already requested
+        self.mpd.request.reset_mock()
+        self.assertEqual([''], self.model._format_row(1))
+        self.assertEqual([''], self.model._format_row(2))
+        self.mpd.playlistinfo.assert_not_called()
+        self.assertEqual(1, self.mpd.request.call_count)
+        args, kwargs = self.mpd.request.call_args
+        self.assertEqual(('playlistinfo', '0:3'), args)
+        self.model.row_changed = Mock()
+        kwargs['callback'](self.playlistinfo(args[1]))
+        self.assertEqual(3, self.model.row_changed.call_count)
+        self.assertEqual(['Song 7'], self.model._format_row(2))
+        self.assertEqual(1, self.mpd.request.call_count)
+
+    def test_clear_forgets_the_songs(self):
+        self.assertEqual({5, 6, 7}, self.search("song"))
+        self.assertEqual(5, self.model.get_song(0).id)
+        self.model.clear()
+        self.songs = [MPDSong({'id': '5', 'pos': '0', 'file': 'g.ogg',
+                               'title': 'Other'})]
+        self.model.update(self.changes(), 1)
+        self.assertEqual('g.ogg', self.model.get_song(0).file)
+        self.assertEqual({5}, self.search("other"))
+
+    def test_clear_removes_the_rows_one_by_one(self):
+        lengths = []
+        self.model.row_deleted = lambda path: lengths.append(len(self.model))
+        self.model.clear()
+        self.assertEqual([2, 1, 0], lengths)
+
+    def test_total_time(self):
+        self.assertEqual(0, self.model.total_time)
+        self.load_times()
+        self.assertEqual(180, self.model.total_time)
+
+    def test_update_keeps_known_times(self):
+        self.load_times()
+        # Remove the first song
+        self.songs = [self.song(i, pos) for pos, i in enumerate([6, 7])]
+        self.model.update(self.changes(), 2)
+        self.assertEqual(130, self.model.total_time)
+        self.assertEqual(6, self.model.get_song_id(0))
+        # Add a song at the end, its length is requested
+        self.songs.append(self.song(8, 2))
+        self.model.update(self.changes(2), 3)
+        self.assertEqual(130, self.model.total_time)
+        self.load_times()
+        self.assertEqual(210, self.model.total_time)
+
+    def test_unknown_lengths_are_requested_again(self):
+        self.load_times()
+        self.songs[1] = self.song(9, 1)
+        self.model.update(self.changes(1)[:1], 3)
+        self.assertEqual(120, self.model.total_time)
+        self.assertEqual('1:3', self.mpd.request.call_args[0][1])
+        self.load_times()
+        self.assertEqual(210, self.model.total_time)
+
+    def test_move_and_remove(self):
+        self.load_times()
+        self.model.move(0, 2)
+        self.assertEqual([6, 7, 5], [self.model.get_song_id(i)
+                                     for i in range(3)])
+        self.model.remove(self.model._iter(1))
+        self.assertEqual([6, 5], [self.model.get_song_id(i)
+                                  for i in range(2)])
+        self.assertEqual(110, self.model.total_time)
+
+    def test_search(self):
+        self.assertEqual({5, 6, 7}, self.search("song"))
+        self.assertEqual({6}, self.search("song 6"))
+        self.assertEqual(set(), self.search("6 song"))
+        self.mpd.request.assert_not_called()
+
+    def test_search_after_changes(self):
+        self.assertEqual({7}, self.search("7"))
+        # Change the tags of the last song, and add another one
+        self.songs[2] = MPDSong({'id': '7', 'pos': '2', 'file': 'f.ogg',
+                                 'title': 'Other'})
+        self.songs.append(self.song(17, 3))
+        self.model.update(self.changes(2), 4)
+        self.assertEqual({17}, self.search("7"))
+        # Only the changed songs are requested again
+        self.assertEqual([call('playlistid', 7, callback=ANY),
+                          call('playlistid', 17, callback=ANY)],
+                         self.mpd.request.call_args_list)
+
+    def test_search_waits_for_the_songs(self):
+        results = []
+        self.model.search("song", results.append)
+        self.model.search("song 6", results.append)
+        args, kwargs = self.mpd.request.call_args
+        self.assertEqual(('playlistinfo',), args)
+        # The playlist changes before the songs arrive
+        self.songs.append(self.song(16, 3))
+        self.model.update(self.changes(3), 4)
+        self.mpd.request.reset_mock()
+        kwargs['callback'](self.songs[:3])
+        self.assertEqual([], results)
+        args, kwargs = self.mpd.request.call_args
+        self.assertEqual(('playlistinfo',), args)
+        kwargs['callback'](self.songs)
+        # Only the last search gets its results
+        self.assertEqual([{6, 16}], results)
+
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(
         'sonata.artwork',
         optionflags=DOCTEST_FLAGS))
+    tests.addTests(doctest.DocTestSuite(
+        'sonata.playlistsort',
+        optionflags=DOCTEST_FLAGS))
+    tests.addTests(doctest.DocTestSuite(
+        'sonata.sortkeys',
+        optionflags=DOCTEST_FLAGS))
     return tests
@@ -2,17 +2,23 @@ from os.path import expanduser
 import unittest
 
 try:
-    from unittest.mock import Mock, patch, call
+    from unittest.mock import Mock, patch, call, ANY
 except ImportError: # pragma: nocover
-    from mock import Mock, patch, call
+    from mock import Mock, patch, call, ANY
 
 import os
+import queue
 import shutil
 import tempfile
+import threading
 
 from sonata.artwork import artwork_path
 from sonata.artwork import ArtworkLocator
+from sonata.artwork import ArtworkCache
+from sonata.artwork import DirectoryCache
+from sonata.artwork import ArtworkLoader
 from sonata import consts
+from sonata.song import SongRecord
 
 
 class _MixinTestDirectory:
@@ -260,6 +266,24 @@ class TestArtworkLocatorPathChecks(_MixinTestDirectory, unittest.TestCase):
         res = self.locator.locate('Toto', 'Tata', 'To/Ta')
         self.assertEqual((self.config.art_location, folder_path), res)
 
+    def test_locate_lists_directories_once(self):
+        self.mkdir('To', 'Ta')
+        self.config.art_location = consts.ART_LOCATION_COVER
+        directories = DirectoryCache()
+        locator = ArtworkLocator(self.config, directories)
+
+        self.assertEqual((None, None), locator.locate('Toto', 'Tata', 'To/Ta'))
+        scans = directories.counters['scandir']
+        self.assertEqual((None, None), locator.locate('Toto', 'Tata', 'To/Ta'))
+        self.assertEqual(scans, directories.counters['scandir'])
+
+        # The directory changed
+        cover_path = self.touch('To', 'Ta', 'cover.jpg')
+        os.utime(os.path.join(self.music_dir, 'To', 'Ta'), ns=(0, 0))
+        self.assertEqual((consts.ART_LOCATION_COVER, cover_path),
+                         locator.locate('Toto', 'Tata', 'To/Ta'))
+        self.assertEqual(scans + 1, directories.counters['scandir'])
+
     def test_locate_nothing_valid(self):
         self.mkdir('To', 'Ta')
         self.config.art_location = consts.ART_LOCATION_COVER
@@ -267,3 +291,204 @@ class TestArtworkLocatorPathChecks(_MixinTestDirectory, unittest.TestCase):
         res = self.locator.locate('Toto', 'Tata', 'To/Ta')
 
         self.assertEqual((None, None), res)
+
+
+def _pixbuf(option=None):
+    pixbuf = Mock(name='pixbuf')
+    pixbuf.get_rowstride.return_value = 40
+    pixbuf.get_height.return_value = 10
+    pixbuf.get_option.return_value = option
+    return pixbuf
+
+
+@patch('sonata.artwork.img.do_style_cover', lambda config, p, w, h: p)
+@patch('sonata.artwork.GLib', Mock(GError=ValueError))
+@patch('sonata.artwork.GdkPixbuf')
+class TestArtworkCachePixbufs(_MixinTestDirectory, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = Mock('Config', covers_type=consts.COVERS_TYPE_STANDARD)
+        self.thumbnails_dir = os.path.join(self.music_dir, 'thumbnails')
+        self.cache = self.new_cache()
+        self.cover = self.touch('cover.jpg')
+        self.key = ('Foo', 'Bar')
+        self.cache.set(self.key, self.cover)
+
+    def new_cache(self, max_bytes=1000):
+        return ArtworkCache(self.config, os.path.join(self.music_dir, 'cache'),
+                            thumbnails_dir=self.thumbnails_dir,
+                            max_bytes=max_bytes)
+
+    def test_pixbufs_are_kept(self, GdkPixbuf):
+        GdkPixbuf.Pixbuf.new_from_file_at_size.side_effect = \
+                lambda *args: _pixbuf()
+        pixbuf = self.cache.get_pixbuf(self.key, 100)
+        self.assertIs(pixbuf, self.cache.get_pixbuf(self.key, 100))
+        self.assertEqual(1, GdkPixbuf.Pixbuf.new_from_file_at_size.call_count)
+
+        # The file changed: only checked on request
+        os.utime(self.cover, (0, 0))
+        self.assertIs(pixbuf, self.cache.get_pixbuf(self.key, 100))
+        pixbuf = self.cache.get_pixbuf(self.key, 100, check=True)
+        self.assertEqual(2, GdkPixbuf.Pixbuf.new_from_file_at_size.call_count)
+        self.assertIs(pixbuf, self.cache.get_pixbuf(self.key, 100,
+                                                    check=True))
+
+    def test_pixbufs_are_found_without_the_database(self, GdkPixbuf):
+        GdkPixbuf.Pixbuf.new_from_file_at_size.side_effect = \
+                lambda *args: _pixbuf()
+        pixbuf = self.cache.get_pixbuf(self.key, 100)
+        with patch.object(self.cache, 'get') as get, \
+             patch('sonata.artwork.os.stat') as stat:
+            self.assertIs(pixbuf, self.cache.get_pixbuf(self.key, 100))
+        get.assert_not_called()
+        stat.assert_not_called()
+
+    def test_pixbufs_are_forgotten_when_the_file_changes(self, GdkPixbuf):
+        GdkPixbuf.Pixbuf.new_from_file_at_size.side_effect = \
+                lambda *args: _pixbuf()
+        pixbuf = self.cache.get_pixbuf(self.key, 100)
+        other = self.touch('other.jpg')
+        self.cache.set(self.key, other)
+        self.assertIsNot(pixbuf, self.cache.get_pixbuf(self.key, 100))
+        self.cache.remove(self.key)
+        self.assertEqual('default', self.cache.get_pixbuf(self.key, 100,
+                                                          'default'))
+
+    def test_least_recently_used_pixbufs_are_dropped(self, GdkPixbuf):
+        GdkPixbuf.Pixbuf.new_from_file_at_size.side_effect = \
+                lambda *args: _pixbuf()
+        self.cache.max_bytes = 800
+        pixbufs = [self.cache.get_pixbuf(self.key, size)
+                   for size in (100, 101, 102)]
+        self.assertIs(pixbufs[2], self.cache.get_pixbuf(self.key, 102))
+        self.assertIs(pixbufs[1], self.cache.get_pixbuf(self.key, 101))
+        self.assertIsNot(pixbufs[0], self.cache.get_pixbuf(self.key, 100))
+
+    def test_missing_file(self, GdkPixbuf):
+        os.remove(self.cover)
+        self.assertEqual('default', self.cache.get_pixbuf(self.key, 100,
+                                                          'default'))
+        self.assertIsNone(self.cache.get(self.key))
+
+    def test_thumbnails(self, GdkPixbuf):
+        GdkPixbuf.Pixbuf.new_from_file.side_effect = ValueError
+        GdkPixbuf.Pixbuf.new_from_file_at_size.return_value = _pixbuf()
+        self.cache.get_pixbuf(self.key, consts.LIB_COVER_SIZE)
+        mtime = str(int(os.stat(self.cover).st_mtime))
+        GdkPixbuf.Pixbuf.new_from_file_at_size.return_value.savev.\
+                assert_called_once_with(ANY, "png", ["tEXt::Thumb::MTime"],
+                                        [mtime])
+        self.assertEqual(1, len(os.listdir(self.thumbnails_dir)))
+
+        # The thumbnail is used by the next sessions
+        self.cache.save()
+        cache = self.new_cache()
+        cache.set(self.key, self.cover)
+        GdkPixbuf.Pixbuf.new_from_file.side_effect = None
+        GdkPixbuf.Pixbuf.new_from_file.return_value = thumbnail = \
+                _pixbuf(mtime)
+        self.assertIs(thumbnail, cache.get_pixbuf(self.key,
+                                                  consts.LIB_COVER_SIZE))
+        self.assertEqual(1, GdkPixbuf.Pixbuf.new_from_file_at_size.call_count)
+
+    def test_thumbnails_are_removed_with_their_file(self, GdkPixbuf):
+        GdkPixbuf.Pixbuf.new_from_file.side_effect = ValueError
+        GdkPixbuf.Pixbuf.new_from_file_at_size.return_value = _pixbuf()
+        self.cache.get_pixbuf(self.key, consts.LIB_COVER_SIZE)
+        self.assertEqual(1, len(os.listdir(self.thumbnails_dir)))
+        os.remove(self.cover)
+        self.assertIsNone(self.cache.get_pixbuf(self.key,
+                                                consts.LIB_COVER_SIZE,
+                                                check=True))
+        self.assertEqual([], os.listdir(self.thumbnails_dir))
+
+    def test_least_recently_used_thumbnails_are_removed(self, GdkPixbuf):
+        os.mkdir(self.thumbnails_dir)
+        for i in range(4):
+            path = os.path.join(self.thumbnails_dir, "%d.png" % i)
+            with open(path, 'wb') as f:
+                f.write(b'x' * 100)
+            os.utime(path, (1000 - i, 1000 - i))
+        self.cache.thumbnails_bytes = 250
+        self.cache.compact()
+        self.assertEqual(['0.png', '1.png'],
+                         sorted(os.listdir(self.thumbnails_dir)))
+        self.cache.compact()
+        self.assertEqual(2, len(os.listdir(self.thumbnails_dir)))
+
+
+class TestArtworkCache(_MixinTestDirectory, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.music_dir, 'art_cache.db')
+        self.legacy_path = os.path.join(self.music_dir, 'art_cache')
+        self.cache = self.new_cache()
+
+    def new_cache(self):
+        cache = ArtworkCache(self.config, self.path, self.legacy_path)
+        cache.load()
+        return cache
+
+    def test_set_and_get(self):
+        key = SongRecord(artist='Foo', album='Bar', path='Foo/Bar')
+        self.assertIsNone(self.cache.get(key))
+        self.cache.set(key, '/covers/foo.jpg')
+        self.assertEqual('/covers/foo.jpg', self.cache.get(key))
+        self.assertIsNone(self.cache.get(key._replace(path='Foo')))
+        self.cache.remove(key)
+        self.assertIsNone(self.cache.get(key))
+
+    def test_saved_entries_are_kept(self):
+        key = SongRecord(artist='Foo', album='Bar')
+        self.cache.set(key, '/covers/foo.jpg')
+        self.cache.save()
+        self.assertEqual('/covers/foo.jpg', self.new_cache().get(key))
+
+    def test_legacy_cache_is_imported(self):
+        key = SongRecord(artist='Foo', album='Bar', path='Foo/Bar')
+        with open(self.legacy_path, 'w', encoding="utf8") as f:
+            f.write(repr({key: '/covers/foo.jpg'}))
+        self.assertEqual('/covers/foo.jpg', self.new_cache().get(key))
+        self.assertFalse(os.path.exists(self.legacy_path))
+
+    def test_legacy_cache_is_not_evaluated(self):
+        with open(self.legacy_path, 'w', encoding="utf8") as f:
+            f.write("{SongRecord(album=os.remove('x')): 'foo'}")
+        with patch('os.remove') as remove:
+            self.new_cache()
+        self.assertNotIn(call('x'), remove.call_args_list)
+
+
+class TestArtworkLoader(unittest.TestCase):
+    def setUp(self):
+        self.loaded = queue.Queue()
+        self.blocked = threading.Event()
+        self.unblock = threading.Event()
+        self.loader = ArtworkLoader(self.load, 1, "Test")
+
+    def load(self, key, priority, rows):
+        if key == 'block':
+            self.blocked.set()
+            self.unblock.wait()
+        self.loaded.put((key, rows))
+
+    def wait_loaded(self, count):
+        return [self.loaded.get(timeout=5) for i in range(count)]
+
+    def test_urgent_requests_first_and_once(self):
+        self.loader.schedule([(0, 'block', 0)])
+        self.blocked.wait(5)
+        self.loader.schedule([(3, 'c', 1), (2, 'b', 2), (1, 'a', 3),
+                              (4, 'b', 4)], cancel=False)
+        self.unblock.set()
+        self.assertEqual([('block', [0]), ('a', [3]), ('b', [2, 4]),
+                          ('c', [1])], self.wait_loaded(4))
+
+    def test_requests_are_cancelled(self):
+        self.loader.schedule([(0, 'block', 0), (1, 'a', 1)])
+        self.blocked.wait(5)
+        self.loader.schedule([(0, 'b', 2)])
+        self.unblock.set()
+        self.assertEqual([('block', [0]), ('b', [2])], self.wait_loaded(2))
+        self.assertTrue(self.loaded.empty())
@@ -0,0 +1,136 @@
+import os
+import tempfile
+import unittest
+
+from sonata.libraryindex import LibraryIndex
+
+
+SONGS = [
+    {'directory': 'A'},
+    {'file': 'A/1.ogg', 'artist': 'Foo', 'album': 'Bar', 'genre': 'Rock',
+     'date': '2001', 'title': 'One', 'time': '100'},
+    {'file': 'A/2.ogg', 'artist': 'foo', 'album': 'Bar', 'genre': 'Rock',
+     'date': '2001', 'title': 'Two', 'time': '200'},
+    {'file': 'B/1.ogg', 'artist': 'Baz', 'album': 'Qux', 'genre': 'Jazz',
+     'time': '50'},
+    {'file': 'C/1.ogg', 'artist': ['Multi', 'Other'], 'time': '10'},
+    {'playlist': 'foo.m3u'},
+]
+
+
+class TestLibraryIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = LibraryIndex()
+        self.index.add_songs(SONGS)
+
+    def test_directories_and_playlists_are_skipped(self):
+        self.assertEqual(4, len(self.index))
+
+    def test_select_is_case_insensitive(self):
+        self.assertEqual([0, 1], self.index.select(artist='FOO'))
+
+    def test_select_several_tags(self):
+        self.assertEqual([0, 1], self.index.select(genre='rock', album='bar'))
+        self.assertEqual([], self.index.select(genre='rock', album='qux'))
+
+    def test_select_alternatives(self):
+        self.assertEqual([2, 3], self.index.select(date=('Untagged', '')))
+
+    def test_select_any_value(self):
+        self.assertEqual([3], self.index.select(artist='other'))
+        self.assertEqual([3], self.index.select(artist='multi'))
+
+    def test_select_without_filters(self):
+        self.assertEqual([0, 1, 2, 3], self.index.select(artist=None))
+
+    def test_count(self):
+        ids = self.index.select(artist='foo')
+        self.assertEqual((300, 2), self.index.count(ids))
+
+    def test_values(self):
+        self.assertEqual(['Foo', 'Baz', 'Multi', 'Other'],
+                         self.index.values('artist', self.index.select()))
+        self.assertEqual(['Bar'],
+                         self.index.values('album', self.index.select()[:2]))
+
+    def test_rows(self):
+        rows = list(self.index.rows('album', 'file'))
+        self.assertEqual(('Bar', 'A/1.ogg'), rows[0])
+        self.assertEqual(('', 'C/1.ogg'), rows[3])
+
+    def test_song(self):
+        song = self.index.song(2)
+        self.assertEqual('B/1.ogg', song.file)
+        self.assertEqual('Baz', song.artist)
+        self.assertEqual(50, song.time)
+        self.assertNotIn('date', song)
+        self.assertEqual(('Multi', 'Other'),
+                         self.index.song(3).get_values('artist'))
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'index')
+            key = {'host': 'localhost', 'port': 6600, 'db_update': '42'}
+            self.assertTrue(self.index.save(path, key))
+            loaded_key, index = LibraryIndex.load(path)
+
+        self.assertEqual(key, loaded_key)
+        self.assertEqual(len(self.index), len(index))
+        self.assertEqual([0, 1], index.select(artist='FOO', genre='rock'))
+        self.assertEqual(list(self.index.rows('file', 'title', 'date')),
+                         list(index.rows('file', 'title', 'date')))
+        self.assertEqual((360, 4), index.count(index.select()))
+        self.assertEqual([3], index.select(artist='other'))
+        self.assertEqual(('Multi', 'Other'), index.song(3).get_values('artist'))
+
+    def test_load_invalid_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'index')
+            self.assertEqual((None, None), LibraryIndex.load(path))
+            with open(path, 'wb') as f:
+                f.write(b"garbage")
+            self.assertEqual((None, None), LibraryIndex.load(path))
+
+    def test_select_dirs(self):
+        self.assertEqual([0, 1, 2], self.index.select_dirs(['A', 'B/']))
+        self.assertEqual([], self.index.select_dirs(['A/1.ogg']))
+
+    def test_remove_songs(self):
+        self.index.remove_songs([0, 2])
+        self.assertEqual(2, len(self.index))
+        self.assertEqual([1], self.index.select(artist='other'))
+        self.assertEqual(('Multi', 'Other'),
+                         self.index.song(1).get_values('artist'))
+        self.assertEqual([0], self.index.select(artist='foo'))
+        self.assertEqual([], self.index.select(genre='jazz'))
+        self.assertEqual([('A/2.ogg',), ('C/1.ogg',)],
+                         list(self.index.rows('file')))
+        self.assertEqual((210, 2), self.index.count(self.index.select()))
+
+    def test_search(self):
+        self.assertEqual([0, 1], self.index.search('artist', ['FO']))
+        self.assertEqual([3], self.index.search('artist', ['her']))
+        self.assertEqual([0], self.index.search('any', ['one', 'bar']))
+        self.assertEqual([0], self.index.search('any', ['bar', 'one', '']))
+        self.assertEqual([], self.index.search('title', ['one', 'bar']))
+        self.assertEqual([0, 2, 3], self.index.search('file', ['.ogg', '1']))
+        self.assertEqual([0, 1, 2], self.index.search('album', ['']))
+
+    def test_search_after_changes(self):
+        self.assertEqual([2], self.index.search('any', ['jazz']))
+        self.index.remove_songs([0])
+        self.assertEqual([1], self.index.search('any', ['jazz']))
+        self.index.add_songs([{'file': 'D/1.ogg', 'genre': 'Acid Jazz'}])
+        self.assertEqual([1, 3], self.index.search('any', ['jazz']))
+
+    def test_copy(self):
+        self.assertEqual([2], self.index.search('any', ['jazz']))
+        copy = self.index.copy()
+        copy.remove_songs([0])
+        copy.add_songs([{'file': 'D/1.ogg', 'genre': 'Acid Jazz'}])
+        self.assertEqual([1, 3], copy.search('any', ['jazz']))
+        self.assertEqual([3], copy.select(genre='acid jazz'))
+        self.assertEqual(4, len(self.index))
+        self.assertEqual([2], self.index.search('any', ['jazz']))
+        self.assertEqual([], self.index.select(genre='acid jazz'))
+        self.assertEqual([0, 1], self.index.select(genre='rock'))
@@ -0,0 +1,100 @@
+import random
+import unittest
+from unittest.mock import Mock
+
+from sonata import playlistsort
+
+
+def apply_moves(playlist, moves):
+    playlist = list(playlist)
+    for start, end, to in moves:
+        songs = playlist[start:end]
+        del playlist[start:end]
+        playlist[to:to] = songs
+    return playlist
+
+
+class TestPlaylistSort(unittest.TestCase):
+    def assertSorts(self, new_positions):
+        moves = playlistsort.sort_moves(new_positions)
+        playlist = apply_moves(new_positions, moves)
+        self.assertEqual(list(range(len(new_positions))), playlist)
+        return moves
+
+    def test_sorted_playlist_is_not_moved(self):
+        self.assertEqual([], self.assertSorts([]))
+        self.assertEqual([], self.assertSorts([0, 1, 2, 3]))
+
+    def test_ranges_are_moved_together(self):
+        new_positions = list(range(1000))
+        new_positions = new_positions[500:600] + new_positions[:500] + \
+                new_positions[600:]
+        self.assertEqual([(0, 100, 500)], self.assertSorts(new_positions))
+
+    def test_only_songs_out_of_order_are_moved(self):
+        moves = self.assertSorts([0, 1, 5, 2, 3, 4, 6, 9, 7, 8])
+        self.assertEqual(2, len(moves))
+
+    def test_random_playlists(self):
+        rand = random.Random(0)
+        for length in [2, 3, 5, 10, 50] * 20:
+            new_positions = list(range(length))
+            rand.shuffle(new_positions)
+            self.assertSorts(new_positions)
+
+    def assertCommandsGive(self, expected, playlist, commands):
+        playlist = list(playlist)
+        for name, arg1, arg2 in commands:
+            if name == 'swap':
+                playlist[arg1], playlist[arg2] = playlist[arg2], playlist[arg1]
+            else:
+                self.assertEqual('move', name)
+                start, end = arg1.split(':')
+                playlist = apply_moves(playlist, [(int(start), int(end),
+                                                   arg2)])
+        self.assertEqual(expected, playlist)
+
+    def test_sort_commands(self):
+        playlist = ['b', 'd', 'a', 'c', 'b']
+        commands = playlistsort.sort_commands(playlist, key=str.upper)
+        self.assertCommandsGive(sorted(playlist), playlist, commands)
+
+    def test_reverse_commands(self):
+        for length in [0, 1, 2, 7, 100]:
+            playlist = list(range(length))
+            commands = playlistsort.reverse_commands(length)
+            self.assertEqual(length // 2, len(commands))
+            self.assertCommandsGive(playlist[::-1], playlist, commands)
+
+    def test_send_commands(self):
+        client = Mock()
+        progress = Mock()
+        commands = [('swap', i, 1999 - i) for i in range(1000)]
+        self.assertTrue(playlistsort.send_commands(client, commands,
+                                                   progress))
+        self.assertEqual(2, client.batch.call_count)
+        progress.assert_called_with(1000, 1000)
+
+    def test_send_commands_checks_the_version(self):
+        client = Mock()
+        versions = iter(['10', '510', '1000'])
+        client.status.side_effect = lambda: {'playlist': next(versions)}
+        commands = [('swap', i, 1999 - i) for i in range(1000)]
+        self.assertTrue(playlistsort.send_commands(client, commands,
+                                                   version=10))
+        self.assertEqual(2, client.batch.call_count)
+
+        # Another client changed the playlist after the first command list
+        client.batch.reset_mock()
+        self.assertFalse(playlistsort.send_commands(client, commands,
+                                                    version=0))
+        self.assertEqual(0, client.batch.call_count)
+
+    def test_send_commands_cancelled(self):
+        client = Mock()
+        request = playlistsort.SortRequest(1000)
+        commands = [('swap', i, 1999 - i) for i in range(1000)]
+        client.batch.side_effect = lambda commands: request.cancel()
+        self.assertFalse(playlistsort.send_commands(
+            client, commands, cancelled=lambda: request.cancelled))
+        self.assertEqual(1, client.batch.call_count)
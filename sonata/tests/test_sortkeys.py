@@ -0,0 +1,54 @@
+import unittest
+
+from sonata import sortkeys
+from sonata.mpdhelper import MPDSong
+
+
+def song(**tags):
+    return MPDSong(dict(tags, file=tags.get('file', 'a/b.ogg')))
+
+
+class TestSortKeys(unittest.TestCase):
+    def sort(self, songs, spec):
+        return sortkeys.sort_songs(songs, sortkeys.parse_spec(spec))
+
+    def test_numbers_are_compared_as_numbers(self):
+        songs = [song(track='10'), song(track='2/12'), song(), song(track='1')]
+        self.assertEqual(['1', '2/12', '10', None],
+                         [dict(s.items()).get('track')
+                          for s in self.sort(songs, "track")])
+
+    def test_durations(self):
+        songs = [song(time='600'), song(time='61'), song(time='9')]
+        self.assertEqual([9, 61, 600],
+                         [s.time for s in self.sort(songs, "length")])
+
+    def test_multiple_fields(self):
+        songs = [song(artist='The B', album='X', track='2'),
+                 song(artist='a', album='Y', track='1'),
+                 song(artist='b', album='X', track='1')]
+        self.assertEqual([('a', 1), ('b', 1), ('The B', 2)],
+                         [(s.artist, s.track)
+                          for s in self.sort(songs, "artist, album, track")])
+
+    def test_album_artist_falls_back_on_artist(self):
+        songs = [song(albumartist='Various', artist='Zed', date='2001'),
+                 song(artist='Abc', date='1999'),
+                 song(albumartist='Various', artist='Abc', date='1990')]
+        self.assertEqual(['1999', '1990', '2001'],
+                         [s.date for s in self.sort(songs,
+                                                    "album-artist, date")])
+
+    def test_title_falls_back_on_file_name(self):
+        songs = [song(title='b'), song(file='x/c.ogg'), song(file='z/a.ogg')]
+        self.assertEqual(['z/a.ogg', 'a/b.ogg', 'x/c.ogg'],
+                         [s.file for s in self.sort(songs, "title")])
+
+    def test_sort_is_stable(self):
+        songs = [song(album='A', title=str(i)) for i in range(10)]
+        self.assertEqual(songs, self.sort(songs, "album"))
+
+    def test_column_spec(self):
+        self.assertEqual(('artist', 'title'), sortkeys.column_spec("%A - %T"))
+        self.assertEqual(('time',), sortkeys.column_spec("%L"))
+        self.assertEqual((), sortkeys.column_spec("100%"))